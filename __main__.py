@@ -9,11 +9,31 @@ import sys, os
 import toml
 from argparse import ArgumentParser
 from utils import * # Yes, everything.
-from fetcher import fetchcomic
+from fetcher import fetchcomic, fetchcomics, updatecomics
+from httpclient import shared as _getter
+from stats import stats
 
 def getlocal(*path):
     return os.path.join(os.path.dirname(__file__), os.path.join(*path))
 
+def addstatsargs(parser):
+    """Adds the options for the phase timings of the run"""
+    parser.add_argument("--stats", action="store_true", default=False,
+        help="Print the time spent in each phase of the run at the end")
+    
+    parser.add_argument("--stats-file", default=statsfile,
+        help="The JSON-lines file the stats of the run are appended to")
+
+def reportstats(args, command):
+    """Saves (and prints) the phase timings of the run"""
+    if args.stats_file:
+        ensure(os.path.dirname(os.path.abspath(args.stats_file)))
+        stats.dump(args.stats_file, command=command,
+            connections=_getter.stats())
+    if args.stats:
+        for line in stats.summary():
+            print(line)
+
 def parse_scrape(*args):
     """Scrapes a web-based comic"""
     desc="""Scrapes a webcomic from the given specifications.
@@ -25,7 +45,7 @@ A specfile or the path of an existing comic must be supplied."""
         help="""The title of the comic to scrape, or a file with a 
 specification to scrape from.""")
     
-    parser.add_argument("-p", "--pages", default=-1, 
+    parser.add_argument("-p", "--pages", default=-1, type=int,
         help="""The number of pages to scrape. Defaults to -1, 
 meaning 'all'.""")
     
@@ -35,10 +55,231 @@ meaning 'all'.""")
     parser.add_argument("-o", "--overwrite", action="store_true", default=False,
         help="Whether the previous entry for this comic should be overwritten")
     
+    parser.add_argument("-w", "--workers", default=4, type=int,
+        help="The number of images to download at the same time")
+    
+    parser.add_argument("--stream", action="store_true", default=False,
+        help="Read pages with the streaming extractor, stopping early")
+    
+    parser.add_argument("--two-phase", action="store_true", default=False,
+        help="Crawl the links first, then download the images of all pages in parallel")
+    
+    addstatsargs(parser)
+    args = parser.parse_args(args)
+    
+    try:
+        fetchcomic(args.spec_or_comic, overwrite=args.overwrite, 
+            startpage=args.startpage, pages=args.pages, workers=args.workers,
+            stream=args.stream, twophase=args.two_phase)
+        print("Connections:", _getter.describe())
+    finally:
+        reportstats(args, _scrapecmd)
+
+def parse_batch(*args):
+    """Scrapes many web-based comics in one process"""
+    desc="""Scrapes all of the given specfiles and/or existing comics in one
+process, sharing the connections between them."""
+    prog = os.path.basename(sys.argv[0])+" "+_batchcmd
+    parser = ArgumentParser(description=desc, prog=prog)
+    
+    parser.add_argument("specs_or_comics", nargs="*", default=[],
+        help="The titles of the comics or the specfiles to scrape")
+    
+    parser.add_argument("-a", "--all", action="store_true", default=False,
+        help="Scrape every comic in local storage as well")
+    
+    parser.add_argument("-p", "--pages", default=-1, type=int,
+        help="The number of pages to scrape of each comic")
+    
+    parser.add_argument("-c", "--connections", default=8, type=int,
+        help="The number of fetches that may run at the same time in total")
+    
+    parser.add_argument("--per-host", default=2, type=int,
+        help="The number of fetches that may run at the same time per host")
+    
+    parser.add_argument("--comics", default=4, type=int,
+        help="The number of comics that are scraped at the same time")
+    
+    parser.add_argument("--stream", action="store_true", default=False,
+        help="Read pages with the streaming extractor, stopping early")
+    
+    parser.add_argument("--two-phase", action="store_true", default=False,
+        help="Crawl the links first, then download the images of all pages in parallel")
+    
+    addstatsargs(parser)
+    args = parser.parse_args(args)
+    requests = list(args.specs_or_comics)
+    if args.all:
+        requests += [c for c in getcomiclist() if not c in requests]
+    if not requests:
+        return print("No comics to scrape!")
+    
+    try:
+        fetchcomics(requests, pages=args.pages, connections=args.connections,
+            perhost=args.per_host, comics=args.comics, stream=args.stream,
+            twophase=args.two_phase)
+    finally:
+        reportstats(args, _batchcmd)
+
+def parse_update(*args):
+    """Scrapes the new pages of the locally stored comics"""
+    desc="""Checks every comic in local storage (or the given ones) for new
+pages, and scrapes only the comics that have them. The last page of each
+comic is revalidated with a conditional request, so unchanged comics are
+skipped without being opened for writing."""
+    prog = os.path.basename(sys.argv[0])+" "+_updatecmd
+    parser = ArgumentParser(description=desc, prog=prog)
+    
+    parser.add_argument("comics", nargs="*", default=[],
+        help="The titles of the comics to update (defaults to all of them)")
+    
+    parser.add_argument("-n", "--dry-run", action="store_true", default=False,
+        help="Only check the comics for new pages")
+    
+    parser.add_argument("--checks", default=16, type=int,
+        help="The number of comics that are checked at the same time")
+    
+    parser.add_argument("-p", "--pages", default=-1, type=int,
+        help="The number of pages to scrape of each comic")
+    
+    parser.add_argument("-c", "--connections", default=8, type=int,
+        help="The number of fetches that may run at the same time in total")
+    
+    parser.add_argument("--per-host", default=2, type=int,
+        help="The number of fetches that may run at the same time per host")
+    
+    parser.add_argument("--stream", action="store_true", default=False,
+        help="Read pages with the streaming extractor, stopping early")
+    
+    parser.add_argument("--two-phase", action="store_true", default=False,
+        help="Crawl the links first, then download the images of all pages in parallel")
+    
+    addstatsargs(parser)
     args = parser.parse_args(args)
+    titles = args.comics or getcomiclist()
+    if not titles:
+        return print("No comics to update!")
     
-    fetchcomic(args.spec_or_comic, overwrite=args.overwrite, 
-        startpage=args.startpage, pages=args.pages)            
+    try:
+        updatecomics(titles, checks=args.checks, pages=args.pages,
+            connections=args.connections, perhost=args.per_host,
+            stream=args.stream, twophase=args.two_phase, dryrun=args.dry_run)
+    finally:
+        reportstats(args, _updatecmd)
+
+def parse_distribute(*args):
+    """Scrapes comics with workers in other processes or on other machines"""
+    desc="""Coordinates a distributed scrape of the given specfiles and/or
+existing comics. The link chain of each comic is crawled here, and its pages
+are put on a work queue in a shared folder for the workers (see 'work') to
+download. The images are merged into the comics in order."""
+    prog = os.path.basename(sys.argv[0])+" "+_distributecmd
+    parser = ArgumentParser(description=desc, prog=prog)
+    
+    parser.add_argument("specs_or_comics", nargs="+",
+        help="The titles of the comics or the specfiles to scrape")
+    
+    parser.add_argument("-q", "--queue", default=queuedir,
+        help="The (shared) folder of the work queue")
+    
+    parser.add_argument("-l", "--local", default=0, type=int,
+        help="The number of workers to start on this machine")
+    
+    parser.add_argument("-p", "--pages", default=-1, type=int,
+        help="The number of pages to scrape of each comic")
+    
+    parser.add_argument("-u", "--unit-size", default=8, type=int,
+        help="The number of pages in a work unit")
+    
+    parser.add_argument("--lease", default=60, type=int,
+        help="The seconds a worker may go without a heartbeat before its unit is given to another")
+    
+    parser.add_argument("-c", "--connections", default=8, type=int,
+        help="The number of fetches of each local worker that may run at the same time in total")
+    
+    parser.add_argument("--per-host", default=2, type=int,
+        help="The number of fetches of each local worker that may run at the same time per host")
+    
+    parser.add_argument("--comics", default=4, type=int,
+        help="The number of comics that are scraped at the same time")
+    
+    parser.add_argument("--stream", action="store_true", default=False,
+        help="Read pages with the streaming extractor, stopping early")
+    
+    addstatsargs(parser)
+    args = parser.parse_args(args)
+    from functools import partial
+    from distributed import WorkQueue, scrapedistributed, startworkers
+    workqueue = WorkQueue(args.queue)
+    workqueue.open()
+    workers = startworkers(args.queue, args.local, lease=args.lease,
+        connections=args.connections, perhost=args.per_host)
+    try:
+        fetchcomics(args.specs_or_comics, pages=args.pages, comics=args.comics,
+            stream=args.stream, scraper=partial(scrapedistributed,
+            queue=args.queue, unitsize=args.unit_size, lease=args.lease))
+    finally:
+        workqueue.close()
+        for worker in workers:
+            worker.wait()
+        reportstats(args, _distributecmd)
+
+def parse_work(*args):
+    """Works on the queue of a distributed scrape"""
+    desc="""Downloads the images of the work units on the queue of a
+distributed scrape (see 'distribute'), until the coordinator is done."""
+    prog = os.path.basename(sys.argv[0])+" "+_workcmd
+    parser = ArgumentParser(description=desc, prog=prog)
+    
+    parser.add_argument("queue", nargs="?", default=queuedir,
+        help="The (shared) folder of the work queue")
+    
+    parser.add_argument("-n", "--name", default=None,
+        help="The name of the worker (defaults to the host and process)")
+    
+    parser.add_argument("-w", "--workers", default=4, type=int,
+        help="The number of images to download at the same time")
+    
+    parser.add_argument("--lease", default=60, type=int,
+        help="The lease of the coordinator, for timing the heartbeats")
+    
+    parser.add_argument("-c", "--connections", default=8, type=int,
+        help="The number of fetches that may run at the same time in total")
+    
+    parser.add_argument("--per-host", default=2, type=int,
+        help="The number of fetches that may run at the same time per host")
+    
+    args = parser.parse_args(args)
+    from distributed import work
+    try:
+        work(args.queue, name=args.name, workers=args.workers, lease=args.lease,
+            connections=args.connections, perhost=args.per_host)
+    except KeyboardInterrupt:
+        print("\nInterrupted! The leased unit goes back to the queue.")
+
+def parse_serve(*args):
+    """Serves the comics for reading in a browser"""
+    desc="""Serves the locally stored comics over HTTP, to be read in a
+browser. Pages are read from the archives as they are requested."""
+    prog = os.path.basename(sys.argv[0])+" "+_servecmd
+    parser = ArgumentParser(description=desc, prog=prog)
+    
+    parser.add_argument("-p", "--port", default=8080, type=int,
+        help="The port to serve on")
+    
+    parser.add_argument("--host", default="127.0.0.1",
+        help="The address to serve on")
+    
+    parser.add_argument("--thumbs", default=256, type=int,
+        help="The number of thumbnails kept in memory")
+    
+    parser.add_argument("--prefetch", default=4, type=int,
+        help="The number of pages read ahead of the one being read")
+    
+    args = parser.parse_args(args)
+    from reader import serve
+    serve(host=args.host, port=args.port, thumbs=args.thumbs,
+        prefetch=args.prefetch)
 
 def printhelp(*args):
     """Prints help text for the commands"""
@@ -63,16 +304,31 @@ def printhelp(*args):
 
 _scrapecmd  = "scrape"
 _editcmd    = "edit"
-_parsed     = {_scrapecmd, _editcmd}
+_batchcmd   = "batch"
+_updatecmd  = "update"
+_servecmd   = "serve"
+_distributecmd = "distribute"
+_workcmd    = "work"
+_parsed     = {_scrapecmd, _editcmd, _batchcmd, _updatecmd, _servecmd,
+    _distributecmd, _workcmd}
 _commands   = {
     _scrapecmd: parse_scrape,
+    _batchcmd:  parse_batch,
+    _updatecmd: parse_update,
+    _servecmd:  parse_serve,
+    _distributecmd: parse_distribute,
+    _workcmd:   parse_work,
     _editcmd:   edit,
     "list":     listcomics,
     "info":     infocomic,
     "help":     printhelp,
     "patch":    patch,
     "resume":   resume,
-    "read":     read
+    "read":     read,
+    "compact":  compact,
+    "rebuild":  rebuild,
+    "process":  process,
+    "export":   export
 }
 
 def main():
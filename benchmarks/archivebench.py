@@ -0,0 +1,88 @@
+# coding: utf-8
+# archivebench.py
+"""
+Compares the archive backends (zip, folder and pack) the way a scrape uses
+them: an archive that holds many images already is opened for appending in
+a number of sessions, which write a few pages of images with a checkpoint
+every few pages (as the journal does) and replace the progress at the end.
+Then random members are read back, and the other backends are exported to
+a .cbz. Run it from the project directory:
+python benchmarks/archivebench.py [existing images] [sessions]
+"""
+import os, sys, json, time, random, tempfile
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from zipbench import makeimages
+from stores import backends, export
+
+def fill(backend, path, images, count):
+    """Makes an archive of 'count' images (cycling through the given ones)"""
+    archive = backend.create(path)
+    for num in range(count):
+        name, data = images[num % len(images)]
+        archive.write("image{0}.{1}".format(num + 1, name.split(".")[-1]), data)
+    archive.close()
+
+def run(backend, images, existing, sessions, perpage=4, reads=200, seed=1):
+    """Times the sessions, the reads and the export of the backend"""
+    rand = random.Random(seed)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bench.cbz")
+        fill(backend, path, images, existing)
+        count = existing
+        written = 0
+        started = time.perf_counter()
+        for session in range(sessions):
+            archive = backend.load(path, mode="a")
+            for page in range(perpage):
+                name, data = images[count % len(images)]
+                count += 1
+                archive.write("image{0}.{1}".format(count, name.split(".")[-1]), data)
+                written += len(data)
+                if page % 2: # Like the journal's group commits
+                    archive.checkpoint()
+            archive.write(".progress.toml", "lastindex = {0}\n".format(count))
+            archive.close()
+        appended = time.perf_counter() - started
+
+        started = time.perf_counter()
+        archive = backend.load(path)
+        members = [member for member in archive.list() if member.startswith("image")]
+        opened = time.perf_counter() - started
+        read = 0
+        started = time.perf_counter()
+        for _ in range(reads):
+            read += len(archive.readbytes(rand.choice(members)))
+        archive.close()
+        readtime = time.perf_counter() - started
+
+        started = time.perf_counter()
+        export(path)
+        exported = time.perf_counter() - started
+        return {
+            "sessions_s": appended,
+            "session_ms": appended / sessions * 1e3,
+            "append_mb_s": written / 2**20 / appended,
+            "open_ms": opened * 1e3,
+            "read_mb_s": read / 2**20 / readtime,
+            "export_s": exported,
+        }
+
+def main(existing=500, sessions=50):
+    print("Generating images...")
+    images = makeimages(8)
+    print("Appending {0} sessions to archives of {1} images...".format(sessions,
+        existing))
+    results = {}
+    for name, backend in sorted(backends.items()):
+        results[name] = result = run(backend, images, existing, sessions)
+        print("- {0}: {1:.1f} ms/session ({2:.1f} MB/s appended), open {3:.1f} ms, "
+            "read {4:.1f} MB/s, export {5:.2f}s".format(name, result["session_ms"],
+            result["append_mb_s"], result["open_ms"], result["read_mb_s"],
+            result["export_s"]))
+    print(json.dumps(results, indent=1, sort_keys=True))
+    return results
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
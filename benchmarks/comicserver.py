@@ -0,0 +1,127 @@
+# coding: utf-8
+# comicserver.py
+"""
+A local stand-in for a comic website, for benchmarking without the network.
+It serves a generated comic of numbered pages, each with a number of comic
+images, a header banner and a thumbnail, filler markup to make the page as
+large as wanted, and a link to the next page. Responses can be delayed to
+imitate the latency of a real host.
+"""
+import io, time, random, threading
+import http.server
+from PIL import Image
+
+class ComicSite:
+    """The shape of the generated comic"""
+    def __init__(self, pages=20, images=1, imagesize=(800, 1100), filler=200,
+        latency=0.0, seed=1):
+        self.pages      = pages
+        self.images     = images # Comic images per page
+        self.imagesize  = imagesize
+        self.filler     = filler # Extra elements (and comments) per page
+        self.latency    = latency # Seconds added to every response
+        self.seed       = seed
+        self.cache      = {}
+        self.lock       = threading.Lock()
+
+    def page(self, num):
+        """The html of the page with the given number"""
+        rand = random.Random(self.seed * 1000 + num)
+        nextnum = min(num + 1, self.pages) # The last page links to itself
+        filler = "\n".join(
+            '<div class="post" id="post{0}"><!-- comment {0} --><p>{1}</p>'
+            '<a href="/archive/{0}">permalink</a></div>'.format(
+                n, " ".join(rand.choice(["lorem", "ipsum", "dolor", "sit"])
+                    for _ in range(12)))
+            for n in range(self.filler))
+        images = "\n".join('<img src="/comics/{0}_{1}.png" alt="">'.format(num, n)
+            for n in range(self.images))
+        return """<html><head><title>Comic {num}</title></head><body>
+<header><img src="/static/banner.png"></header>
+<div id="sidebar"><img src="/static/thumb.png"></div>
+<div id="comic">{images}</div>
+<div class="nav"><a class="prev" href="/page/{prev}">Previous</a>
+<a class="next" href="/page/{nextnum}">Next</a></div>
+<section id="comments">{filler}</section>
+</body></html>""".format(num=num, prev=max(num - 1, 1), nextnum=nextnum,
+            images=images, filler=filler).encode("utf-8")
+
+    def image(self, size, key):
+        """A PNG of the given size (generated once per key)"""
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+        rand = random.Random(key)
+        image = Image.new("RGB", size, (255, 255, 255))
+        pixels = image.load()
+        for _ in range(size[0] * size[1] // 100):
+            pixels[rand.randrange(size[0]), rand.randrange(size[1])] = (
+                rand.randrange(256), rand.randrange(256), rand.randrange(256))
+        out = io.BytesIO()
+        image.save(out, format="png")
+        with self.lock:
+            self.cache[key] = out.getvalue()
+        return self.cache[key]
+
+    def url(self, server, num=1):
+        return "http://127.0.0.1:{0}/page/{1}".format(server.server_port, num)
+
+    def content(self, path):
+        """Returns the content type and body of the path (or None)"""
+        parts = path.strip("/").split("/")
+        if parts[0] == "page" and len(parts) == 2 and parts[1].isdigit():
+            num = int(parts[1])
+            if 1 <= num <= self.pages:
+                return "text/html; charset=utf-8", self.page(num)
+        if parts[0] == "comics" and len(parts) == 2:
+            # Every page gets its own images
+            num = parts[1].split(".")[0]
+            return "image/png", self.image(self.imagesize, num)
+        if path == "/static/banner.png":
+            return "image/png", self.image((728, 90), "banner")
+        if path == "/static/thumb.png":
+            return "image/png", self.image((100, 100), "thumb")
+        return None
+
+def makehandler(site):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive
+        def do_GET(self):
+            if site.latency:
+                time.sleep(site.latency)
+            found = site.content(self.path)
+            if not found:
+                self.send_error(404)
+                return
+            contenttype, body = found
+            self.send_response(200)
+            self.send_header("Content-Type", contenttype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    def handle_error(self, request, address):
+        pass # Clients that stop reading early hang up on us
+
+def serve(site, port=0):
+    """Starts serving the site on a background thread; returns the server"""
+    server = Server(("127.0.0.1", port), makehandler(site))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    import sys
+    site = ComicSite()
+    server = serve(site, port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    print("Serving a {0}-page comic at {1}".format(site.pages, site.url(server)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
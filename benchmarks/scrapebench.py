@@ -0,0 +1,175 @@
+# coding: utf-8
+# scrapebench.py
+"""
+Benchmarks comic creation and scraping against the local comic server,
+without the network. Reports pages/s, bytes/s, the time spent identifying
+tags and the zip write throughput as JSON, so runs of different commits can
+be compared (--output to save a run, --compare to diff against one).
+Run it from the project directory: python benchmarks/scrapebench.py -h
+"""
+import os, sys, io, json, time, tempfile, threading, subprocess, contextlib
+from argparse import ArgumentParser
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from comicserver import ComicSite, serve
+
+class Timer:
+    """Accumulates the time (and bytes) spent in a function"""
+    def __init__(self):
+        self.seconds    = 0.0
+        self.calls      = 0
+        self.bytes      = 0
+        self.lock       = threading.Lock()
+
+    def wrap(self, func, measure=None):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                spent = time.perf_counter() - started
+                with self.lock:
+                    self.seconds += spent
+                    self.calls += 1
+                    if measure:
+                        self.bytes += measure(*args)
+        return timed
+
+def commit():
+    """The commit that is benchmarked (if this is a git checkout)"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=root, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run(args):
+    """Runs the benchmark in a temporary home (removed afterwards),
+    returning the results"""
+    with tempfile.TemporaryDirectory(prefix="comicbench") as home:
+        os.environ["COMIC_SCRAPER_HOME"] = home
+        try:
+            return bench(args, home)
+        finally: # Let go of the databases in the home before it goes
+            import httpclient, catalog, imageindex
+            for db in (httpclient.shared.cache, catalog.shared, imageindex.shared):
+                if db:
+                    db.close()
+
+def bench(args, home):
+    """Creates and scrapes the benchmark comic in the home"""
+    import finder, ziparchive, httpclient
+    from comic import Comic
+    from fetcher import fetchcomic
+    if not args.cache:
+        httpclient.shared.cache = None
+
+    identify = Timer()
+    finder.Identifier.identify = identify.wrap(finder.Identifier.identify)
+    # Comic creation indexes the pages once and evaluates identifiers on that
+    finder.PageIndex.__init__ = identify.wrap(finder.PageIndex.__init__)
+    finder.PageIndex.evaluate = identify.wrap(finder.PageIndex.evaluate)
+    zipwrite = Timer()
+    def written(archive, member, content):
+        return len(content) if isinstance(content, (bytes, str)) else 0
+    ziparchive.ZipArchive.write = zipwrite.wrap(ziparchive.ZipArchive.write, written)
+    writestream = ziparchive.ZipArchive.writestream
+    def countedstream(archive, member, chunks):
+        def counted():
+            for chunk in chunks:
+                zipwrite.bytes += len(chunk)
+                yield chunk
+        return writestream(archive, member, counted())
+    ziparchive.ZipArchive.writestream = zipwrite.wrap(countedstream)
+
+    width, height = [int(n) for n in args.image_size.split("x")]
+    site = ComicSite(pages=args.pages, images=args.images,
+        imagesize=(width, height), filler=args.filler, latency=args.latency)
+    server = serve(site)
+    specs = {
+        "title": "Benchmark",
+        "authors": ["comicserver"],
+        "startpage": site.url(server, 1),
+        "nextpage": site.url(server, 2),
+    }
+    specfile = os.path.join(home, "benchmark.toml")
+    with open(specfile, "w") as f:
+        import toml
+        toml.dump(specs, f)
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        started = time.perf_counter()
+        Comic.create(specs, directory=home)
+        created = time.perf_counter() - started
+        identifycreate = identify.seconds
+
+        started = time.perf_counter()
+        tally = fetchcomic(specfile, workers=args.workers, stream=args.stream)
+        scraped = time.perf_counter() - started
+    server.shutdown()
+    if args.verbose:
+        print(log.getvalue(), file=sys.stderr)
+
+    return {
+        "commit": commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": vars(args),
+        "create_seconds": created,
+        "create_identify_seconds": identifycreate,
+        "scrape_seconds": scraped,
+        "pages": tally['pages'],
+        "images": tally['images'],
+        "bytes": tally['bytes'],
+        "pages_per_s": tally['pages'] / scraped,
+        "bytes_per_s": tally['bytes'] / scraped,
+        "identify_seconds": identify.seconds,
+        "identify_calls": identify.calls,
+        "zip_write_seconds": zipwrite.seconds,
+        "zip_write_mb_s": zipwrite.bytes / 2**20 / max(zipwrite.seconds, 1e-9),
+        "connections": httpclient.shared.stats(),
+    }
+
+def compare(results, old):
+    """Prints how the numbers changed from the old results"""
+    print("Compared to {0} ({1}):".format(old.get("commit"), old.get("time")),
+        file=sys.stderr)
+    for key, val in results.items():
+        before = old.get(key)
+        if isinstance(val, float) and isinstance(before, float) and before:
+            print("- {0}: {1:.4g} -> {2:.4g} ({3:+.1%})".format(key, before, val,
+                val / before - 1), file=sys.stderr)
+
+def main(*args):
+    parser = ArgumentParser(description="Benchmarks scraping a local comic")
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument("--images", type=int, default=1,
+        help="Comic images per page")
+    parser.add_argument("--image-size", default="800x1100")
+    parser.add_argument("--filler", type=int, default=200,
+        help="Filler elements per page (the DOM size)")
+    parser.add_argument("--latency", type=float, default=0.02,
+        help="Seconds added to every response")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--stream", action="store_true", default=False)
+    parser.add_argument("--cache", action="store_true", default=False,
+        help="Keep the response cache on")
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument("--compare", help="Results of an earlier run to compare to")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    args = parser.parse_args(args)
+
+    results = run(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,69 @@
+# coding: utf-8
+# zipbench.py
+"""
+Measures the write and read throughput of ZipArchive with images, comparing
+deflating every member to the compression policy (storing compressed images).
+Run it from the project directory: python benchmarks/zipbench.py [count]
+"""
+import os, sys, io, time, random, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PIL import Image
+from ziparchive import ZipArchive, compression
+
+def makeimages(count, size=(800, 1100), seed=1):
+    """Generates comic-sized JPEG and PNG images with some noise in them"""
+    rand = random.Random(seed)
+    images = []
+    for num in range(count):
+        image = Image.new("RGB", size, (255, 255, 255))
+        pixels = image.load()
+        for _ in range(size[0] * size[1] // 50):
+            pixels[rand.randrange(size[0]), rand.randrange(size[1])] = (
+                rand.randrange(256), rand.randrange(256), rand.randrange(256))
+        out = io.BytesIO()
+        ending = "png" if num % 2 else "jpeg"
+        image.save(out, format=ending)
+        images.append(("image{0}.{1}".format(num + 1, ending), out.getvalue()))
+    return images
+
+def run(images, policy):
+    """Writes and reads back the images, returning the timings"""
+    total = sum(len(data) for name, data in images)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bench.cbz")
+        started = time.perf_counter()
+        archive = ZipArchive.create(path)
+        archive.policy = policy
+        for name, data in images:
+            archive.write(name, data)
+        archive.close()
+        written = time.perf_counter() - started
+
+        started = time.perf_counter()
+        archive = ZipArchive.load(path)
+        for name, data in images:
+            archive.arch.read(name)
+        archive.close()
+        read = time.perf_counter() - started
+        return {
+            "bytes": total,
+            "archive_bytes": os.path.getsize(path),
+            "write_mb_s": total / 2**20 / written,
+            "read_mb_s": total / 2**20 / read,
+        }
+
+def main(count=40):
+    print("Generating {0} images...".format(count))
+    images = makeimages(count)
+    results = {
+        "deflate_all": run(images, None),
+        "policy": run(images, compression),
+    }
+    for name, result in results.items():
+        print("- {0}: write {1:.1f} MB/s, read {2:.1f} MB/s, {3} -> {4} bytes".format(
+            name, result["write_mb_s"], result["read_mb_s"], result["bytes"],
+            result["archive_bytes"]))
+    return results
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
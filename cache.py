@@ -0,0 +1,205 @@
+# coding: utf-8
+# cache.py
+"""
+A persistent on-disk cache for fetched pages and images. Bodies are stored
+by their content hash (so the same image under many urls is stored once),
+urls point at the bodies along with their ETag/Last-Modified validators, and
+the least recently used bodies are evicted when the cache grows too large.
+Pages and images have budgets of their own, so the many images a scrape
+downloads never evict the pages that updates revalidate.
+"""
+import os, time, hashlib, sqlite3, threading, tempfile
+
+class Entry:
+    """The cached response of a url"""
+    def __init__(self, url, digest, etag, lastmodified, fetched):
+        self.url            = url
+        self.digest         = digest
+        self.etag           = etag
+        self.lastmodified   = lastmodified
+        self.fetched        = fetched # When it was last known to be current
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def conditions(self):
+        """Returns the headers that make a GET of the url conditional"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.lastmodified:
+            headers["If-Modified-Since"] = self.lastmodified
+        return headers
+
+def kindof(contenttype):
+    """The kind of a body ("image" or "page") by its Content-Type"""
+    return "image" if (contenttype or "").startswith("image/") else "page"
+
+class ResponseCache:
+    """A content-addressed response cache with LRU eviction. Of 'maxbytes',
+    'pagebytes' are kept for pages and the rest for images."""
+    def __init__(self, directory, maxbytes=512 * 2**20, pagebytes=64 * 2**20):
+        self.directory  = directory
+        self.maxbytes   = maxbytes
+        self.pagebytes  = min(pagebytes, maxbytes)
+        self.lock       = threading.Lock()
+        self.db         = None # Opened on first use
+
+    def _open(self):
+        if self.db is None:
+            os.makedirs(os.path.join(self.directory, "blobs"), exist_ok=True)
+            path = os.path.join(self.directory, "index.db")
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    digest TEXT PRIMARY KEY, size INTEGER, accessed REAL,
+                    kind TEXT DEFAULT 'image');
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY, digest TEXT, etag TEXT,
+                    lastmodified TEXT, fetched REAL);
+            """)
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(blobs)")]
+            if not "kind" in columns: # A cache from before the budgets
+                self.db.execute("ALTER TABLE blobs ADD COLUMN kind TEXT DEFAULT 'image'")
+            self.db.execute("DROP INDEX IF EXISTS byaccess")
+            self.db.execute("CREATE INDEX IF NOT EXISTS bykind ON blobs (kind, accessed)")
+            self.db.commit()
+            self.sizes = dict(self.db.execute(
+                "SELECT kind, SUM(size) FROM blobs GROUP BY kind").fetchall())
+        return self.db
+
+    def budget(self, kind):
+        """The bytes the bodies of the kind may take"""
+        return self.pagebytes if kind == "page" else self.maxbytes - self.pagebytes
+
+    def blobpath(self, digest):
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def lookup(self, url):
+        """Returns the cache entry of the url, or None"""
+        with self.lock:
+            row = self._open().execute("SELECT digest, etag, lastmodified, "
+                "fetched FROM urls WHERE url = ?", (url,)).fetchone()
+        return Entry(url, *row) if row else None
+
+    def body(self, entry):
+        """Returns the cached body of the entry (or None if it is gone),
+        and marks it as recently used"""
+        try:
+            with open(self.blobpath(entry.digest), "rb") as f:
+                data = f.read()
+        except OSError:
+            self.forget(entry.url)
+            return None
+        with self.lock:
+            self._open().execute("UPDATE blobs SET accessed = ? WHERE digest = ?",
+                (time.time(), entry.digest))
+            self.db.commit()
+        return data
+
+    def refresh(self, entry):
+        """Marks the entry as current (after a '304 Not Modified')"""
+        with self.lock:
+            self._open().execute("UPDATE urls SET fetched = ? WHERE url = ?",
+                (time.time(), entry.url))
+            self.db.commit()
+
+    def writer(self, url, etag=None, lastmodified=None, kind="page"):
+        """Returns a BlobWriter that stores a body for the url as it is
+        written, so that streamed responses are cached as well"""
+        self._open()
+        return BlobWriter(self, url, etag, lastmodified, kind)
+
+    def store(self, url, body, etag=None, lastmodified=None, kind="page"):
+        """Stores the body as the current response of the url"""
+        writer = self.writer(url, etag=etag, lastmodified=lastmodified, kind=kind)
+        writer.write(body)
+        return writer.commit()
+
+    def _index(self, url, digest, size, etag, lastmodified, kind):
+        """Points the url at the stored body"""
+        now = time.time()
+        with self.lock:
+            db = self._open()
+            known = db.execute("SELECT kind FROM blobs WHERE digest = ?",
+                (digest,)).fetchone()
+            if known:
+                kind = known[0]
+                db.execute("UPDATE blobs SET accessed = ? WHERE digest = ?",
+                    (now, digest))
+            else:
+                db.execute("INSERT INTO blobs VALUES (?, ?, ?, ?)",
+                    (digest, size, now, kind))
+                self.sizes[kind] = self.sizes.get(kind, 0) + size
+            db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)",
+                (url, digest, etag, lastmodified, now))
+            self._evict(kind)
+            db.commit()
+
+    def forget(self, url):
+        """Removes the url from the cache (its body may stay for others)"""
+        with self.lock:
+            self._open().execute("DELETE FROM urls WHERE url = ?", (url,))
+            self.db.commit()
+
+    def _evict(self, kind):
+        """Removes the least recently used bodies of the kind until they fit
+        in its budget. Must be called with the lock held."""
+        while self.sizes.get(kind, 0) > self.budget(kind):
+            row = self.db.execute("SELECT digest, size FROM blobs WHERE kind = ? "
+                "ORDER BY accessed LIMIT 1", (kind,)).fetchone()
+            if not row:
+                break
+            digest, size = row
+            self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            self.db.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+            self.sizes[kind] -= size
+            try:
+                os.remove(self.blobpath(digest))
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+class BlobWriter:
+    """Writes a body to a temporary file while hashing it, and moves it into
+    place under its content hash on commit"""
+    def __init__(self, cache, url, etag, lastmodified, kind="page"):
+        self.cache          = cache
+        self.url            = url
+        self.etag           = etag
+        self.lastmodified   = lastmodified
+        self.kind           = kind
+        self.hash           = hashlib.sha1()
+        self.size           = 0
+        # Written next to the blobs, so no reader sees half a blob
+        fd, self.temp = tempfile.mkstemp(dir=os.path.join(cache.directory, "blobs"))
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        """Stores the body and returns its digest"""
+        self.file.close()
+        digest  = self.hash.hexdigest()
+        path    = self.cache.blobpath(digest)
+        if os.path.exists(path):
+            os.remove(self.temp)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.temp, path)
+        self.cache._index(self.url, digest, self.size, self.etag,
+            self.lastmodified, self.kind)
+        return digest
+
+    def abort(self):
+        """Throws away what was written"""
+        self.file.close()
+        os.remove(self.temp)
@@ -0,0 +1,185 @@
+# coding: utf-8
+# catalog.py
+"""
+The catalog of the comics in local storage. It keeps what list, info and
+read need to know about every comic (its size, progress, authors and tags)
+in an SQLite database in the metadata folder, so they don't have to open
+the archives. Comics update their entry when they are created or closed,
+and 'rebuild' scans the archives to make it anew. 'reconcile' adds the
+archives that were put in the comic folder by hand (or by another copy of
+the library) and drops the entries of the ones that are gone.
+"""
+import os, json, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor
+import toml
+from utils import catalogfile, comicdir, extension
+from stores import loadarchive, archivesize
+from utils import metadatafile, progressfile
+
+class Catalog:
+    """An index of the comics in the library, by title"""
+    fields = ["title", "path", "size", "images", "pages", "lastpage",
+        "scraped", "authors", "tags"]
+
+    def __init__(self, path):
+        self.path   = path
+        self.lock   = threading.Lock()
+        self.db     = None # Opened on first use
+
+    def _open(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS comics (
+                    title TEXT PRIMARY KEY, path TEXT, size INTEGER,
+                    images INTEGER, pages INTEGER, lastpage TEXT,
+                    scraped REAL, authors TEXT, tags TEXT);
+            """)
+        return self.db
+
+    def built(self):
+        """Whether the catalog was built from the archives (and so has every
+        comic, not just the ones that were changed since it was made)"""
+        with self.lock:
+            return self._open().execute("PRAGMA user_version").fetchone()[0] > 0
+
+    def update(self, title, path, metadata, progress, scraped=None):
+        """Updates the entry of the comic stored at the path. The time of the
+        last scrape is kept unless a new one is given."""
+        with self.lock:
+            db = self._open()
+            if scraped is None:
+                row = db.execute("SELECT scraped FROM comics WHERE title = ?",
+                    (title,)).fetchone()
+                scraped = row[0] if row else None
+            db.execute("INSERT OR REPLACE INTO comics VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?)", (title, path,
+                archivesize(path), progress.get('lastindex', 0),
+                progress.get('pages'), progress.get('lastpage', ""), scraped,
+                json.dumps(metadata.get('authors', [])),
+                json.dumps(metadata.get('tags', []))))
+            db.commit()
+
+    def resize(self, title, path):
+        """Updates the size of the archive of the comic (after a compact)"""
+        with self.lock:
+            self._open().execute("UPDATE comics SET size = ? WHERE title = ?",
+                (archivesize(path), title))
+            self.db.commit()
+
+    def remove(self, title):
+        with self.lock:
+            self._open().execute("DELETE FROM comics WHERE title = ?", (title,))
+            self.db.commit()
+
+    def titles(self, prefix=""):
+        """The sorted titles of the comics starting with the prefix"""
+        with self.lock:
+            if prefix: # A range scan of the primary key
+                rows = self._open().execute("SELECT title FROM comics WHERE "
+                    "title >= ? AND title < ? ORDER BY title",
+                    (prefix, prefix + "\U0010ffff")).fetchall()
+            else:
+                rows = self._open().execute(
+                    "SELECT title FROM comics ORDER BY title").fetchall()
+        return [row[0] for row in rows]
+
+    def get(self, title):
+        """Returns the entry of the comic as a dict, or None"""
+        with self.lock:
+            row = self._open().execute("SELECT * FROM comics WHERE title = ?",
+                (title,)).fetchone()
+        if not row:
+            return None
+        entry = dict(zip(Catalog.fields, row))
+        entry['authors']    = json.loads(entry['authors'])
+        entry['tags']       = json.loads(entry['tags'])
+        return entry
+
+    def find(self, name):
+        """Returns the title of the comic with the name, or else of the first
+        one starting with it (or None)"""
+        if self.get(name):
+            return name
+        titles = self.titles(name)
+        return titles[0] if titles else None
+
+    def paths(self):
+        """The paths of the entries of the catalog, by title"""
+        with self.lock:
+            rows = self._open().execute("SELECT title, path FROM comics").fetchall()
+        return dict(rows)
+
+    def reconcile(self, workers=8):
+        """Adds the archives in the comic folder that have no entry and
+        removes the entries whose archive is gone. Returns the number of
+        comics added and removed."""
+        stored = {os.path.basename(path)[:-len(extension)]: path
+            for path in archivepaths()}
+        entries = self.paths()
+        gone = [title for title, path in entries.items()
+            if not title in stored or not os.path.exists(path)]
+        for title in gone:
+            self.remove(title)
+        missing = [path for title, path in stored.items()
+            if not title in entries or title in gone]
+        added = self.add(missing, workers)[0] if missing else 0
+        return added, len(gone)
+
+    def rebuild(self, workers=8):
+        """Makes the catalog anew by reading every archive, 'workers' at a
+        time. Returns the number of comics and the archives that failed."""
+        with self.lock:
+            self._open().execute("DELETE FROM comics")
+            self.db.commit()
+        count, failed = self.add(archivepaths(), workers)
+        with self.lock:
+            self.db.execute("PRAGMA user_version = 1")
+            self.db.commit()
+        return count, failed
+
+    def add(self, paths, workers=8):
+        """Adds the entries of the archives at the paths by reading them.
+        Returns the number of comics added and the archives that failed."""
+        def scan(path):
+            archive = loadarchive(path)
+            try:
+                metadata = toml.loads(archive.read(metadatafile))
+                progress = toml.loads(archive.read(progressfile))
+            finally:
+                archive.close()
+            return metadata, progress
+        def scanone(path):
+            try:
+                return path, scan(path), None
+            except Exception as e:
+                return path, None, e
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(scanone, paths))
+        failed = []
+        for path, found, error in results:
+            if error:
+                failed.append((path, error))
+                continue
+            metadata, progress = found
+            title = os.path.basename(path)[:-len(extension)]
+            self.update(title, path, metadata, progress,
+                scraped=os.path.getmtime(path))
+        return len(results) - len(failed), failed
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+def archivepaths():
+    """The paths of the archives in the comic folder"""
+    if not os.path.exists(comicdir):
+        return []
+    return [os.path.join(comicdir, file) for file in os.listdir(comicdir)
+        if file.endswith(extension)]
+
+shared = Catalog(catalogfile)
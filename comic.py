@@ -1,59 +1,174 @@
 # coding: utf-8
 # Created by Jabok @ August 14th 2014
 # comic.py
-import os, toml, imghdr, tempfile, sys
-from getter import Getter
+import os, re, time, toml, imghdr, itertools
 from utils import defaultarchive, comicdir, progressfile, metadatafile, extension # vars
+from stores import backends, archivetype, loadarchive, removearchive
 from utils import assertpath # funcs
 from linkers import findlinker
 from images import findimagefinder
+from journal import Journal, PageList
+from pipeline import download, spoolchunks
+from imageindex import ImageIndex, shared as _library
+from catalog import shared as _catalog
 
 """
 Holds the comic class and its utilities
 """
 
-_getter = Getter(timeout=5)
 class Comic:
     """Convenience class for the representation of a comic"""
-    def __init__(self, archive, progress, metadata):
+    def __init__(self, archive, progress, metadata, journal=None, index=None):
         self.archive    = archive
         self.progress   = progress
         self.metadata   = metadata
+        self.journal    = journal
+        self.index      = index or ImageIndex()
+        self.library    = _library if progress.get('sharedindex') else None
         
         # If the scraper breaks halway through scraping a page with multiple images
         self.unsavedindex   = progress['lastindex']
-        #self.unsavedimages  = []
+        self.unsavedimages  = []
+        self.unsavedhashes  = [] # [url, digest, member] (for the journal)
+        self.scraped        = False # Whether pages were added this session
     
     def add(self, imageurl, reconnect=False):
         """Adds an image with the given url to the comic"""
-        index       = self.progress['lastindex'] + 1
-        imgbytes    = _getter.get_read(imageurl, reconnect=reconnect)
-        ending      = imghdr.what(None, imgbytes)
+        spool, digest = download(imageurl, reconnect=reconnect)
+        with spool:
+            self.addstream(spoolchunks(spool))
+    
+    def addimage(self, imgbytes):
+        """Adds the given (already downloaded) image bytes to the comic"""
+        self.addstream([imgbytes])
+    
+    def addstream(self, chunks):
+        """Adds an image from an iterable of byte chunks, writing them into
+        the archive as they come. The format is sniffed from the start."""
+        chunks      = iter(chunks)
+        head        = b""
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 32: # Enough for imghdr
+                break
+        index       = self.unsavedindex + 1
+        ending      = imghdr.what(None, head)
         fname       = "image{0}.{1}".format(str(index), ending)
 
-        self.archive.write(fname, imgbytes)
+        if self.journal: # Checkpoint the archive before changing it
+            self.journal.begin(self.archive)
+        self.archive.writestream(fname, itertools.chain([head], chunks))
         self.unsavedindex = index
-        #self.unsavedimages.append(fname)
+        self.unsavedimages.append(fname)
+        return fname
     
-    def setscraped(self, page, images):
-        """Sets the last fetched page of the comic to the given one"""
+    def knowndigest(self, url):
+        """Returns the content hash of the image at the url if the comic
+        stores that content already, so it needn't be downloaded again"""
+        digest = self.index.digestof(url)
+        if not digest and self.library:
+            digest = self.library.digestof(url)
+        return digest if self.index.memberof(digest) else None
+    
+    def addunique(self, url, digest, chunks, size=0):
+        """Adds the downloaded image at the url, unless the same content is
+        stored already and duplicates are skipped ('duplicates' = "skip" in
+        the progress, the default). Returns whether it was written."""
+        member = self.index.memberof(digest)
+        if member and self.progress.get('duplicates', "skip") == "skip":
+            member = None
+        else:
+            member = self.addstream(chunks)
+        self.index.add(url, digest, member)
+        self.unsavedhashes.append([url, digest, member])
+        if self.library:
+            self.library.add(self.metadata['title'], url, digest, size)
+        return member is not None
+    
+    def addknown(self, url, digest):
+        """Adds the image at the url, whose content is stored already (see
+        'knowndigest'). Returns whether it was written."""
+        member = self.index.memberof(digest)
+        def stored(): # Only read if it is written again
+            yield self.archive.readbytes(member)
+        return self.addunique(url, digest, stored())
+    
+    def setscraped(self, page, images, nextpage=None, digest=None):
+        """Sets the last fetched page of the comic to the given one.
+        The link to the next page is kept too, if it is known, so that a
+        resumed scrape can start there without fetching the last page, and
+        so is the content hash of the page, which tells an update whether
+        the page changed since."""
+        self.countpage()
         self.progress['lastpage']   = page
         self.progress['lastimages'] = images
         self.progress['lastindex']  = self.unsavedindex
-        #self.unsavedimages          = [] # clear
+        self.progress['nextpage']   = nextpage or ""
+        self.progress['lastdigest'] = digest or ""
+        self.progress['finished']   = False # Until the scrape reaches the end
+        self.scraped                = True
+        if self.journal:
+            self.journal.record(self.archive, page, images, self.unsavedimages,
+                self.unsavedindex, nextpage, self.unsavedhashes, digest)
+        self.unsavedimages          = [] # clear
+        self.unsavedhashes          = []
+    
+    def countpage(self):
+        """Counts a scraped page. Archives scraped before pages were counted
+        have no count, which stays unknown rather than wrong."""
+        if 'pages' in self.progress or not self.progress['lastpage']:
+            self.progress['pages'] = self.progress.get('pages', 0) + 1
+    
+    def recover(self, records):
+        """Replays the journal records of a session that didn't end cleanly,
+        and removes the images that were written after the last record."""
+        recovered = 0
+        members = set(self.archive.list())
+        for record in records:
+            if record['lastindex'] <= self.progress['lastindex']:
+                continue # Saved already
+            if not all(member in members for member in record['members']):
+                break # Lost with the end of the archive
+            self.countpage()
+            self.progress['lastpage']   = record['page']
+            self.progress['lastimages'] = record['images']
+            self.progress['lastindex']  = record['lastindex']
+            self.progress['nextpage']   = record['nextpage']
+            self.progress['lastdigest'] = record.get('digest', "")
+            self.progress['finished']   = False # Interrupted
+            self.scraped                = True
+            for url, digest, member in record.get('hashes', []):
+                self.index.add(url, digest, member)
+            recovered += 1
+        orphans = []
+        for member in members:
+            match = re.match(r"image(\d+)\.", member)
+            if match and int(match.group(1)) > self.progress['lastindex']:
+                orphans.append(member)
+        for member in orphans:
+            self.archive.remove(member)
+        self.index.prune(member for member in members if not member in orphans)
+        self.unsavedindex = self.progress['lastindex']
+        return recovered, len(orphans)
     
     def __enter__(self): # Support context management
         return self
     
     def __exit__(self, *errargs):
-        # Write changes to metadata and progress
-        with tempfile.TemporaryFile(mode="w") as f: # Act responsibly: No evidence
-            out = sys.stderr
-            sys.stderr = f
-            self.archive.write(metadatafile, toml.dumps(self.metadata))
-            self.archive.write(progressfile, toml.dumps(self.progress))
-            sys.stderr = out
+        # Write changes to metadata and progress (replacing the old ones;
+        # what didn't change isn't written, so the archive doesn't grow)
+        members, removed = self.index.changes()
+        for segment in removed:
+            self.archive.remove(segment)
+        members[metadatafile] = toml.dumps(self.metadata)
+        members[progressfile] = toml.dumps(self.progress) # Changes most often
+        self.archive.writemany(members)
         self.archive.close() # Clean up
+        if self.journal:
+            self.journal.finish()
+        title = os.path.basename(self.archive.path)[:-len(extension)]
+        _catalog.update(title, self.archive.path, self.metadata, self.progress,
+            scraped=time.time() if self.scraped else None)
     
     def create(specs, directory=None):
         """Creates a new comic with the given name and specification dictionary,
@@ -71,9 +186,18 @@ class Comic:
         archivepath = os.path.join(comicdir, title+extension)
         if os.path.exists(archivepath):
             print("- Removing old archive")
-            os.remove(archivepath)
+            removearchive(archivepath)
+        Journal.remove(archivepath)
+        PageList.remove(archivepath)
+        if specs.get('sharedindex') or _library.exists(): # Not made for nothing
+            _library.forget(title)
         
-        archive =  defaultarchive.create(archivepath)
+        # The backend the comic is scraped into (see stores.py)
+        backend = specs.get('archive')
+        if backend and not backend in backends:
+            raise Exception("Unknown archive backend '{0}' (one of {1})".format(
+                backend, ", ".join(sorted(backends))))
+        archive = (backends[backend] if backend else defaultarchive).create(archivepath)
         # Copy metadata over
         def copypath(member, target):
             if member in specs:
@@ -93,7 +217,8 @@ class Comic:
         progress = {
             'lastindex': 0, # Start indexing at one(ce)!
             'lastimages': [],
-            'lastpage': ""
+            'lastpage': "",
+            'pages': 0
         }
         
         print("- Generating scraping identifiers")
@@ -103,9 +228,19 @@ class Comic:
         else:
             reconnect = False
         
-        progress['link_identifier']     = findlinker(startpage, nextpage).getdict()
-        progress['image_identifier']    = findimagefinder(startpage, nextpage).getdict()
+        pages = {} # Both pages are parsed and indexed once for both finders
+        progress['link_identifier']     = findlinker(startpage, nextpage,
+            pages=pages).getdict()
+        progress['image_identifier']    = findimagefinder(startpage, nextpage,
+            pages=pages).getdict()
         progress['reconnect']           = reconnect
+        # How repeated image content is handled (see Comic.addunique), how
+        # images are post-processed (see postprocess.py) and how politely
+        # the site is fetched (see ratelimit.py)
+        for option in ['duplicates', 'repeatstop', 'sharedindex', 'postprocess',
+            'ratelimit']:
+            if option in specs:
+                progress[option] = specs[option]
         
         print("Comic Progress:")
         print(progress)
@@ -113,6 +248,7 @@ class Comic:
         print("- Writing progress file")
         archive.write(progressfile, toml.dumps(progress))
         archive.close()
+        _catalog.update(title, archivepath, metadata, progress)
         print("Done!")
         
     def load(name):
@@ -122,10 +258,37 @@ class Comic:
         path = os.path.join(comicdir, name)
         if not assertpath(path):
             raise Exception("Could not load the comic '{0}'".format(name))
-        archive = defaultarchive.load(path)
+        journal = Journal(path)
+        unclean = journal.exists()
+        backend = archivetype(path)
+        if unclean and journal.recover(backend.restore, backend.isvalid):
+            print("- Restored the archive from its last checkpoint")
+        archive = backend.load(path)
         metadata = toml.loads(archive.read(metadatafile))
         progress = toml.loads(archive.read(progressfile))
-        return Comic(archive, progress, metadata)
+        index = ImageIndex.load(archive)
+        comic = Comic(archive, progress, metadata, journal=journal, index=index)
+        if unclean:
+            recovered, orphans = comic.recover(journal.replay())
+            print("- Recovered {0} pages from the journal ({1} unsaved images removed)".format(
+                recovered, orphans))
+        return comic
+    
+    def peek(name):
+        """Reads the progress of the comic with the given name without
+        loading it for writing. Returns None if it has to be recovered first."""
+        if not name.endswith(extension):
+            name += extension
+        path = os.path.join(comicdir, name)
+        if not assertpath(path):
+            raise Exception("Could not load the comic '{0}'".format(name))
+        if Journal(path).exists():
+            return None
+        archive = loadarchive(path)
+        try:
+            return toml.loads(archive.read(progressfile))
+        finally:
+            archive.close()
     
     def __str__(self):
         return "{0} at page {1}".format(self.metadata['title'], self.progress['lastindex']+1)
@@ -0,0 +1,329 @@
+# coding: utf-8
+# distributed.py
+"""
+Distributed scraping over a work queue in a shared directory. The coordinator
+crawls the link chain of a comic (as the first phase of a two-phase scrape),
+splits the page list into work units and puts them on the queue. Workers (in
+other processes, or on other machines that mount the directory) lease the
+units, download the images of their pages and put the images back. The
+coordinator merges the finished units into the archive in page order.
+
+    queue/
+        todo/<unit>.json            Units waiting for a worker
+        leased/<unit>.json.<worker> Leased units (the mtime is the heartbeat)
+        staging/                    Units being written
+        done/<unit>/                The images of the unit and its result.json
+        closed                      Workers stop once this is here
+
+Everything is moved into place with renames, so a unit is only ever taken by
+one worker and a result is only seen complete. Leases that aren't renewed
+expire, and the unit goes back to the queue for another worker.
+"""
+import os, sys, json, time, shutil, socket, hashlib, threading, subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from finder import Identifier
+from httpclient import shared as _getter
+from scheduler import Scheduler
+from journal import PageList
+from pipeline import Page, download, imagepage, listpages, store, newtally
+
+maxattempts = 3 # Times a unit is tried before it is given up on
+
+class WorkQueue:
+    """A queue of work units in a (shared) directory"""
+    def __init__(self, directory):
+        self.directory = directory
+        for part in ["todo", "leased", "staging", "done"]:
+            os.makedirs(self.path(part), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def put(self, name, unit):
+        temp = self.path("staging", name + ".json")
+        with open(temp, "w") as f:
+            json.dump(unit, f)
+        os.replace(temp, self.path("todo", name + ".json"))
+
+    def claim(self, worker):
+        """Leases the first unit waiting, returning the lease and the unit
+        (or None if there is no work)"""
+        for file in sorted(os.listdir(self.path("todo"))):
+            lease = self.path("leased", "{0}.{1}".format(file, worker))
+            try:
+                os.rename(self.path("todo", file), lease)
+            except OSError:
+                continue # Another worker got it first
+            os.utime(lease) # The lease starts now
+            with open(lease) as f:
+                return lease, json.load(f)
+        return None
+
+    def unitof(lease):
+        return os.path.basename(lease).split(".json.")[0]
+
+    def renew(self, lease):
+        """Renews the lease, returning False if it was lost"""
+        try:
+            os.utime(lease)
+            return True
+        except OSError:
+            return False
+
+    def release(self, lease, unit):
+        """Gives the leased unit back to the queue"""
+        if os.path.exists(lease):
+            self.put(WorkQueue.unitof(lease), unit)
+            self.drop(lease)
+
+    def staging(self, lease):
+        """Makes an empty folder for the results of the leased unit"""
+        path = self.path("staging", os.path.basename(lease))
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def finish(self, lease, staging, result):
+        """Moves the results of the unit to the done folder. Returns False if
+        the lease was lost (or the unit was done by another worker)."""
+        with open(os.path.join(staging, "result.json"), "w") as f:
+            json.dump(result, f)
+        finished = self.renew(lease)
+        if finished:
+            try:
+                os.rename(staging, self.path("done", WorkQueue.unitof(lease)))
+            except OSError:
+                finished = False
+        if not finished:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.drop(lease)
+        return finished
+
+    def drop(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def expire(self, seconds):
+        """Puts the units whose lease wasn't renewed in time back to the queue.
+        Returns the number of expired leases."""
+        expired = 0
+        for file in os.listdir(self.path("leased")):
+            lease = self.path("leased", file)
+            try:
+                if os.path.getmtime(lease) > time.time() - seconds:
+                    continue
+                os.rename(lease, self.path("todo", WorkQueue.unitof(lease) + ".json"))
+                expired += 1
+            except OSError:
+                pass # Finished or expired meanwhile
+        return expired
+
+    def result(self, name):
+        """Returns the folder with the results of the unit, if it is done"""
+        path = self.path("done", name)
+        return path if os.path.exists(path) else None
+
+    def wait(self, name, lease, stop, poll=0.2):
+        """Waits until the unit is done, expiring the leases of the workers
+        that went away. Returns its result folder (None if stopped)."""
+        while not stop.is_set():
+            path = self.result(name)
+            if path:
+                return path
+            self.expire(lease)
+            stop.wait(poll)
+        return None
+
+    def discard(self, name):
+        """Removes the unit from the queue, wherever it is"""
+        self.drop(self.path("todo", name + ".json"))
+        for file in os.listdir(self.path("leased")):
+            if WorkQueue.unitof(file) == name:
+                self.drop(self.path("leased", file))
+        shutil.rmtree(self.path("done", name), ignore_errors=True)
+
+    def clear(self, prefix):
+        """Removes the units whose name starts with the prefix"""
+        names = set()
+        for part in ["todo", "leased", "done"]:
+            names.update(WorkQueue.unitof(file) for file
+                in os.listdir(self.path(part)) if file.startswith(prefix))
+        for name in names:
+            self.discard(name)
+
+    def open(self):
+        self.drop(self.path("closed"))
+
+    def close(self):
+        open(self.path("closed"), "w").close()
+
+    def isclosed(self):
+        return os.path.exists(self.path("closed"))
+
+def unitprefix(title):
+    """Names the units of a comic (titles may have any characters)"""
+    return hashlib.sha1(title.encode("utf-8")).hexdigest()[:12]
+
+def finished(result):
+    """A future that is done already"""
+    future = Future()
+    future.set_result(result)
+    return future
+
+def scrapedistributed(comic, nextpage, link_identifier, image_identifier,
+    pages=-1, reconnect=False, workers=4, scheduler=None, stop=None,
+    tally=None, stream=False, repeatstop=0, queue=None, unitsize=8, lease=60):
+    """Scrapes the comic with the workers of the queue in the directory
+    'queue'. The link chain is crawled here, and its pages are put on the
+    queue 'unitsize' at a time. The finished units are merged in order, with
+    the stop conditions of scrape.
+    Returns the reason the scrape ended (if any)."""
+    stop        = stop or threading.Event()
+    scheduler   = scheduler or Scheduler(connections=workers+1, perhost=workers+1)
+    tally       = newtally() if tally is None else tally
+    workqueue   = WorkQueue(queue)
+    prefix      = unitprefix(comic.metadata['title'])
+    workqueue.clear(prefix) # Units of an earlier run
+    reason, entries, listed = listpages(comic, nextpage, link_identifier,
+        pages=pages, reconnect=reconnect, stop=stop, scheduler=scheduler,
+        stream=stream)
+    if stop.is_set():
+        return "Scrape stopped! Ending..."
+
+    names = []
+    for start in range(0, len(entries), unitsize):
+        name = "{0}-{1:06}".format(prefix, start // unitsize)
+        workqueue.put(name, {"title": comic.metadata['title'],
+            "pages": entries[start:start+unitsize], "reconnect": reconnect,
+            "image_identifier": comic.progress['image_identifier'],
+            "ratelimit": comic.progress.get('ratelimit'),
+            "stream": stream, "attempts": 0})
+        names.append(name)
+    print("Queued {0} units at '{1}', waiting for the workers...".format(
+        len(names), queue))
+    lastimages  = comic.progress['lastimages']
+    merged      = None
+    stored      = 0
+    repeats     = 0
+    try:
+        for name in names:
+            path = workqueue.wait(name, lease, stop)
+            if path is None:
+                merged = "Scrape stopped! Ending..."
+                break
+            with open(os.path.join(path, "result.json")) as f:
+                result = json.load(f)
+            if result.get('error'):
+                merged = "Work unit {0} failed: {1}! Ending...".format(name,
+                    result['error'])
+                break
+            for page in result['pages']:
+                imageurls = [image['url'] for image in page['images']]
+                if not imageurls:
+                    merged = "No images found at '{0}'! Ending...".format(page['page'])
+                    break
+                if imageurls == lastimages:
+                    merged = "Image duplicates found at '{0}'! Ending...".format(page['page'])
+                    break
+                lastimages = imageurls
+                futures = [finished((open(os.path.join(path, image['file']), "rb"),
+                    image['digest'])) for image in page['images']]
+                new = store(comic, Page(page['page'], imageurls, page['next']),
+                    futures, tally)
+                repeats = 0 if new else repeats + 1
+                stored += 1
+                if repeatstop and repeats >= repeatstop:
+                    merged = "Only repeated images for {0} pages at '{1}'! Ending...".format(
+                        repeats, page['page'])
+                    break
+            workqueue.discard(name)
+            if merged:
+                break
+    finally:
+        for name in names: # Whatever wasn't merged
+            workqueue.discard(name)
+    if stored == listed or merged and not stop.is_set():
+        PageList.remove(comic.archive.path) # Done with (or past) the list
+    return merged or reason
+
+def workunit(unit, staging, workers, scheduler):
+    """Downloads the images of the pages of the unit into the staging folder.
+    Returns the result of the unit."""
+    identifier  = Identifier.load(unit['image_identifier'])
+    reconnect   = unit.get('reconnect', False)
+    if unit.get('ratelimit'):
+        _getter.configure(unit['pages'][0]['page'], unit['ratelimit'])
+    result      = {"pages": []}
+    downloads   = [] # (image, future)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        found = [pool.submit(scheduler.run, entry['page'], imagepage,
+            identifier, reconnect=reconnect, stream=unit.get('stream', False))
+            for entry in unit['pages']]
+        for entry, future in zip(unit['pages'], found):
+            images = []
+            for url in future.result():
+                image = {"url": url, "file": "{0:04}".format(len(downloads))}
+                downloads.append((image, pool.submit(scheduler.run, url,
+                    download, reconnect=reconnect)))
+                images.append(image)
+            result['pages'].append({"page": entry['page'],
+                "next": entry['next'], "images": images})
+        for image, future in downloads:
+            spool, image['digest'] = future.result()
+            with spool, open(os.path.join(staging, image['file']), "wb") as f:
+                shutil.copyfileobj(spool, f)
+    return result
+
+def work(directory, name=None, workers=4, lease=60, connections=8, perhost=2,
+    poll=0.5):
+    """Works on the units of the queue in the directory until the coordinator
+    closes it. Returns the number of units done."""
+    name        = name or "{0}-{1}".format(socket.gethostname(), os.getpid())
+    workqueue   = WorkQueue(directory)
+    scheduler   = Scheduler(connections=connections, perhost=perhost)
+    done        = 0
+    print("Worker '{0}' working on '{1}'...".format(name, directory))
+    while True:
+        claimed = workqueue.claim(name)
+        if claimed is None:
+            if workqueue.isclosed():
+                break
+            time.sleep(poll)
+            continue
+        leased, unit = claimed
+        print("- {0}: {1} pages".format(WorkQueue.unitof(leased), len(unit['pages'])))
+        beating = threading.Event()
+        def heartbeat(leased=leased):
+            while not beating.wait(lease / 3):
+                workqueue.renew(leased)
+        threading.Thread(target=heartbeat, daemon=True).start()
+        staging = workqueue.staging(leased)
+        try:
+            result = workunit(unit, staging, workers, scheduler)
+        except KeyboardInterrupt: # Another worker may take it right away
+            shutil.rmtree(staging, ignore_errors=True)
+            workqueue.release(leased, unit)
+            raise
+        except Exception as e:
+            unit['attempts'] = unit.get('attempts', 0) + 1
+            if unit['attempts'] < maxattempts:
+                print("  Failed ({0}), giving it back".format(e))
+                shutil.rmtree(staging, ignore_errors=True)
+                workqueue.release(leased, unit)
+                continue
+            result = {"error": str(e)}
+        finally:
+            beating.set()
+        if workqueue.finish(leased, staging, result):
+            done += 1
+    print("Queue closed, {0} units done.".format(done))
+    return done
+
+def startworkers(directory, count, workers=4, lease=60, connections=8, perhost=2):
+    """Starts 'count' workers on the queue as processes on this machine"""
+    return [subprocess.Popen([sys.executable, os.path.dirname(os.path.abspath(__file__)),
+        "work", directory, "--name", "local{0}".format(num), "-w", str(workers),
+        "--lease", str(lease), "-c", str(connections), "--per-host", str(perhost)])
+        for num in range(count)]
@@ -0,0 +1,242 @@
+# coding: utf-8
+# extractor.py
+"""
+Streaming extraction of the images and the next link of a comic page.
+The page is tokenized as it arrives and the stored identifiers are checked as
+the tags stream past, without building a tree. Reading stops as soon as both
+results are settled, so neither memory nor the bytes read grow with the
+size of the rest of the page.
+"""
+import codecs
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+from httpclient import shared as _getter
+from stats import stats
+
+# Attributes that BeautifulSoup splits into lists ("*" for every tag)
+multivalued = {
+    "*": {"class", "accesskey", "dropzone"},
+    "a": {"rel", "rev"},
+    "link": {"rel", "rev"},
+    "td": {"headers"},
+    "th": {"headers"},
+    "form": {"accept-charset"},
+    "object": {"archive"},
+    "area": {"rel"},
+    "icon": {"sizes"},
+    "iframe": {"sandbox"},
+    "output": {"for"},
+}
+# Tags that never have an end tag
+voidtags = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+    "keygen", "link", "meta", "param", "source", "track", "wbr"}
+
+def startcheck(identifier):
+    """Whether the identifier can be decided from the start tag alone"""
+    if identifier.func == "attribute":
+        return True
+    if identifier.func == "parent":
+        return all(startcheck(pid) for pid in identifier.kwargs['pids'])
+    return False
+
+def streamable(identifier):
+    """Whether the identifier can be checked while streaming"""
+    if identifier.func == "member":
+        return identifier.kwargs['mem'] == "text"
+    return identifier.func == "sub-image" or startcheck(identifier)
+
+def unique(identifier):
+    """Whether the identifier can match one tag at most (ids are unique)"""
+    if identifier.func == "attribute":
+        return identifier.kwargs['attr'] == "id"
+    if identifier.func == "parent":
+        return all(unique(pid) for pid in identifier.kwargs['pids'])
+    return False
+
+class Element:
+    """An open tag while streaming"""
+    def __init__(self, name, attrs):
+        self.name   = name
+        self.attrs  = attrs
+        self.text   = None # Collected for text checks
+        self.subimg = False # Contains the sub-image looked for
+        self.scopes = [] # The parent identifiers it matches
+
+class Match:
+    """The matches of one identifier in the streamed page"""
+    def __init__(self, identifier, first=False):
+        self.identifier = identifier
+        self.first      = first # Only the first match is wanted
+        self.tags       = [] # The attributes of the matching tags
+        self.settled    = False
+        self.pids       = identifier.kwargs.get('pids', [])
+
+    def found(self, attrs):
+        if not self.settled:
+            self.tags.append(attrs)
+            if self.first or (self.identifier.func == "attribute" and
+                unique(self.identifier)):
+                self.settled = True
+
+class PageExtractor(HTMLParser):
+    """Checks the link and image identifiers on a page as it is fed.
+    Either may be None, when only the other is wanted."""
+    def __init__(self, link_identifier, image_identifier):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.link   = Match(link_identifier, first=True) if link_identifier else None
+        self.images = Match(image_identifier) if image_identifier else None
+        self.matches = [match for match in (self.link, self.images) if match]
+        self.stack  = []
+        self.open   = {} # id(parent identifier) -> open tags matching it
+        self.textnames = set(match.identifier.name for match in
+            self.matches if match.identifier.func == "member")
+
+    def settled(self):
+        return all(match.settled for match in self.matches)
+
+    def checkattrs(self, identifier, name, attrs):
+        """Checks a start-decidable identifier against a tag"""
+        if identifier.name != name:
+            return False
+        if identifier.func == "attribute":
+            return attrs.get(identifier.kwargs['attr']) == identifier.kwargs['val']
+        # Parent: some open tag (above this one) matches one of the pids
+        return any(self.inscope(pid) for pid in identifier.kwargs['pids'])
+
+    def inscope(self, pid):
+        """Whether an open tag matches the (start-decidable) identifier"""
+        return self.open.get(id(pid), 0) > 0
+
+    def enter(self, element):
+        """Opens the tag, noting the parent identifiers it matches"""
+        for match in self.matches:
+            for pid in match.pids:
+                if self.checkattrs(pid, element.name, element.attrs):
+                    element.scopes.append(pid)
+                    self.open[id(pid)] = self.open.get(id(pid), 0) + 1
+        if element.name in self.textnames:
+            element.text = []
+        self.stack.append(element)
+
+    def leave(self):
+        """Closes the innermost open tag"""
+        element = self.stack.pop()
+        for pid in element.scopes:
+            self.open[id(pid)] -= 1
+        return element
+
+    def handle_starttag(self, name, attrlist):
+        attrs = {}
+        listed = multivalued["*"] | multivalued.get(name, set())
+        for key, val in attrlist:
+            val = val or ""
+            attrs[key] = val.split() if key in listed else val
+        for match in self.matches:
+            identifier = match.identifier
+            if startcheck(identifier):
+                if self.checkattrs(identifier, name, attrs):
+                    match.found(attrs)
+        if name == "img":
+            for match in self.matches:
+                if match.identifier.func == "sub-image":
+                    if attrs.get('src') == match.identifier.kwargs['val']:
+                        for element in self.stack:
+                            element.subimg = True
+        if name in voidtags:
+            self.endmatches(Element(name, attrs))
+        else:
+            self.enter(Element(name, attrs))
+
+    def handle_startendtag(self, name, attrlist):
+        self.handle_starttag(name, attrlist)
+        if not name in voidtags:
+            self.handle_endtag(name)
+
+    def handle_endtag(self, name):
+        # Close everything that was left open inside the tag
+        if not any(element.name == name for element in self.stack):
+            return
+        while self.stack:
+            element = self.leave()
+            self.endmatches(element)
+            if element.text is not None:
+                for parent in reversed(self.stack):
+                    if parent.text is not None:
+                        parent.text.extend(element.text)
+                        break
+            if element.name == name:
+                break
+        self.settlescopes()
+
+    def handle_data(self, data):
+        for element in reversed(self.stack):
+            if element.text is not None:
+                element.text.append(data)
+                break # The rest get it when this one closes (see endtag)
+
+    def endmatches(self, element):
+        """Checks the end-decided identifiers against a closing tag"""
+        for match in self.matches:
+            identifier = match.identifier
+            if identifier.name != element.name:
+                continue
+            if identifier.func == "sub-image" and element.subimg:
+                match.found(element.attrs)
+            elif identifier.func == "member" and element.text is not None:
+                if "".join(element.text) == identifier.kwargs['val']:
+                    match.found(element.attrs)
+
+    def settlescopes(self):
+        """The images of a unique parent scope are settled when it closes"""
+        images = self.images
+        if not images or images.settled or not images.tags:
+            return
+        if images.identifier.func == "parent" and unique(images.identifier):
+            if not any(self.inscope(pid) for pid in images.pids):
+                images.settled = True
+
+def decoderfor(headers):
+    """Returns an incremental decoder for the charset of the response"""
+    charset = "utf-8"
+    contenttype = headers.get("Content-Type", "") if headers else ""
+    for param in contenttype.split(";")[1:]:
+        key, _, val = param.strip().partition("=")
+        if key.lower() == "charset" and val:
+            charset = val.strip('"')
+    try:
+        return codecs.getincrementaldecoder(charset)(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+def extractpage(url, link_identifier, image_identifier, reconnect=False):
+    """Streams the page at the url and returns the urls of the images on it
+    and the link to the next page, like findimages and findlink would.
+    Either identifier may be None, leaving its result empty, so that reading
+    stops as soon as the other one is settled."""
+    extractor = PageExtractor(link_identifier, image_identifier)
+    with stats.timer("extract") as event, \
+        _getter.stream(url, reconnect=reconnect) as stream:
+        decoder = decoderfor(stream.headers)
+        for chunk in stream:
+            event['bytes'] += len(chunk)
+            extractor.feed(decoder.decode(chunk))
+            if extractor.settled():
+                break
+        else:
+            extractor.feed(decoder.decode(b"", final=True))
+            extractor.close()
+
+    imageurls, nextpage = [], None
+    if extractor.images:
+        if not extractor.images.tags:
+            print("Could not find any images using {0}!".format(image_identifier))
+        for attrs in extractor.images.tags:
+            imageurl = urljoin(url, attrs.get('src', ""))
+            if not imageurl in imageurls:
+                imageurls.append(imageurl)
+    if extractor.link:
+        links = extractor.link.tags
+        if not links:
+            print("Could not find any link using {0}!".format(link_identifier))
+        nextpage = urljoin(url, links[0]['href']) if links else None
+    return imageurls, nextpage
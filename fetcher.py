@@ -1,34 +1,42 @@
 # coding: utf-8
 # Created by Jabok @ August 14th 2014
 # fetcher.py
-import os
+import os, time, hashlib, threading
 import toml
+from concurrent.futures import ThreadPoolExecutor
 from validators import validate_specs
 from comic import Comic
 from linkers import findlink
 from images import findimages
-from getter import Getter
+from pipeline import scrape, scrapetwophase, newtally, reachedend
+from scheduler import Scheduler
+from httpclient import shared as _getter
 from finder import Identifier
 from bs4 import BeautifulSoup
-from utils import lastcomicfile
+from utils import lastcomicfile, metadir, ensure
+from stats import stats
 """
 Initiates the fetching of a comic, attempting to generate the schema if necessary.
 """
-_getter = Getter(timeout=5)
 
 def findcontent(url, link_identifier, progress_identifier):
     """Finds image url and the link to the next page at the given web address."""
     # Url should be a full url path for correct url joining!
     image, nextpage = None, None
-    soup = BeautifulSoup(_getter.get(url))
+    soup = BeautifulSoup(_getter.get_read(url))
     nextpage = findlink(soup, url, link_identifier)
     if not (image and newpage): raise Exception("Nothing Found!")
     return image, nextpage        
 
 def fetchcomic(request, overwrite=False, startpage=None, 
-    pages=-1):
-    """Fetches the comic described in the given request"""
-    from utils import getcomiclist, printiter
+    pages=-1, workers=4, scheduler=None, stop=None, stream=False,
+    twophase=False, scraper=None):
+    """Fetches the comic described in the given request.
+    With 'twophase', the link chain is crawled before any images are
+    downloaded (see pipeline.scrapetwophase). A 'scraper' with the arguments
+    of pipeline.scrape may be given to scrape with instead.
+    Returns a summary of what was scraped (or None if nothing could be)."""
+    from utils import comicdir, extension, printiter
     # If it is not a comic name that is known
     if os.path.exists(request):
         with open(request) as f:
@@ -39,7 +47,8 @@ def fetchcomic(request, overwrite=False, startpage=None,
         title = request.strip()
         directory = os.getcwd()
     
-    if (not title in getcomiclist()) or overwrite:
+    stored = os.path.exists(os.path.join(comicdir, title+extension))
+    if (not stored) or overwrite:
         if not os.path.exists(request):
             return print("Could not find any specfile or comic '{0}'!".format(request))
         
@@ -54,21 +63,29 @@ def fetchcomic(request, overwrite=False, startpage=None,
         Comic.create(specs, directory=directory)
         
     print("Preparing scrape...")
+    tally = newtally()
+    tally['title'] = title
+    started = time.time()
     with Comic.load(title) as comic:
         print("- Comic:", comic)
         link_identifier     = Identifier.load(comic.progress['link_identifier'])
         image_identifier    = Identifier.load(comic.progress['image_identifier'])
         
-        lastimages  = comic.progress['lastimages'] 
-        remaining   = pages
         reconnect   = comic.progress.get('reconnect', False)
         lastpage    = comic.progress['lastpage']
+        if comic.progress.get('ratelimit'):
+            _getter.configure(lastpage or startpage or specs['startpage'],
+                comic.progress['ratelimit'])
+        storednext = comic.progress.get('nextpage')
         if (not lastpage) or startpage: # No previous, or start supplied
             nextpage = startpage or specs['startpage']
             print("- Starting new scrape from", nextpage)
+        elif storednext and storednext != lastpage and not comic.progress.get('finished'):
+            print("- Resuming scrape from", storednext)
+            nextpage    = storednext
         else:
             print("- Resuming scrape from", lastpage)
-            data        = _getter.get_read(lastpage)
+            data        = _getter.get_read(lastpage, maxage=0) # Revalidate
             soup        = BeautifulSoup(data)
             nextpage    = findlink(soup, lastpage, link_identifier)
         
@@ -78,29 +95,19 @@ def fetchcomic(request, overwrite=False, startpage=None,
                 pagestamp = "({0} pages)".format(pages) if (pages != -1) else ""
                 print("Starting scrape..."+pagestamp)
             
-            while nextpage and remaining: # There is a way!
-                print("- {0:03}: {1}".format(comic.progress['lastindex']+1, nextpage))
-                data        = _getter.get_read(nextpage, reconnect=reconnect)
-                soup        = BeautifulSoup(data)
-                imageurls   = findimages(soup, nextpage, image_identifier)
-                if not imageurls:
-                    print("No images found at '{0}'! Ending...".format(nextpage))
-                    break
-                if imageurls == lastimages:
-                    print("Image duplicates found at '{0}'! Ending...".format(nextpage))
-                    break
-                for url in imageurls:
-                    comic.add(url, reconnect=reconnect)
-                comic.setscraped(nextpage, imageurls)
-                lastimages  = imageurls # Don't repeat content!
-                lastpage    = nextpage
-                nextpage    = findlink(soup, nextpage, link_identifier)
-                if nextpage == lastpage:
-                    print("No further links found at '{0}'! Ending...".format(lastpage))
-                    break
-                remaining  -= 1
+            run = scraper or (scrapetwophase if twophase else scrape)
+            reason = run(comic, nextpage, link_identifier, image_identifier,
+                pages=pages, reconnect=reconnect, workers=workers,
+                scheduler=scheduler, stop=stop, tally=tally, stream=stream,
+                repeatstop=comic.progress.get('repeatstop', 0))
+            if reason:
+                print(reason)
+            if reachedend(reason) and not (stop and stop.is_set()):
+                comic.progress['finished'] = True # Updates needn't resume it
             lastpage = comic.progress['lastpage']
             print("No more comics found after '{0}', ending...".format(lastpage))
+            if comic.progress.get('postprocess') and not (stop and stop.is_set()):
+                postprocess(comic)
         except KeyboardInterrupt:
             print("\nInterrupted!")
             print("Progress:")
@@ -113,6 +120,137 @@ def fetchcomic(request, overwrite=False, startpage=None,
             raise
     
     meta = {"lastcomic": title}
+    ensure(metadir)
     with open(lastcomicfile, "w") as f:
         toml.dump(meta, f)
-    print("Scrape ended.")
\ No newline at end of file
+    print("Scrape ended.")
+    tally['seconds'] = time.time() - started
+    return tally
+
+def postprocess(comic):
+    """Post-processes the new images of the comic (see postprocess.py)"""
+    from postprocess import process
+    print("Post-processing images...")
+    with stats.timer("postprocess"):
+        count, written = process(comic)
+    print("- Processed {0} images ({1} renditions)".format(count, written))
+
+def fetchcomics(requests, pages=-1, workers=4, connections=8, perhost=2,
+    comics=4, stream=False, twophase=False, scraper=None):
+    """Fetches all of the requested comics in this process, 'comics' at a time.
+    Every fetch shares the same scheduler, so the connection caps hold for
+    the whole batch. Prints a throughput summary for each comic at the end."""
+    scheduler   = Scheduler(connections=connections, perhost=perhost)
+    stop        = threading.Event()
+    summaries   = {}
+    started     = time.time()
+    def fetchone(request):
+        try:
+            return fetchcomic(request, pages=pages, workers=workers,
+                scheduler=scheduler, stop=stop, stream=stream, twophase=twophase,
+                scraper=scraper)
+        except Exception as e:
+            print("Scraping '{0}' failed: {1}".format(request, e))
+            return {'title': request, 'error': str(e)}
+    
+    with ThreadPoolExecutor(max_workers=comics) as pool:
+        futures = [(request, pool.submit(fetchone, request)) for request in requests]
+        try:
+            for request, future in futures:
+                summaries[request] = future.result()
+        except KeyboardInterrupt:
+            print("\nInterrupted! Finishing the pages in flight...")
+            stop.set()
+            for request, future in futures:
+                future.cancel()
+            for request, future in futures:
+                if not future.cancelled():
+                    summaries[request] = future.result()
+    
+    printsummary([summaries[request] for request, future in futures 
+        if summaries.get(request)], time.time() - started)
+    return summaries
+
+def checkcomic(title, scheduler):
+    """Checks cheaply whether the comic has new pages, without loading it for
+    writing. The last page is revalidated (a conditional GET, when it is in
+    the cache) and only parsed if its content changed since it was stored.
+    Returns a (needs scraping, reason) tuple."""
+    progress = Comic.peek(title)
+    if progress is None:
+        return True, "interrupted, needs recovery"
+    lastpage = progress['lastpage']
+    if not lastpage:
+        return True, "never scraped"
+    storednext = progress.get('nextpage')
+    if storednext and storednext != lastpage and not progress.get('finished'):
+        return True, "unfinished, resumes at '{0}'".format(storednext)
+    if progress.get('ratelimit'):
+        _getter.configure(lastpage, progress['ratelimit'])
+    
+    data = scheduler.run(lastpage, _getter.get_read, maxage=0,
+        reconnect=progress.get('reconnect', False))
+    # Compared to the page as it was when it was stored (the cache may have
+    # been refreshed since, by a dry run or a failed scrape)
+    stored = progress.get('lastdigest')
+    if stored and hashlib.sha1(data).hexdigest() == stored:
+        return False, "unchanged"
+    
+    link_identifier = Identifier.load(progress['link_identifier'])
+    link = findlink(BeautifulSoup(data), lastpage, link_identifier)
+    if link and link != lastpage and link != storednext:
+        return True, "new page '{0}'".format(link)
+    return False, "changed, but no new link"
+
+def updatecomics(titles, checks=16, pages=-1, workers=4, connections=8,
+    perhost=2, comics=4, stream=False, twophase=False, dryrun=False):
+    """Checks all of the comics for new pages, 'checks' at a time, and then
+    scrapes the ones that have them. Returns the titles that had new pages."""
+    scheduler   = Scheduler(connections=max(connections, checks), perhost=perhost)
+    started     = time.time()
+    def checkone(title):
+        try:
+            return checkcomic(title, scheduler)
+        except Exception as e:
+            return False, "check failed: {0}".format(e)
+    
+    print("Checking {0} comics...".format(len(titles)))
+    with ThreadPoolExecutor(max_workers=checks) as pool:
+        results = list(pool.map(checkone, titles))
+    changed = []
+    for title, (scrape, reason) in zip(titles, results):
+        print("- {0}: {1}".format(title, reason))
+        if scrape:
+            changed.append(title)
+    print("Checked in {0:.1f}s: {1} of {2} comics have new pages".format(
+        time.time() - started, len(changed), len(titles)))
+    if changed and not dryrun:
+        fetchcomics(changed, pages=pages, workers=workers,
+            connections=connections, perhost=perhost, comics=comics,
+            stream=stream, twophase=twophase)
+    return changed
+
+def printsummary(tallies, seconds):
+    """Prints the throughput of each scraped comic, and the total"""
+    print("Summary:")
+    total = newtally()
+    total['seconds'] = seconds
+    for tally in tallies:
+        if 'error' in tally:
+            print("- {0}: FAILED ({1})".format(tally['title'], tally['error']))
+            continue
+        for key in ['pages', 'images', 'bytes', 'duplicates']:
+            total[key] += tally.get(key, 0)
+        print("- {0}: {1}".format(tally['title'], throughput(tally)))
+    print("Total: {0}".format(throughput(total)))
+    print("Connections:", _getter.describe())
+
+def throughput(tally):
+    """Formats the counts and rates of a scrape tally"""
+    seconds = max(tally['seconds'], 0.001)
+    text = "{0} pages, {1} images, {2:.1f} MB in {3:.1f}s ({4:.2f} pages/s, {5:.1f} KB/s)".format(
+        tally['pages'], tally['images'], tally['bytes'] / 2**20, seconds,
+        tally['pages'] / seconds, tally['bytes'] / 1024 / seconds)
+    if tally.get('duplicates'):
+        text += ", {0} duplicate images skipped".format(tally['duplicates'])
+    return text
\ No newline at end of file
@@ -4,11 +4,12 @@
 """
 Gneral finding methods and testing
 """
+import json
+from urllib.parse import urljoin
 from bs4 import BeautifulSoup
-from getter import Getter
+from httpclient import shared as _getter
 from utils import printiter
 import toml
-_getter = Getter(timeout=5)
 
 def isimage(tag):
     """Soup image identifier"""
@@ -64,15 +65,43 @@ checkfuncs = {
     "parent": parcheck
 }
 
+# Selector compilation
+def cssstring(val):
+    """Quotes the value as a CSS string (multi-valued attributes are joined
+    with spaces, the way the selector engine joins them when matching)"""
+    if isinstance(val, list):
+        val = " ".join(val)
+    return '"{0}"'.format(str(val).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\a "))
+
+def compileselector(name, func, kwargs):
+    """Compiles an identifier to an equivalent CSS selector.
+    Returns None for checks that can't be expressed as one."""
+    if func == "attribute":
+        return "{0}[{1}={2}]".format(name, kwargs['attr'], cssstring(kwargs['val']))
+    if func == "sub-image":
+        return "{0}:has(img[src={1}])".format(name, cssstring(kwargs['val']))
+    if func == "parent":
+        parents = [pid.selector for pid in kwargs['pids']]
+        if not all(parents):
+            return None
+        return ":is({0}) {1}".format(", ".join(parents), name)
+    return None # Text comparisons and the like
+
 class Identifier:
-    """A simpler way of identifying tags"""
-    def __init__(self, tagname, func, **kwargs):
+    """A simpler way of identifying tags.
+    Identifiers are compiled to CSS selectors where possible, so that they
+    are matched by the selector engine instead of a Python check per tag."""
+    def __init__(self, tagname, func, selector=None, **kwargs):
         if not func in checkfuncs:
             raise Exception("Invalid function '{0}'!".format(func))
         self.name   = tagname
         self.func   = func
         self.kwargs = kwargs
         self.check  = checkfuncs[func](**kwargs)
+        if selector is None: # Not cached ("" means that it can't be compiled)
+            selector = compileselector(tagname, func, kwargs) or ""
+        self.selector = selector
         
     def getdict(self):
         """Serialize to a simple-type dictionary"""
@@ -84,6 +113,7 @@ class Identifier:
             else:
                 kwargs[key] = val
         d['kwargs'] = kwargs
+        d['selector'] = self.selector
         return d
     
     def load(data):
@@ -94,21 +124,126 @@ class Identifier:
                 kwargs[key] = [Identifier.load(pid) for pid in val]
             else:
                 kwargs[key] = val
-        return Identifier(data['name'], data['func'], **kwargs)
+        return Identifier(data['name'], data['func'],
+            selector=data.get('selector'), **kwargs)
     
     def validate(self, tag):
         return self.check(tag) and (tag.name == self.name)
     
     def identify(self, soup):
         """Identifies tags of the type in the soup"""
+        if self.func == "parent":
+            return self.identifyscoped(soup)
+        if self.selector:
+            return soup.select(self.selector)
         return list(soup.find_all(self.validate))
     
+    def identifyscoped(self, soup):
+        """Identifies tags with a matching parent top-down: the parents are
+        found once, and only their subtrees are searched for the tag, instead
+        of checking the parents of every tag in the soup."""
+        pids = self.kwargs['pids']
+        scopes, scopeids = [], set()
+        for pid in pids:
+            for scope in pid.identify(soup):
+                if not id(scope) in scopeids:
+                    scopes.append(scope)
+                    scopeids.add(id(scope))
+        if len(pids) > 1: # Merge into document order
+            order = {id(tag): num for num, tag in enumerate(soup.descendants)}
+            scopes.sort(key=lambda tag: order[id(tag)])
+        # Scopes inside other scopes are searched with them
+        found = []
+        for scope in scopes:
+            if any(id(parent) in scopeids for parent in scope.parents):
+                continue
+            found += scope.find_all(self.name)
+        return found
+    
     def __str__(self):
         return "[{0}:{1}(**{2})]".format(self.name, self.func, self.kwargs)
     
     def __repr__(self): 
         return str(self)
 
+class PageIndex:
+    """A parsed page, indexed in one pass over its tags so that many
+    identifiers can be evaluated against it without searching the whole soup
+    for each (for finding the identifiers of a comic). The absolute urls of
+    the links are computed once, and the found tags of every identifier are
+    kept, so they are shared between link and image finding."""
+    indexed = {"class", "id", "rel", "src"} # Attributes looked up by value
+    
+    def __init__(self, url, soup):
+        self.url        = url
+        self.soup       = soup
+        self.order      = {} # id(tag) -> position in the document
+        self.names      = {} # name -> [tags]
+        self.values     = {} # (name, attr, value) -> [tags]
+        self.hrefs      = {} # absolute url -> [tags linking to it]
+        self.sources    = {} # image src -> [img tags]
+        self.results    = {} # identifier key -> [tags]
+        for num, tag in enumerate(soup.find_all(True)):
+            self.order[id(tag)] = num
+            self.names.setdefault(tag.name, []).append(tag)
+            for attr in PageIndex.indexed & set(tag.attrs):
+                key = (tag.name, attr, PageIndex.hashable(tag[attr]))
+                self.values.setdefault(key, []).append(tag)
+            if tag.has_attr('href'):
+                self.hrefs.setdefault(urljoin(url, tag['href']), []).append(tag)
+            if tag.name == "img" and tag.has_attr('src'):
+                self.sources.setdefault(tag['src'], []).append(tag)
+    
+    def load(url, pages=None):
+        """Fetches and indexes the page at the url, or returns it from the
+        'pages' dict if it was indexed already"""
+        if pages is not None and url in pages:
+            return pages[url]
+        page = PageIndex(url, BeautifulSoup(_getter.get_read(url)))
+        if pages is not None:
+            pages[url] = page
+        return page
+    
+    def hashable(val):
+        return tuple(val) if isinstance(val, list) else val
+    
+    def tags(self, name):
+        return self.names.get(name, [])
+    
+    def linksto(self, url):
+        """The tags that link to the (absolute) url"""
+        return self.hrefs.get(url, [])
+    
+    def inorder(self, tags):
+        """The tags in document order, once each"""
+        unique = {id(tag): tag for tag in tags}
+        return sorted(unique.values(), key=lambda tag: self.order[id(tag)])
+    
+    def identify(self, identifier):
+        """Returns the tags the identifier finds, like identifier.identify
+        would in the soup"""
+        key = json.dumps(identifier.getdict(), sort_keys=True)
+        if not key in self.results:
+            self.results[key] = self.evaluate(identifier)
+        return self.results[key]
+    
+    def evaluate(self, identifier):
+        name, func, kwargs = identifier.name, identifier.func, identifier.kwargs
+        if func == "attribute" and kwargs['attr'] in PageIndex.indexed:
+            return list(self.values.get((name, kwargs['attr'],
+                PageIndex.hashable(kwargs['val'])), []))
+        if func == "sub-image":
+            parents = [parent for image in self.sources.get(kwargs['val'], [])
+                for parent in image.parents if parent.name == name]
+            return self.inorder(parents)
+        if func == "parent":
+            scopes = set(id(scope) for pid in kwargs['pids']
+                for scope in self.identify(pid))
+            return [tag for tag in self.tags(name)
+                if any(id(parent) in scopes for parent in tag.parents)]
+        # Anything else is checked on the tags with the name only
+        return [tag for tag in self.tags(name) if identifier.check(tag)]
+
 def findcommonidentifiers(tag, soup):
     """Finds the common (between links and images) identifiers of the tag"""
     # 1) Check whether the class, id or rel makes sense to use
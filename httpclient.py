@@ -0,0 +1,406 @@
+# coding: utf-8
+# httpclient.py
+"""
+The process-wide HTTP layer. Connections are kept alive and pooled per host,
+host names are resolved once (for a while), and pages are fetched with
+compressed transfer encoding. Responses are kept in the on-disk cache and
+revalidated with conditional GETs. Every request waits for a slot of the
+adaptive limit of its host (see ratelimit.py), and requests that are answered
+with 429 or 503 are sent again once the host allows it.
+Everything that fetches goes through 'shared'.
+"""
+import socket, threading, time, zlib
+import http.client
+from urllib.parse import urlsplit, urljoin
+from cache import ResponseCache, kindof
+from ratelimit import RateLimiter, throttled
+from utils import cachedir, cachesize, pagecachesize
+from stats import stats
+
+class FetchError(Exception):
+    """A fetch that failed with an HTTP error status"""
+    def __init__(self, url, status, reason=""):
+        Exception.__init__(self, "HTTP {0} {1} for '{2}'".format(status, reason, url))
+        self.url    = url
+        self.status = status
+
+class Response:
+    """The (decoded) result of a fetch"""
+    def __init__(self, url, status, headers, body):
+        self.url        = url # After redirects
+        self.status     = status
+        self.headers    = headers
+        self.body       = body
+
+class Stream:
+    """The body of a fetch, read in (decoded) chunks. Reading it to the end
+    returns the connection to the pool and commits the body to the cache,
+    while closing it early drops both."""
+    def __init__(self, client, url, status=200, headers=None, body=None,
+        key=None, conn=None, response=None, writer=None, reconnect=False,
+        ticket=None):
+        self.client     = client
+        self.url        = url
+        self.status     = status
+        self.headers    = headers if headers is not None else {}
+        self.body       = body # When it is already known (cached)
+        self.key        = key
+        self.conn       = conn
+        self.response   = response
+        self.writer     = writer
+        self.reconnect  = reconnect
+        self.ticket     = ticket # The slot of the host
+        self.finished   = body is not None
+        self.closed     = False
+        self.received   = 0 # Bytes of the body read off the wire
+
+    def __iter__(self):
+        return self.chunks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *errargs):
+        self.close()
+
+    def chunks(self, size=16384):
+        """Yields the body in chunks of (about) the given size"""
+        if self.body is not None:
+            for start in range(0, len(self.body), size):
+                yield self.body[start:start+size]
+            return
+        encoding = (self.response.getheader("Content-Encoding") or "").lower()
+        decoder = None
+        if encoding in ("gzip", "x-gzip", "deflate"):
+            decoder = zlib.decompressobj(zlib.MAX_WBITS | 32) # gzip or zlib
+        first = True
+        while True:
+            data = self.response.read(size)
+            if not data:
+                break
+            self.received += len(data)
+            self.client.count("bytes", len(data))
+            if decoder:
+                try:
+                    data = decoder.decompress(data)
+                except zlib.error:
+                    if not first:
+                        raise
+                    # Raw deflate, without the zlib header
+                    decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                    data = decoder.decompress(data)
+            first = False
+            if data:
+                yield self._emit(data)
+        if decoder:
+            data = decoder.flush()
+            if data:
+                yield self._emit(data)
+        self.finished = True
+
+    def _emit(self, data):
+        self.client.count("decoded_bytes", len(data))
+        if self.writer:
+            self.writer.write(data)
+        return data
+
+    def read(self):
+        """Reads the whole (rest of the) body"""
+        return b"".join(self.chunks())
+
+    def close(self):
+        """Releases the connection, keeping it if the body was read"""
+        if self.closed or self.response is None:
+            return
+        self.closed = True
+        if self.ticket:
+            self.ticket.release()
+        if self.finished:
+            if self.writer:
+                self.writer.commit()
+            self.client.release(self.key, self.conn, self.response,
+                reconnect=self.reconnect)
+        else:
+            if self.writer:
+                self.writer.abort()
+            remaining = self.response.length # None when unknown (chunked)
+            if remaining is not None and remaining <= drainlimit:
+                try: # Cheaper to read the rest than to reconnect
+                    self.response.read()
+                    return self.client.release(self.key, self.conn,
+                        self.response, reconnect=self.reconnect)
+                except Exception:
+                    pass
+            self.conn.close()
+
+# Unread bodies smaller than this are read to keep the connection alive
+drainlimit = 64 * 1024
+
+_redirects = (301, 302, 303, 307, 308)
+_conditions = ("if-none-match", "if-modified-since")
+
+# Errors that mean that a kept-alive connection was closed by the server
+_stale = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+    ConnectionResetError, BrokenPipeError)
+
+class Client:
+    """A thread-safe HTTP client with keep-alive connection pools per host"""
+    def __init__(self, timeout=5, maxidle=8, dnsttl=300, redirects=5,
+        cache=None, maxage=60, retries=3):
+        self.timeout    = timeout
+        self.cache      = cache
+        self.maxage     = maxage # How long cached responses are used unchecked
+        self.maxidle    = maxidle # Idle connections kept per host
+        self.dnsttl     = dnsttl
+        self.redirects  = redirects
+        self.retries    = retries # Of requests that were throttled
+        self.limiter    = RateLimiter(robots=self.robotstxt)
+        self.headers    = {
+            "User-Agent": "Mozilla/5.0 (compatible; comic_scraper)",
+            "Accept-Encoding": "gzip, deflate",
+        }
+        self.idle       = {} # (scheme, host, port) -> [connection]
+        self.addresses  = {} # (host, port) -> (address, resolved at)
+        self.lock       = threading.Lock()
+        self.counters   = {
+            "requests": 0,
+            "connections": 0, # Opened
+            "reused": 0,
+            "dns_lookups": 0,
+            "dns_hits": 0,
+            "bytes": 0, # Read off the wire
+            "decoded_bytes": 0,
+            "cache_hits": 0,
+            "not_modified": 0,
+        }
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def stats(self):
+        """Returns a copy of the connection reuse counters"""
+        with self.lock:
+            return dict(self.counters)
+
+    def describe(self):
+        """Describes the connection reuse so far"""
+        c = self.stats()
+        return ("{requests} requests over {connections} connections "
+            "({reused} reused), {dns_lookups} DNS lookups, {cache_hits} cache hits, "
+            "{not_modified} not modified").format(**c) + (
+            "; limits: " + self.limiter.describe() if self.limiter.hosts else "")
+
+    def resolve(self, host, port):
+        """Returns a socket address of the host, from the cache if possible"""
+        key = (host, port)
+        with self.lock:
+            cached = self.addresses.get(key)
+            if cached and (time.time() - cached[1] < self.dnsttl):
+                self.counters["dns_hits"] += 1
+                return cached[0]
+        info = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        address = info[0][4][:2]
+        with self.lock:
+            self.counters["dns_lookups"] += 1
+            self.addresses[key] = (address, time.time())
+        return address
+
+    def connect(self, scheme, host, port):
+        """Opens a new connection to the host"""
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        def create(address, *args):
+            sock = socket.create_connection(self.resolve(*address), *args)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        conn._create_connection = create # Connect through the DNS cache
+        self.count("connections")
+        return conn
+
+    def checkout(self, key, reconnect=False):
+        """Returns an idle connection to the host, or a new one.
+        The second value tells whether the connection was reused."""
+        if not reconnect:
+            with self.lock:
+                pool = self.idle.get(key)
+                if pool:
+                    self.counters["reused"] += 1
+                    return pool.pop(), True
+        return self.connect(*key), False
+
+    def checkin(self, key, conn):
+        """Returns the connection to the idle pool of the host"""
+        with self.lock:
+            pool = self.idle.setdefault(key, [])
+            if len(pool) < self.maxidle:
+                return pool.append(conn)
+        conn.close()
+
+    def open(self, url, headers=None, reconnect=False, limit=True):
+        """Sends a GET for the url and returns the connection key, the
+        connection, the (unread) http.client response and the ticket of the
+        slot it holds of its host (None if it isn't limited)"""
+        parts   = urlsplit(url)
+        scheme  = parts.scheme or "http"
+        port    = parts.port or (443 if scheme == "https" else 80)
+        key     = (scheme, parts.hostname, port)
+        target  = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        sendheaders = dict(self.headers)
+        sendheaders.update(headers or {})
+
+        ticket = self.limiter.acquire(key) if limit else None
+        timeout = ticket and ticket.limit.timeout
+        try:
+            conn, reused = self.checkout(key, reconnect=reconnect)
+            try:
+                self.settimeout(conn, timeout)
+                conn.request("GET", target, headers=sendheaders)
+                response = conn.getresponse()
+            except _stale:
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped the kept-alive connection: try a fresh one
+                stats.count("retries")
+                conn, reused = self.checkout(key, reconnect=True)
+                self.settimeout(conn, timeout)
+                conn.request("GET", target, headers=sendheaders)
+                response = conn.getresponse()
+        except Exception:
+            if ticket:
+                ticket.failed()
+            raise
+        if ticket:
+            ticket.responded(response.status, response.headers)
+        self.count("requests")
+        return key, conn, response, ticket
+
+    def settimeout(self, conn, timeout):
+        """Sets the timeout of the host on the (pooled) connection"""
+        if timeout:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+
+    def configure(self, page, options):
+        """Applies the [ratelimit] options of a spec to the host of the page
+        (and to the other 'hosts' they list, like those of the images)"""
+        options = dict(options or {})
+        hosts = options.pop('hosts', [])
+        for host in [urlsplit(page).hostname] + list(hosts):
+            self.limiter.configure(host, **options)
+
+    def robotstxt(self, url):
+        """Returns the robots.txt at the url (outside of the rate limits)"""
+        with self.stream(url, maxage=24 * 3600, limit=False) as stream:
+            return stream.read()
+
+    def release(self, key, conn, response, reconnect=False):
+        """Pools the connection again if the response allows it"""
+        if reconnect or response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self.checkin(key, conn)
+
+    def cached(self, url, maxage=None):
+        """Returns the cached response of the url if it is recent enough"""
+        maxage = self.maxage if maxage is None else maxage
+        entry = self.cache.lookup(url) if self.cache else None
+        if entry and entry.age() <= maxage:
+            body = self.cache.body(entry)
+            if body is not None:
+                self.count("cache_hits")
+                return Response(url, 200, {}, body)
+        return None
+
+    def stream(self, url, headers=None, reconnect=False, maxage=None,
+        cache=True, limit=True):
+        """Fetches the url, following redirects, and returns a Stream of the
+        body (which must be closed). Cached responses younger than 'maxage'
+        seconds are used as they are, and older ones are revalidated with a
+        conditional GET. Throttled requests are retried 'retries' times. A 304
+        that there is no cached body for is asked for again once without the
+        conditional headers."""
+        cache = cache and self.cache
+        if cache:
+            response = self.cached(url, maxage=maxage)
+            if response:
+                return Stream(self, url, body=response.body)
+        redirects = retries = 0
+        conditional = True
+        while True:
+            entry = cache.lookup(url) if cache and conditional else None
+            sendheaders = dict(headers or {})
+            if not conditional:
+                sendheaders = {name: value for name, value in sendheaders.items()
+                    if not name.lower() in _conditions}
+            if entry:
+                sendheaders.update(entry.conditions())
+            key, conn, response, ticket = self.open(url, headers=sendheaders,
+                reconnect=reconnect, limit=limit)
+            status = response.status
+            if status == 200 or not ((status in _redirects) or
+                (status == 304) or (status >= 400)):
+                writer = None
+                if cache and status == 200:
+                    writer = cache.writer(url, etag=response.getheader("ETag"),
+                        lastmodified=response.getheader("Last-Modified"),
+                        kind=kindof(response.getheader("Content-Type")))
+                return Stream(self, url, status, response.headers, key=key,
+                    conn=conn, response=response, writer=writer,
+                    reconnect=reconnect, ticket=ticket)
+            # Nothing to stream here: finish the response first
+            with Stream(self, url, status, response.headers, key=key,
+                conn=conn, response=response, reconnect=reconnect,
+                ticket=ticket) as body:
+                body.read()
+            if status in throttled and limit and retries < self.retries:
+                retries += 1 # The limit of the host waits for the Retry-After
+                continue
+            if status in _redirects and response.getheader("Location"):
+                redirects += 1
+                if redirects > self.redirects:
+                    raise FetchError(url, status, "Too many redirects")
+                url = urljoin(url, response.getheader("Location"))
+                continue
+            if status == 304 and entry:
+                cached = cache.body(entry)
+                if cached is not None:
+                    cache.refresh(entry)
+                    self.count("not_modified")
+                    return Stream(self, url, 200, response.headers, body=cached)
+                # The body was evicted under us; fetch it unconditionally
+                cache.forget(url)
+                return self.stream(url, headers=headers, reconnect=reconnect,
+                    limit=limit)
+            if status == 304 and conditional: # Not modified since... nothing
+                conditional = False
+                continue
+            raise FetchError(url, status, response.reason)
+
+    def get(self, url, headers=None, reconnect=False, maxage=None, cache=True):
+        """Fetches the url, following redirects. Returns a Response"""
+        with self.stream(url, headers=headers, reconnect=reconnect,
+            maxage=maxage, cache=cache) as stream:
+            body = stream.read()
+        return Response(stream.url, stream.status, stream.headers, body)
+
+    def get_read(self, url, reconnect=False, maxage=None):
+        """Fetches the url and returns the body"""
+        return self.get(url, reconnect=reconnect, maxage=maxage).body
+
+    def close(self):
+        """Closes all of the idle connections"""
+        with self.lock:
+            pools, self.idle = self.idle, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+shared = Client(timeout=5, cache=ResponseCache(cachedir, maxbytes=cachesize,
+    pagebytes=pagecachesize))
@@ -0,0 +1,164 @@
+# coding: utf-8
+# imageindex.py
+"""
+Content hashes of the stored images. Every archive keeps an index of the
+urls of its images, their content hashes and the members they are stored
+as, so known urls aren't downloaded again and the same content under another
+url is stored once. The library index shares the url -> hash part between
+all of the comics (in the metadata folder).
+
+The images a session adds are stored as a segment of their own (so the index
+isn't written again whole every session), and the segments are folded into
+the whole index when there are many of them or the archive is compacted.
+"""
+import os, json, sqlite3, threading
+from utils import libraryindexfile, indexfile, indexdir
+
+maxsegments = 64 # Segments loaded before they are folded into the index
+
+class ImageIndex:
+    """The url -> content hash -> member index of the images of an archive"""
+    def __init__(self, urls=None, members=None):
+        self.urls       = urls or {} # url -> digest
+        self.members    = members or {} # digest -> member
+        self.changed    = False
+        self.added      = [] # [url, digest, member] since it was stored
+        self.rewritten  = False # Whether it changed other than by additions
+        self.segments   = [] # The segment members it was loaded with
+
+    def load(archive):
+        """Loads the index of the archive with the segments added to it"""
+        members = archive.list()
+        index = ImageIndex()
+        if indexfile in members:
+            index = ImageIndex.loads(archive.read(indexfile))
+        index.segments = sorted(member for member in members
+            if member.startswith(indexdir + "/"))
+        for segment in index.segments:
+            for url, digest, member in json.loads(archive.read(segment)):
+                index.add(url, digest, member)
+        index.added, index.changed = [], False
+        return index
+
+    def changes(self, fold=False):
+        """Returns the members to write for what changed (a dict of their
+        contents) and the segments to remove: the images added as a new
+        segment, or else (if it changed otherwise, has many segments or
+        'fold' is set) the whole index, replacing the segments"""
+        written, removed = {}, []
+        if self.rewritten or len(self.segments) >= maxsegments or \
+            fold and self.segments:
+            written[indexfile] = self.dumps()
+            removed, self.segments = self.segments, []
+        elif self.changed:
+            number = int(self.segments[-1][len(indexdir)+1:].split(".")[0]) + 1 \
+                if self.segments else 1
+            segment = "{0}/{1:06}.json".format(indexdir, number)
+            written[segment] = json.dumps(self.added)
+            self.segments.append(segment)
+        self.added, self.rewritten, self.changed = [], False, False
+        return written, removed
+
+    def loads(text):
+        data = json.loads(text)
+        return ImageIndex(data.get('urls'), data.get('members'))
+
+    def dumps(self):
+        return json.dumps({"urls": self.urls, "members": self.members},
+            sort_keys=True)
+
+    def digestof(self, url):
+        return self.urls.get(url)
+
+    def memberof(self, digest):
+        return self.members.get(digest)
+
+    def known(self, url):
+        """Returns the member of the image at the url, if it is stored"""
+        return self.memberof(self.digestof(url))
+
+    def add(self, url, digest, member=None):
+        """Adds an image url with its content hash (and where it is stored,
+        unless it is a duplicate)"""
+        self.urls[url] = digest
+        if member and not digest in self.members:
+            self.members[digest] = member
+        self.added.append([url, digest, member])
+        self.changed = True
+
+    def rename(self, old, new):
+        """Points the content stored as the old member at the new one"""
+        for digest, member in self.members.items():
+            if member == old:
+                self.members[digest] = new
+                self.changed = self.rewritten = True
+
+    def prune(self, members):
+        """Forgets the content that isn't in the given archive members"""
+        members = set(members)
+        kept = {digest: member for digest, member
+            in self.members.items() if member in members}
+        if len(kept) != len(self.members):
+            self.members = kept
+            self.urls = {url: digest for url, digest in self.urls.items()
+                if digest in self.members}
+            self.changed = self.rewritten = True
+
+class LibraryIndex:
+    """The url -> content hash index shared by every comic in the library"""
+    def __init__(self, path):
+        self.path       = path
+        self.lock       = threading.Lock()
+        self.db         = None # Opened on first use
+
+    def _open(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY, digest TEXT, size INTEGER);
+                CREATE TABLE IF NOT EXISTS contents (
+                    digest TEXT, title TEXT, PRIMARY KEY (digest, title));
+            """)
+        return self.db
+
+    def exists(self):
+        """Whether the index was ever made (by a comic with 'sharedindex')"""
+        return self.db is not None or os.path.exists(self.path)
+
+    def digestof(self, url):
+        with self.lock:
+            row = self._open().execute("SELECT digest FROM urls WHERE url = ?",
+                (url,)).fetchone()
+        return row[0] if row else None
+
+    def titlesof(self, digest):
+        """The comics that store the content"""
+        with self.lock:
+            rows = self._open().execute("SELECT title FROM contents "
+                "WHERE digest = ?", (digest,)).fetchall()
+        return [row[0] for row in rows]
+
+    def add(self, title, url, digest, size):
+        with self.lock:
+            db = self._open()
+            db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?)",
+                (url, digest, size))
+            db.execute("INSERT OR IGNORE INTO contents VALUES (?, ?)",
+                (digest, title))
+            db.commit()
+
+    def forget(self, title):
+        """Forgets the content of the comic (when it is created anew)"""
+        with self.lock:
+            self._open().execute("DELETE FROM contents WHERE title = ?", (title,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+shared = LibraryIndex(libraryindexfile)
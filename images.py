@@ -4,12 +4,14 @@
 """
 Responsible for the correct finding, identifying and testing of comic images
 """
-import os, tempfile, imghdr, shutil, sys
+import os, tempfile, imghdr, shutil, sys, struct
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
 from urllib.parse import urljoin, urlparse
-from finder import isimage, findcommonidentifiers, _getter, Identifier
+from finder import isimage, findcommonidentifiers, _getter, Identifier, PageIndex
 from bs4 import BeautifulSoup
 from PIL import Image
+from stats import stats
 
 def imagesize(path):
     #print("Finding the size of path:", path)
@@ -56,16 +58,18 @@ def findimages(soup, page, identifier):
     """Finds the images identified by the given identifier in the soup,
     and returns their source urls"""
     found = identifier.identify(soup)
-    urls = set()
+    urls = []
     if not found:
         print("Could not find any images using {0}!".format(identifier))
-    for image in found:
-        urls.add(image['src'])
-    return [urljoin(page, url) for url in urls]  
+    for image in found: # Keep the page order, but only once per image
+        url = urljoin(page, image['src'])
+        if not url in urls:
+            urls.append(url)
+    return urls
 
-def validateidentifiers(tag, identifiers, firstsoup, nextsoup, validimages):
-    """Checks and finds the valid identifiers for the given tag in the soup,
-    then checks whether it works for the second as well."""
+def validateidentifiers(tag, identifiers, first, second, validimages):
+    """Checks and finds the valid identifiers for the given tag on the
+    indexed first page, then checks whether they work on the second as well."""
     validimages = set(validimages)
     
     print("Validating identifiers:")
@@ -75,7 +79,7 @@ def validateidentifiers(tag, identifiers, firstsoup, nextsoup, validimages):
     # Find out which identifiers work
     valid = []
     for identifier in identifiers: 
-        found = identifier.identify(firstsoup)
+        found = first.identify(identifier)
         isvalid = True
         for image in found:
             #print("- Found {0}".format(image['src']))
@@ -88,7 +92,7 @@ def validateidentifiers(tag, identifiers, firstsoup, nextsoup, validimages):
     proven = []
     print("Valid identifiers:")
     for identifier in valid:
-        found = identifier.identify(nextsoup)
+        found = second.identify(identifier)
         print("-", identifier, "->")
         for tag in found:
             print("---", tag['src'])
@@ -111,6 +115,82 @@ def findimageidentifiers(tag, soup):
     
     return identifiers
 
+def headersize(data):
+    """Reads the (width, height) of a PNG, JPEG, GIF or WebP image from the
+    start of its data. Returns None when it can't (yet) be read."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) >= 24 and data[12:16] == b"IHDR":
+            return struct.unpack(">II", data[16:24])
+    elif data[:6] in (b"GIF87a", b"GIF89a"):
+        if len(data) >= 10:
+            return struct.unpack("<HH", data[6:10])
+    elif data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 " and len(data) >= 30 and data[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", data[26:30])
+            return (width & 0x3fff, height & 0x3fff)
+        if chunk == b"VP8L" and len(data) >= 25 and data[20] == 0x2f:
+            bits = int.from_bytes(data[21:25], "little")
+            return ((bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+        if chunk == b"VP8X" and len(data) >= 30:
+            return (int.from_bytes(data[24:27], "little") + 1,
+                int.from_bytes(data[27:30], "little") + 1)
+    elif data[:2] == b"\xff\xd8":
+        # Walk the segments until a start of frame
+        pos = 2
+        while pos + 9 <= len(data):
+            if data[pos] != 0xff:
+                return None # Not where a marker should be
+            marker = data[pos+1]
+            if marker == 0xff: # Padding
+                pos += 1
+            elif marker in jpegframes:
+                height, width = struct.unpack(">HH", data[pos+5:pos+9])
+                return (width, height)
+            elif marker == 0x01 or 0xd0 <= marker <= 0xd8: # No length
+                pos += 2
+            else:
+                pos += 2 + struct.unpack(">H", data[pos+2:pos+4])[0]
+    return None
+
+# Start of frame markers (the ones that aren't DHT, JPG or DAC)
+jpegframes = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+probelimit      = 64 * 1024 # bytes read at most for the header
+probeworkers    = 8
+
+def probesize(url, limit=probelimit):
+    """Finds the size of the image at the url by reading only the start of
+    it (asking for a range, and stopping early if it is ignored)"""
+    data = b""
+    headers = {"Range": "bytes=0-{0}".format(limit - 1)}
+    try:
+        with _getter.stream(url, headers=headers, cache=False) as stream:
+            for chunk in stream.chunks(4096):
+                data += chunk
+                imgsize = headersize(data)
+                if imgsize or len(data) >= limit:
+                    return imgsize
+    except Exception as e:
+        print("Could not probe '{0}': {1}".format(url, e))
+    return None
+
+def fetchimage(url, folder, num):
+    """Downloads the whole image to the folder, returning its path"""
+    data = _getter.get_read(url)
+    if not data:
+        raise Exception("No image data read from url '{0}'!".format(url))
+    ending = imghdr.what(None, data)
+    if not ending:
+        ending = urlparse(url).path.split(".")[-1]
+        print("Could not determine image format using imghdr, ")
+        print("found '{0}' by parsing the url".format(ending))
+    fname = "{0}.{1}".format(num, ending)
+    path = os.path.join(folder, fname)
+    with open(path, "wb") as f: # Save the image
+        f.write(data)
+    return path
+
+@stats.timed("findlargerthan")
 def findlargerthan(imagetags, minsize, page):
     """Returns the given image tags that are larger than the size, or
     if none are, the largest of them."""
@@ -120,29 +200,22 @@ def findlargerthan(imagetags, minsize, page):
         return imgsize[0] * imgsize[1]
     
     with tempfile.TemporaryDirectory() as folder: # clean!
-        print("Folder:", folder)
-        imageinfo = [] # (imagetag, size, path)
-        for num, image in enumerate(imagetags):
+        def findsize(args):
+            num, image = args
             src = image['src']
             if os.path.exists(getlocal(src)): # It's a local file
-                path = src
-            else: # Fetch
-                url = urljoin(page, src)
-                data = _getter.get_read(url, reconnect=True)
-                if not data:
-                    raise Exception("No image data read from url '{0}'!".format(url))
-                ending = imghdr.what(None, data)
-                if not ending:
-                    ending = urlparse(url).path.split(".")[-1]
-                    print("Could not determine image format using imghdr, ")
-                    print("found '{0}' by parsing the url".format(ending))
-                fname = "{0}.{1}".format(num, ending)
-                path = os.path.join(folder, fname)
-                with open(path, "wb") as f: # Save the image
-                    f.write(data)
-            # Check the image
-            imgsize = imagesize(path)
-            imageinfo.append((image, imgsize, path))
+                return (image, imagesize(src), src)
+            url = urljoin(page, src)
+            imgsize = probesize(url)
+            if imgsize:
+                return (image, imgsize, url)
+            print("Could not read the size of '{0}' from its header".format(url))
+            path = fetchimage(url, folder, num)
+            return (image, imagesize(path), path)
+        
+        # Probe all of the candidates at the same time
+        with ThreadPoolExecutor(max_workers=probeworkers) as pool:
+            imageinfo = list(pool.map(findsize, enumerate(imagetags))) # (imagetag, size, path)
         
         larger = []
         print("Larger images:")
@@ -160,18 +233,16 @@ def findlargerthan(imagetags, minsize, page):
             
     return larger
 
+@stats.timed("findimagefinder")
 def findimagefinder(firstpage, nextpage, minsize=(350, 350),
-    silent=False):
-    """Finds the images in the pages and a way of identifying them"""
-    try:
-        p1 = _getter.get_read(firstpage)
-        startsoup = BeautifulSoup(p1)
-        p2 = _getter.get_read(nextpage)
-        nextsoup = BeautifulSoup(p2)
-    except Exception as e:
-        raise e
+    silent=False, pages=None):
+    """Finds the images in the pages and a way of identifying them.
+    Pages indexed already (by findlinker) are taken from 'pages'."""
+    first   = PageIndex.load(firstpage, pages)
+    second  = PageIndex.load(nextpage, pages)
+    startsoup = first.soup
     
-    images = startsoup.find_all(isvalidimage)
+    images = [tag for tag in first.tags("img") if isvalidimage(tag)]
     # Find all the images bigger than or equal to the size
     print("Finding larger images....")
     larger = findlargerthan(images, minsize, firstpage)
@@ -182,8 +253,8 @@ def findimagefinder(firstpage, nextpage, minsize=(350, 350),
     for imagetag in larger:
         print("Finding identifier for '{0}'".format(imagetag['src']))
         identifiers = findimageidentifiers(imagetag, startsoup)
-        proven = validateidentifiers(imagetag, identifiers, startsoup,
-            nextsoup, set(larger))
+        proven = validateidentifiers(imagetag, identifiers, first, second,
+            set(larger))
         if proven:
             print("- Proven:")
             for iid in proven:
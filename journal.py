@@ -0,0 +1,175 @@
+# coding: utf-8
+# journal.py
+"""
+A write-ahead journal of scrape progress, kept next to the archive while a
+comic is being scraped. Every scraped page is appended to it, and it is
+synced to disk in groups, together with a checkpoint of the archive. If the
+process dies, the next load puts the archive back to the last checkpoint and
+replays the journal into the progress.
+"""
+import os, json, time, struct
+
+class Journal:
+    """The journal (and archive checkpoint) of the archive at the path"""
+    def __init__(self, archivepath, every=8, interval=2.0):
+        self.archivepath    = archivepath
+        self.path           = archivepath + ".journal"
+        self.checkpointpath = archivepath + ".checkpoint"
+        self.every          = every # Records per group commit
+        self.interval       = interval # Seconds between commits at most
+        self.file           = None
+        self.pending        = 0
+        self.committed      = time.time()
+
+    def exists(self):
+        """Whether a previous session didn't end cleanly"""
+        return os.path.exists(self.path) or os.path.exists(self.checkpointpath)
+
+    def recover(self, restore, isvalid):
+        """Restores the archive from the last checkpoint if it was left broken
+        (the archive class gives the 'restore' and 'isvalid' functions).
+        Returns whether it was restored."""
+        if not os.path.exists(self.checkpointpath) or isvalid(self.archivepath):
+            return False
+        with open(self.checkpointpath, "rb") as f:
+            offset, = struct.unpack("<Q", f.read(8))
+            tail = f.read()
+        restore(self.archivepath, offset, tail)
+        return True
+
+    def replay(self):
+        """Returns the records in the journal (up to a torn last line)"""
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break # Torn by the crash
+        return records
+
+    def begin(self, archive):
+        """Starts journaling: checkpoints the archive before it is written"""
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.checkpoint(archive)
+
+    def record(self, archive, page, images, members, lastindex, nextpage,
+        hashes=None, digest=None):
+        """Appends a scraped page, committing the group when it is full"""
+        self.begin(archive)
+        record = {
+            "page": page,
+            "images": images,
+            "members": members,
+            "lastindex": lastindex,
+            "nextpage": nextpage or "",
+            "hashes": hashes or [], # [url, digest, member or None]
+            "digest": digest or "", # Of the page
+        }
+        self.file.write(json.dumps(record) + "\n")
+        self.pending += 1
+        if (self.pending >= self.every or
+            time.time() - self.committed >= self.interval):
+            self.commit(archive)
+
+    def commit(self, archive):
+        """Makes the archive and then the journal durable"""
+        if self.file is None:
+            return
+        self.checkpoint(archive)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending    = 0
+        self.committed  = time.time()
+
+    def checkpoint(self, archive):
+        """Saves the current end of the archive (atomically)"""
+        offset, tail = archive.checkpoint()
+        temp = self.checkpointpath + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(struct.pack("<Q", offset))
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.checkpointpath)
+
+    def finish(self):
+        """Ends the journal after the archive was closed cleanly"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if not self.exists():
+            return
+        if os.path.isfile(self.archivepath): # Durable before forgetting
+            with open(self.archivepath, "rb+") as f:
+                os.fsync(f.fileno())
+        for path in (self.path, self.checkpointpath):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def remove(archivepath):
+        """Removes the journal files of the archive at the path"""
+        for path in (archivepath + ".journal", archivepath + ".checkpoint"):
+            if os.path.exists(path):
+                os.remove(path)
+
+class PageList:
+    """The ordered pages found by the link crawl of a two-phase scrape, kept
+    next to the archive until their images are harvested"""
+    def __init__(self, archivepath):
+        self.path   = archivepath + ".pages"
+        self.file   = None
+
+    def load(self):
+        """Returns the listed pages ({"page", "next"}), up to a torn line"""
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+        return entries
+
+    def resume(self, page):
+        """Returns the listed pages from the given one on, or starts the
+        list anew if it doesn't have the page"""
+        entries = self.load()
+        for num, entry in enumerate(entries):
+            if entry['page'] == page:
+                return entries[num:]
+        self.close()
+        PageList.remove(self.path[:-len(".pages")])
+        return []
+
+    def droplast(self):
+        """Removes the last listed page (so it can be listed anew)"""
+        entries = self.load()[:-1]
+        self.close()
+        temp = self.path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temp, self.path)
+
+    def append(self, page, nextpage):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(json.dumps({"page": page, "next": nextpage}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(archivepath):
+        """Removes the page list of the archive at the path"""
+        path = archivepath + ".pages"
+        if os.path.exists(path):
+            os.remove(path)
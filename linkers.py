@@ -6,8 +6,9 @@ Finds and tests identifiers for a link connection between comic pages
 """
 import urllib.parse
 from urllib.parse import urljoin
-from finder import findcommonidentifiers, isimage, _getter, Identifier
+from finder import findcommonidentifiers, isimage, _getter, Identifier, PageIndex
 from utils import printiter
+from stats import stats
 from bs4 import BeautifulSoup
 
 # - - - Soup filters 
@@ -22,15 +23,15 @@ def isnextlink(firstpage, nextpage):
     return identify
 
 # - - - Other functions
-def workinglinkers(firstsoup, nextsoup, tag, identifiers, validtags):
-    """Tests the identifiers found for the tag in the soup of the next page,
-    returning any identifiers that work"""
+def workinglinkers(first, second, tag, identifiers, validtags):
+    """Tests the identifiers found for the tag on the indexed first and next
+    pages, returning any identifiers that work"""
     validtags = set(validtags)
     working = []
     name = tag.name
     for identifier in identifiers:
-        foundfirst  = identifier.identify(firstsoup)
-        foundsecond = identifier.identify(nextsoup)
+        foundfirst  = first.identify(identifier)
+        foundsecond = second.identify(identifier)
         valid = True
         for linktag in foundfirst:
             if not linktag in validtags:
@@ -72,24 +73,22 @@ def findlinkers(tag, soup):
     
     return identifiers    
 
-def findlinker(firstpage, nextpage, silent=False):
-    """Finds a working linker identifier to go from the first page to the next"""
+@stats.timed("findlinker")
+def findlinker(firstpage, nextpage, silent=False, pages=None):
+    """Finds a working linker identifier to go from the first page to the next.
+    The pages are indexed once and kept in 'pages' (if given), so that
+    finding the image identifier can use them as well."""
     def debug(*args, **kwargs):
         if not silent: print(*args, **kwargs)
     def debugiter(*args, **kwargs):
         if not silent: printiter(*args, **kwargs)
     
-    try:
-        p1 = _getter.get_read(firstpage)
-        firstsoup = BeautifulSoup(p1)
-        p2 = _getter.get_read(nextpage)
-        nextsoup = BeautifulSoup(p2)
-        #print("firstsoup:", firstsoup)
-    except Exception as e:
-        raise e
+    first   = PageIndex.load(firstpage, pages)
+    second  = PageIndex.load(nextpage, pages)
+    firstsoup = first.soup
     
     debug("- Identifying next link...")
-    links = firstsoup.find_all(isnextlink(firstpage, nextpage))
+    links = first.linksto(nextpage)
     debug("Found links:")
     for num, link in enumerate(links):
         debug("--", num, "--")
@@ -106,7 +105,7 @@ def findlinker(firstpage, nextpage, silent=False):
     debug("Working:")
     linkers = []
     for num, linktag in enumerate(links):
-        linkers += workinglinkers(firstsoup, nextsoup, linktag, identifiers[num], links)
+        linkers += workinglinkers(first, second, linktag, identifiers[num], links)
     
     if not linkers:
         raise Exception("No working linkers found!")
@@ -0,0 +1,487 @@
+# coding: utf-8
+# pipeline.py
+"""
+The pipelined scrape engine. A crawler thread follows the link chain and
+prefetches pages while the images of earlier pages download on a worker pool.
+Images are written to the archive in page order by the calling thread, and
+bounded queues keep the amount of pages (and image data) in flight flat.
+"""
+import threading, queue, tempfile, hashlib, time, random, re
+import http.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup
+from httpclient import shared as _getter, FetchError
+from linkers import findlink
+from images import findimages
+from scheduler import Scheduler
+from extractor import extractpage, streamable
+from stats import stats
+from journal import PageList
+
+spoolsize   = 2**20 # Bytes of an image kept in memory before spilling to disk
+retries     = 4 # Times a failed image download is tried again
+backoff     = (0.5, 30.0) # The first and the longest wait between the tries
+resumesize  = 64 * 1024 # Downloads cut after this many bytes are resumed
+
+def fetch(url, reconnect=False):
+    """Downloads the page or image at the given url"""
+    with stats.timer("fetch") as event:
+        data = _getter.get_read(url, reconnect=reconnect)
+        event['bytes'] = len(data)
+    return data
+
+class IncompleteDownload(Exception):
+    """A body that doesn't match the length the server announced"""
+
+def retryable(error):
+    """Whether a download that failed with the error may succeed if tried
+    again (errors of the network, the connection and the server)"""
+    if isinstance(error, FetchError):
+        return error.status >= 500 or error.status in (408, 416, 429)
+    return isinstance(error, (OSError, http.client.HTTPException,
+        IncompleteDownload))
+
+def backoffwait(attempt):
+    """The (jittered) seconds to wait before trying again"""
+    first, longest = backoff
+    return min(longest, first * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def expectedlength(stream, offset):
+    """The bytes of the body the server announced (or None), checking that a
+    partial response starts where the download was cut"""
+    if stream.status == 206:
+        match = re.match(r"bytes (\d+)-(\d+)/", stream.headers.get("Content-Range", ""))
+        if not match or int(match.group(1)) != offset:
+            raise IncompleteDownload("Bad Content-Range for offset {0}".format(offset))
+        return int(match.group(2)) + 1 - offset
+    length = stream.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+def download(url, reconnect=False):
+    """Streams the image at the url into a spooled temporary file, so that
+    large images don't stay in memory while they wait to be stored.
+    Failed downloads are tried 'retries' more times with a growing wait, and
+    ones that were cut after 'resumesize' bytes continue with a Range request
+    where they were cut (starting over if the server can't do that).
+    Returns the file and the content hash of the image."""
+    spool       = tempfile.SpooledTemporaryFile(max_size=spoolsize)
+    digest      = hashlib.sha1()
+    offset      = 0 # Bytes of the body kept from earlier tries
+    validator   = None # The ETag or Last-Modified of the body being resumed
+    attempt     = 0
+    def restart():
+        nonlocal offset, digest
+        offset = 0
+        spool.seek(0)
+        spool.truncate()
+        digest = hashlib.sha1()
+    try:
+        while True:
+            headers = None
+            if offset:
+                headers = {"Range": "bytes={0}-".format(offset)}
+                if validator:
+                    headers["If-Range"] = validator
+            try:
+                with stats.timer("download") as event, \
+                    _getter.stream(url, headers=headers, reconnect=reconnect,
+                    cache=not offset) as stream:
+                    if offset and stream.status != 206: # The whole body again
+                        restart()
+                    expected = None
+                    if stream.body is None: # Not from the cache
+                        expected = expectedlength(stream, offset)
+                    identity = stream.headers.get("Content-Encoding",
+                        "identity") == "identity" # Ranges of decoded bytes
+                    etag = stream.headers.get("ETag", "")
+                    validator = (etag if etag and not etag.startswith("W/")
+                        else stream.headers.get("Last-Modified"))
+                    for chunk in stream:
+                        event['bytes'] += spool.write(chunk)
+                        digest.update(chunk)
+                        if identity:
+                            offset += len(chunk)
+                    if expected is not None and stream.received != expected:
+                        raise IncompleteDownload("Got {0} of {1} bytes of '{2}'".format(
+                            stream.received, expected, url))
+                break
+            except Exception as e:
+                if attempt >= retries or not retryable(e):
+                    raise
+                if offset >= resumesize and not (isinstance(e, FetchError)
+                    and e.status == 416):
+                    stats.count("resumed")
+                else: # Cheaper (or only possible) to start over
+                    restart()
+                stats.count("download_retries")
+                time.sleep(backoffwait(attempt))
+                attempt += 1
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+def spoolchunks(spool, size=64 * 1024):
+    """Reads the spooled file in chunks"""
+    return iter(lambda: spool.read(size), b"")
+
+class Page:
+    """A scraped page: its url, the images on it and the link to the next"""
+    def __init__(self, url, imageurls, nextpage):
+        self.url        = url
+        self.imageurls  = imageurls
+        self.nextpage   = nextpage
+
+class End:
+    """Marks the end of the crawl, with the reason or the error that ended it"""
+    def __init__(self, reason=None, error=None):
+        self.reason = reason
+        self.error  = error
+
+def _put(out, item, stop):
+    """Puts the item on the queue, unless the scrape is stopped while waiting"""
+    while not stop.is_set():
+        try:
+            return out.put(item, timeout=0.1)
+        except queue.Full:
+            pass
+
+def _get(out, stop):
+    """Gets the next item from the queue, or an End if the scrape is stopped"""
+    while not stop.is_set():
+        try:
+            return out.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return End("Scrape stopped! Ending...")
+
+def parsepage(url, link_identifier, image_identifier, reconnect=False):
+    """Fetches and parses the whole page, returning the image urls on it
+    and the link to the next page"""
+    data = fetch(url, reconnect=reconnect)
+    with stats.timer("parse") as event:
+        soup = BeautifulSoup(data)
+        event['bytes'] = len(data)
+    with stats.timer("identify"):
+        return (findimages(soup, url, image_identifier),
+            findlink(soup, url, link_identifier))
+
+def crawl(nextpage, link_identifier, image_identifier, lastimages, remaining,
+    out, stop, scheduler, reconnect=False, stream=False):
+    """Follows the link chain from 'nextpage', putting a Page on the queue
+    for every page with new images, and an End when the chain stops.
+    With 'stream', pages are read with the streaming extractor (if the
+    identifiers allow it) instead of being parsed whole."""
+    reason = None
+    extract = parsepage
+    if stream and streamable(link_identifier) and streamable(image_identifier):
+        extract = extractpage
+    try:
+        while nextpage and remaining and not stop.is_set():
+            imageurls, link = scheduler.run(nextpage, extract, link_identifier,
+                image_identifier, reconnect=reconnect)
+            if not imageurls:
+                reason = "No images found at '{0}'! Ending...".format(nextpage)
+                break
+            if imageurls == lastimages:
+                reason = "Image duplicates found at '{0}'! Ending...".format(nextpage)
+                break
+            _put(out, Page(nextpage, imageurls, link), stop)
+            lastimages = imageurls # Don't repeat content!
+            if link == nextpage:
+                reason = "No further links found at '{0}'! Ending...".format(nextpage)
+                break
+            nextpage    = link
+            remaining  -= 1
+        _put(out, End(reason), stop)
+    except Exception as e:
+        _put(out, End(error=e), stop)
+
+def pagedigest(url):
+    """The content hash of the page as it was just fetched (or None if it
+    wasn't kept), which the progress keeps for later updates"""
+    entry = _getter.cache.lookup(url) if _getter.cache else None
+    return entry.digest if entry else None
+
+def store(comic, page, futures, tally):
+    """Writes the downloaded images of the page to the comic, in order.
+    Images whose content the comic has already have no future (they weren't
+    downloaded). Returns whether any new image content was on the page."""
+    print("- {0:03}: {1}".format(comic.progress['lastindex']+1, page.url))
+    new = False
+    for url, future in zip(page.imageurls, futures):
+        if future is None:
+            with stats.timer("zipwrite"):
+                written = comic.addknown(url, comic.knowndigest(url))
+            size = 0
+        else:
+            spool, digest = future.result()
+            new = new or comic.index.memberof(digest) is None
+            with spool:
+                size = spool.seek(0, 2)
+                spool.seek(0)
+                with stats.timer("zipwrite") as event:
+                    written = comic.addunique(url, digest, spoolchunks(spool),
+                        size=size)
+                    event['bytes'] = size if written else 0
+        if written:
+            tally['images'] += 1
+            tally['bytes']  += size
+        else:
+            tally['duplicates'] += 1
+            stats.count("duplicates")
+    with stats.timer("journal"):
+        comic.setscraped(page.url, page.imageurls, page.nextpage,
+            digest=pagedigest(page.url))
+    tally['pages'] += 1
+    return new
+
+# How the reasons start that mean a scrape reached the end of the comic (rather
+# than being stopped, limited to some pages or failing)
+endings = ("No images found", "Image duplicates found", "No further links found",
+    "The links loop back", "Only repeated images")
+
+def reachedend(reason):
+    """Whether the scrape that ended for the reason reached the end of the comic"""
+    return bool(reason) and reason.startswith(endings)
+
+def newtally():
+    """Returns the counters that a scrape updates"""
+    return {'pages': 0, 'images': 0, 'bytes': 0, 'duplicates': 0}
+
+def scrape(comic, nextpage, link_identifier, image_identifier, pages=-1,
+    reconnect=False, workers=4, prefetch=2, scheduler=None, stop=None,
+    tally=None, stream=False, repeatstop=0):
+    """Scrapes the comic from 'nextpage' on, keeping the 'lastimages' and
+    self-link stop conditions (and stopping after 'repeatstop' pages in a row
+    with only image content that is stored already, if it is set).
+    Images the comic knows by their url aren't downloaded again. At most 'prefetch' pages wait to be downloaded
+    and as many more have their images in flight on 'workers' threads.
+    All fetches take their slots from the scheduler (which may be shared with
+    other scrapes), and setting 'stop' ends the scrape after the pages in flight.
+    With 'stream', pages are read by the streaming extractor.
+    Returns the reason the scrape ended (if any)."""
+    pagequeue   = queue.Queue(maxsize=prefetch)
+    stop        = stop or threading.Event()
+    done        = threading.Event() # Only this scrape
+    scheduler   = scheduler or Scheduler(connections=workers+1, perhost=workers+1)
+    tally       = newtally() if tally is None else tally
+    lastimages  = comic.progress['lastimages']
+    crawler     = threading.Thread(target=crawl, daemon=True, args=(nextpage,
+        link_identifier, image_identifier, lastimages, pages, pagequeue, done,
+        scheduler, reconnect, stream))
+    pending     = deque() # (page, [image futures, or None if known])
+    pool        = ThreadPoolExecutor(max_workers=workers)
+    repeats     = 0 # Pages in a row without new image content
+    def ready(futures):
+        return all(future is None or future.done() for future in futures)
+    def storenext():
+        nonlocal repeats
+        page, futures = pending.popleft()
+        repeats = 0 if store(comic, page, futures, tally) else repeats + 1
+        if repeatstop and repeats >= repeatstop:
+            return "Only repeated images for {0} pages at '{1}'! Ending...".format(
+                repeats, page.url)
+    crawler.start()
+    try:
+        while True:
+            item = _get(pagequeue, stop)
+            if isinstance(item, End):
+                break
+            futures = [None if comic.knowndigest(url) else
+                pool.submit(scheduler.run, url, download, reconnect=reconnect)
+                for url in item.imageurls]
+            pending.append((item, futures))
+            # Write whatever is finished, and wait when the window is full
+            while pending and (len(pending) > prefetch or ready(pending[0][1])):
+                reason = storenext()
+                if reason:
+                    return reason
+        while pending:
+            reason = storenext()
+            if reason:
+                return reason
+        if item.error:
+            raise item.error
+        return item.reason
+    finally:
+        done.set()
+        for page, futures in pending:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+        pool.shutdown(wait=True)
+
+def linkpage(url, link_identifier, reconnect=False, stream=False):
+    """Returns the link to the next page only (streaming stops at it)"""
+    if stream and streamable(link_identifier):
+        return extractpage(url, link_identifier, None, reconnect=reconnect)[1]
+    data = fetch(url, reconnect=reconnect)
+    with stats.timer("parse") as event:
+        soup = BeautifulSoup(data)
+        event['bytes'] = len(data)
+    with stats.timer("identify"):
+        return findlink(soup, url, link_identifier)
+
+def imagepage(url, image_identifier, reconnect=False, stream=False):
+    """Returns the urls of the images on the page only"""
+    if stream and streamable(image_identifier):
+        return extractpage(url, None, image_identifier, reconnect=reconnect)[0]
+    data = fetch(url, reconnect=reconnect)
+    with stats.timer("parse") as event:
+        soup = BeautifulSoup(data)
+        event['bytes'] = len(data)
+    with stats.timer("identify"):
+        return findimages(soup, url, image_identifier)
+
+def crawlchain(nextpage, link_identifier, pagelist, entries, remaining, stop,
+    scheduler, reconnect=False, stream=False):
+    """Follows the link chain from 'nextpage' on (reading only the links),
+    appending the pages to the entries and the page list as they are found.
+    Returns the reason the chain ended."""
+    seen = set(entry['page'] for entry in entries)
+    if remaining != -1: # -1 means all
+        remaining = max(remaining - len(entries), 0)
+    while nextpage and remaining and not stop.is_set():
+        link = scheduler.run(nextpage, linkpage, link_identifier,
+            reconnect=reconnect, stream=stream)
+        entries.append({"page": nextpage, "next": link})
+        pagelist.append(nextpage, link)
+        seen.add(nextpage)
+        if link == nextpage or not link:
+            return "No further links found at '{0}'! Ending...".format(nextpage)
+        if link in seen:
+            return "The links loop back at '{0}'! Ending...".format(nextpage)
+        nextpage    = link
+        remaining  -= 1
+    return None
+
+def harvest(comic, entries, image_identifier, reconnect=False, workers=4,
+    ahead=None, scheduler=None, stop=None, tally=None, stream=False,
+    repeatstop=0):
+    """Downloads the images of the listed pages, finding the images of many
+    pages at the same time, and stores them in page order (so the images are
+    numbered as if the pages were scraped one by one). Keeps the stop
+    conditions of scrape. Returns the reason it ended early (if it did) and
+    the number of pages that were stored."""
+    stop        = stop or threading.Event()
+    scheduler   = scheduler or Scheduler(connections=workers+1, perhost=workers+1)
+    tally       = newtally() if tally is None else tally
+    ahead       = ahead or 4 * workers # Pages read ahead of the one stored
+    lastimages  = comic.progress['lastimages']
+    pool        = ThreadPoolExecutor(max_workers=workers)
+    found       = deque() # (entry, future of the image urls)
+    pending     = deque() # (page, [image futures, or None if known])
+    entries     = iter(entries)
+    stored      = 0
+    repeats     = 0
+    def ready(futures):
+        return all(future is None or future.done() for future in futures)
+    def storenext():
+        nonlocal stored, repeats
+        page, futures = pending.popleft()
+        repeats = 0 if store(comic, page, futures, tally) else repeats + 1
+        stored += 1
+        if repeatstop and repeats >= repeatstop:
+            return "Only repeated images for {0} pages at '{1}'! Ending...".format(
+                repeats, page.url)
+    try:
+        while not stop.is_set():
+            while len(found) < ahead:
+                entry = next(entries, None)
+                if entry is None:
+                    break
+                found.append((entry, pool.submit(scheduler.run, entry['page'],
+                    imagepage, image_identifier, reconnect=reconnect,
+                    stream=stream)))
+            if not found:
+                break
+            entry, future = found.popleft()
+            imageurls = future.result()
+            if not imageurls:
+                return "No images found at '{0}'! Ending...".format(entry['page']), stored
+            if imageurls == lastimages:
+                return "Image duplicates found at '{0}'! Ending...".format(entry['page']), stored
+            lastimages = imageurls
+            futures = [None if comic.knowndigest(url) else
+                pool.submit(scheduler.run, url, download, reconnect=reconnect)
+                for url in imageurls]
+            pending.append((Page(entry['page'], imageurls, entry['next']), futures))
+            while pending and (len(pending) > ahead or ready(pending[0][1])):
+                reason = storenext()
+                if reason:
+                    return reason, stored
+        while pending and not stop.is_set():
+            reason = storenext()
+            if reason:
+                return reason, stored
+        if stop.is_set():
+            return "Scrape stopped! Ending...", stored
+        return None, stored
+    finally:
+        for entry, future in found:
+            future.cancel()
+        for page, futures in pending:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+        pool.shutdown(wait=True)
+
+def listpages(comic, nextpage, link_identifier, pages=-1, reconnect=False,
+    stop=None, scheduler=None, stream=False):
+    """Crawls the link chain of the comic from 'nextpage' on (continuing the
+    page list next to the archive, if it has the page) and lists the pages.
+    Returns the reason the chain ended (if any), the pages to scrape (at most
+    'pages' of them) and the number of pages listed."""
+    pagelist    = PageList(comic.archive.path)
+    entries     = pagelist.resume(nextpage)
+    try:
+        if entries:
+            print("- Resuming the page list at '{0}' ({1} pages)".format(
+                nextpage, len(entries)))
+        last = entries[-1] if entries else None
+        start = last['next'] if last else nextpage
+        wanted = pages == -1 or len(entries) < pages # More than are listed
+        if wanted and last and (not last['next'] or last['next'] in
+            set(entry['page'] for entry in entries)):
+            # The list ended there when it was made, but pages may have come
+            # since: the last page is read again for its link
+            entries.pop()
+            pagelist.droplast()
+            start = last['page']
+        print("Crawling the link chain...")
+        reason = crawlchain(start, link_identifier, pagelist, entries,
+            pages, stop, scheduler, reconnect=reconnect, stream=stream)
+        listed = len(entries)
+        if pages != -1:
+            entries = entries[:pages]
+        print("- Found {0} pages".format(listed))
+    finally:
+        pagelist.close()
+    return reason, entries, listed
+
+def scrapetwophase(comic, nextpage, link_identifier, image_identifier,
+    pages=-1, reconnect=False, workers=4, scheduler=None, stop=None,
+    tally=None, stream=False, repeatstop=0):
+    """Scrapes the comic in two phases: the link chain is crawled first,
+    reading only the links, and the ordered pages are listed next to the
+    archive. Then the images of the listed pages are harvested in parallel.
+    An interrupted scrape continues the list where it was left.
+    Returns the reason the scrape ended (if any)."""
+    stop        = stop or threading.Event()
+    scheduler   = scheduler or Scheduler(connections=workers+1, perhost=workers+1)
+    reason, entries, listed = listpages(comic, nextpage, link_identifier,
+        pages=pages, reconnect=reconnect, stop=stop, scheduler=scheduler,
+        stream=stream)
+    if stop.is_set():
+        return "Scrape stopped! Ending..."
+    
+    print("Harvesting images...")
+    harvested, stored = harvest(comic, entries, image_identifier,
+        reconnect=reconnect, workers=workers, scheduler=scheduler, stop=stop,
+        tally=tally, stream=stream, repeatstop=repeatstop)
+    if stored == listed or harvested and not stop.is_set():
+        PageList.remove(comic.archive.path) # Done with (or past) the list
+    return harvested or reason
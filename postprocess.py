@@ -0,0 +1,158 @@
+# coding: utf-8
+# postprocess.py
+"""
+Post-processing of the stored images, driven by the [postprocess] table of
+the spec (kept in the progress of the comic):
+
+    [postprocess]
+    maxsize     = [1600, 2400]  # Renditions fit in this size
+    format      = "webp"        # ... and are saved in this format
+    quality     = 85
+    replace     = false         # Replace the originals with the renditions
+    thumbstrip  = true          # Add strips of thumbnails of the pages
+    thumbsize   = [150, 225]
+    stripsize   = 50            # Thumbnails per strip
+
+Images are decoded and encoded on a pool of processes (one per core), and
+only the images after the last one processed are handled, so it can run
+after every scrape.
+"""
+import io, os, re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+renditiondir    = ".renditions" # Renditions kept alongside the originals
+stripdir        = ".thumbs"
+formats         = {"jpeg": "jpg", "png": "png", "webp": "webp"} # -> ending
+aliases         = {"jpg": "jpeg", "tif": "tiff"} # Endings PIL doesn't know as formats
+opaque          = {"jpeg", "bmp"} # Formats without transparency
+
+def flatten(picture, target):
+    """Converts the picture to a mode the target format can save, keeping
+    its transparency (or putting it on white, for formats without any)"""
+    if not (picture.mode in ("RGBA", "LA", "PA") or "transparency" in picture.info):
+        return picture if picture.mode in ("RGB", "L") else picture.convert("RGB")
+    picture = picture.convert("RGBA")
+    if not target in opaque:
+        return picture
+    background = Image.new("RGB", picture.size, (255, 255, 255))
+    background.paste(picture, mask=picture.getchannel("A"))
+    return background
+
+def render(data, options):
+    """Makes the rendition of the image (or None if it needs none) and its
+    thumbnail (or None). Runs in the worker processes."""
+    picture = Image.open(io.BytesIO(data))
+    if getattr(picture, "is_animated", False):
+        return None, None # Leave animations be
+    picture.load()
+    rendition = None
+    maxsize = options.get('maxsize')
+    target = (options.get('format') or picture.format or "png").lower()
+    target = aliases.get(target, target)
+    resize = maxsize and (picture.size[0] > maxsize[0] or picture.size[1] > maxsize[1])
+    if resize or target != (picture.format or "").lower():
+        copy = flatten(picture, target)
+        if resize:
+            copy = copy.copy()
+            copy.thumbnail(maxsize, Image.LANCZOS)
+        out = io.BytesIO()
+        copy.save(out, format=target, quality=options.get('quality', 85))
+        rendition = (out.getvalue(), formats.get(target, target))
+    thumbnail = None
+    if options.get('thumbstrip'):
+        thumb = flatten(picture, "jpeg").convert("RGB") # Strips are jpeg
+        thumb.thumbnail(options.get('thumbsize', (150, 225)))
+        thumbnail = (thumb.size, thumb.tobytes())
+    return rendition, thumbnail
+
+def imagenumber(member):
+    match = re.match(r"image(\d+)\.", member)
+    return int(match.group(1)) if match else None
+
+class StripWriter:
+    """Pastes thumbnails into strips, keeping the strip that is being filled
+    (read back from the archive when processing is resumed)"""
+    def __init__(self, archive, options):
+        self.archive    = archive
+        self.cell       = tuple(options.get('thumbsize', (150, 225)))
+        self.size       = options.get('stripsize', 50)
+        self.strip      = None
+        self.number     = None
+
+    def member(self, number):
+        return "{0}/strip{1:04}.jpg".format(stripdir, number)
+
+    def add(self, index, thumbnail):
+        number = (index - 1) // self.size
+        if number != self.number:
+            self.flush()
+            self.number = number
+            self.strip = Image.new("RGB", (self.cell[0] * self.size, self.cell[1]))
+            if self.member(number) in self.archive.list():
+                old = Image.open(io.BytesIO(self.archive.readbytes(self.member(number))))
+                self.strip.paste(old, (0, 0))
+        size, pixels = thumbnail
+        self.strip.paste(Image.frombytes("RGB", size, pixels),
+            (((index - 1) % self.size) * self.cell[0], 0))
+
+    def flush(self):
+        if self.strip is not None:
+            out = io.BytesIO()
+            self.strip.save(out, format="jpeg", quality=80)
+            self.archive.write(self.member(self.number), out.getvalue())
+            self.strip = None
+
+def process(comic, workers=None):
+    """Post-processes the images of the comic that weren't processed yet.
+    Images that can't be rendered are reported and passed over, so they
+    don't stop the rest (or the next run). Returns the number of images
+    processed and of renditions written."""
+    options = comic.progress.get('postprocess')
+    if not options:
+        return 0, 0
+    first = comic.progress.get('processed', 0) + 1
+    members = sorted((member for member in comic.archive.list()
+        if (imagenumber(member) or 0) >= first and not "/" in member),
+        key=imagenumber)
+    if not members:
+        return 0, 0
+    if comic.journal: # Checkpoint the archive before changing it
+        comic.journal.begin(comic.archive)
+    strips = StripWriter(comic.archive, options)
+    written = 0
+    def store(member, future):
+        nonlocal written
+        index = imagenumber(member)
+        try:
+            rendition, thumbnail = future.result()
+        except Exception as e:
+            print("- Could not render '{0}': {1}".format(member, e))
+            rendition, thumbnail = None, None
+        if rendition:
+            data, ending = rendition
+            name = "image{0}.{1}".format(index, ending)
+            if options.get('replace'):
+                comic.archive.remove(member)
+                comic.archive.write(name, data)
+                comic.index.rename(member, name)
+            else:
+                comic.archive.write("{0}/{1}".format(renditiondir, name), data)
+            written += 1
+        if thumbnail:
+            strips.add(index, thumbnail)
+        comic.progress['processed'] = index
+    
+    window = 2 * (workers or os.cpu_count() or 1) # Images in flight
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for member in members:
+            pending.append((member, pool.submit(render,
+                comic.archive.readbytes(member), options)))
+            if len(pending) >= window:
+                store(*pending.popleft())
+        while pending:
+            store(*pending.popleft())
+    strips.flush()
+    return len(members), written
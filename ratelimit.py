@@ -0,0 +1,255 @@
+# coding: utf-8
+# ratelimit.py
+"""
+Politeness per host. Every request the client sends takes a slot from the
+limit of its host, which adapts to the host like TCP does: the number of
+requests in flight grows by one per round of successful requests, and is
+halved when the host answers 429 or 503 or gets slow (its latency grows well
+over the fastest seen). Retry-After and the Crawl-delay of robots.txt space
+the requests out, and specs may override the limits of their host:
+
+    [ratelimit]
+    concurrency     = 2     # Requests in flight at first
+    maxconcurrency  = 8     # ... and at most
+    adaptive        = true  # Whether the limit adapts at all
+    delay           = 0.5   # Seconds between the starts of the requests
+    robots          = true  # Honour the Crawl-delay of robots.txt
+    timeout         = 10    # Seconds a request may stall
+"""
+import time, threading
+from email.utils import parsedate_to_datetime
+from stats import stats
+
+throttled   = (429, 503) # Statuses that ask us to slow down
+slowfactor  = 3.0 # Latency over this many times the fastest means overload
+smoothing   = 0.2 # Weight of the newest latency in the average
+
+def retryafter(value):
+    """The seconds a Retry-After header asks for (or None)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def crawldelayof(text, agent):
+    """The Crawl-delay of the group of the agent (or else of '*') in the
+    robots.txt. Delays may be fractions, which urllib.robotparser ignores."""
+    delays, agents, rules = {}, [], False
+    for line in text.splitlines():
+        line = line.split("#")[0]
+        if not ":" in line:
+            continue
+        field, value = [part.strip() for part in line.split(":", 1)]
+        field = field.lower()
+        if field == "user-agent":
+            if rules: # A new group
+                agents, rules = [], False
+            agents.append(value.lower())
+            continue
+        rules = True
+        if field == "crawl-delay":
+            try:
+                delay = float(value)
+            except ValueError:
+                continue
+            for name in agents:
+                delays.setdefault(name, delay)
+    for name, delay in delays.items():
+        if name != "*" and name in agent.lower():
+            return delay
+    return delays.get("*")
+
+class HostLimit:
+    """The adaptive limit of one host"""
+    def __init__(self, host, concurrency=2, maxconcurrency=16, adaptive=True,
+        delay=0.0, robots=True, timeout=None):
+        self.host       = host
+        self.limit      = float(concurrency)
+        self.max        = maxconcurrency if adaptive else concurrency
+        self.adaptive   = adaptive
+        self.delay      = delay # Seconds between starts (the larger of these two)
+        self.specdelay  = delay # ... that the spec asks for
+        self.robotdelay = 0.0 # ... that the robots.txt asks for
+        self.robots     = robots # Whether robots.txt is still to be read
+        self.timeout    = timeout
+        self.inflight   = 0
+        self.nextstart  = 0.0 # When the next request may start (monotonic)
+        self.latency    = None # Moving average
+        self.fastest    = None
+        self.decreased  = 0.0 # When the limit was last cut
+        self.cond       = threading.Condition()
+
+    def configure(self, concurrency=None, maxconcurrency=None, adaptive=None,
+        delay=None, robots=None, timeout=None):
+        with self.cond:
+            if adaptive is not None:
+                self.adaptive = adaptive
+            if concurrency is not None:
+                self.limit = float(concurrency)
+            if maxconcurrency is not None:
+                self.max = maxconcurrency
+            if not self.adaptive:
+                self.max = int(self.limit)
+            if delay is not None:
+                self.specdelay = delay
+            if robots is not None:
+                self.robots = self.robots and robots
+                if not robots: # Not honoured, even if it was read already
+                    self.robotdelay = 0.0
+            self.delay = max(self.specdelay, self.robotdelay)
+            if timeout is not None:
+                self.timeout = timeout
+            self.cond.notify_all()
+
+    def crawldelay(self, delay):
+        """Honours the Crawl-delay of the robots.txt of the host"""
+        with self.cond:
+            self.robotdelay = float(delay)
+            self.delay = max(self.specdelay, self.robotdelay)
+
+    def acquire(self):
+        """Waits for a slot of the host"""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.inflight < max(1, int(self.limit)) and now >= self.nextstart:
+                    break
+                wait = self.nextstart - now if now < self.nextstart else None
+                self.cond.wait(wait)
+            self.inflight += 1
+            self.nextstart = max(self.nextstart, now + self.delay)
+
+    def release(self):
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    def observe(self, latency, status=None, headers=None):
+        """Adapts the limit to the answer of the host (its status and how
+        long it took to come)"""
+        with self.cond:
+            now = time.monotonic()
+            if status in throttled:
+                stats.count("throttled")
+                wait = retryafter(headers and headers.get("Retry-After"))
+                if wait is None:
+                    wait = max(self.delay, self.latency or 1.0)
+                self.nextstart = max(self.nextstart, now + wait)
+                self.decrease(now)
+                return
+            if latency is None:
+                return
+            self.latency = latency if self.latency is None else \
+                (1 - smoothing) * self.latency + smoothing * latency
+            self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+            if self.latency > slowfactor * max(self.fastest, 0.01):
+                self.decrease(now)
+            elif self.adaptive:
+                # One more in flight per round of requests
+                self.limit = min(self.max, self.limit + 1 / self.limit)
+                self.cond.notify_all()
+
+    def failed(self):
+        """A request that got no answer at all"""
+        with self.cond:
+            self.decrease(time.monotonic())
+
+    def decrease(self, now):
+        """Halves the limit, once per round of requests"""
+        if self.adaptive and now - self.decreased > (self.latency or 1.0):
+            self.limit = max(1.0, self.limit / 2)
+            self.decreased = now
+            if self.fastest is not None: # Forget an unloaded latency that won't come back
+                self.fastest *= 1.5
+
+class Ticket:
+    """The slot of one request, released when its response is done with"""
+    def __init__(self, limit):
+        self.limit      = limit
+        self.started    = time.monotonic()
+        self.released   = False
+
+    def responded(self, status, headers):
+        self.limit.observe(time.monotonic() - self.started, status, headers)
+
+    def failed(self):
+        self.limit.failed()
+        self.release()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limit.release()
+
+class RateLimiter:
+    """The limits of all of the hosts. The 'robots' function returns the
+    text of the robots.txt of a url (or None)."""
+    def __init__(self, concurrency=2, maxconcurrency=16, robots=None,
+        agent="comic_scraper"):
+        self.concurrency    = concurrency
+        self.maxconcurrency = maxconcurrency
+        self.robots         = robots
+        self.agent          = agent
+        self.hosts          = {} # (scheme, host, port) -> HostLimit
+        self.overrides      = {} # host -> options
+        self.lock           = threading.Lock()
+
+    def configure(self, host, **options):
+        """Overrides the limits of the host (from a spec)"""
+        with self.lock:
+            self.overrides[host] = options
+            limits = [limit for key, limit in self.hosts.items() if key[1] == host]
+        for limit in limits:
+            limit.configure(**options)
+
+    def hostlimit(self, key):
+        with self.lock:
+            limit = self.hosts.get(key)
+            if limit is None:
+                limit = HostLimit(key[1], concurrency=self.concurrency,
+                    maxconcurrency=self.maxconcurrency, robots=bool(self.robots))
+                limit.configure(**self.overrides.get(key[1], {}))
+                self.hosts[key] = limit
+        return limit
+
+    def crawldelay(self, key):
+        """The Crawl-delay the robots.txt of the host asks for (or None)"""
+        scheme, host, port = key
+        default = 443 if scheme == "https" else 80
+        url = "{0}://{1}{2}/robots.txt".format(scheme, host,
+            "" if port == default else ":{0}".format(port))
+        try:
+            text = self.robots(url)
+        except Exception:
+            return None # No robots.txt, no rules
+        if not text:
+            return None
+        return crawldelayof(text.decode("utf-8", "replace"), self.agent)
+
+    def acquire(self, key):
+        """Waits for a slot of the host of the connection key. Returns the
+        Ticket of the request."""
+        limit = self.hostlimit(key)
+        if limit.robots:
+            with limit.cond: # The first request of the host reads robots.txt
+                if limit.robots:
+                    delay = self.crawldelay(key)
+                    if delay:
+                        limit.crawldelay(delay)
+                    limit.robots = False
+        limit.acquire()
+        return Ticket(limit)
+
+    def describe(self):
+        """Describes the limits the hosts settled at"""
+        with self.lock:
+            limits = list(self.hosts.values())
+        return ", ".join("{0}: {1:.1f} in flight{2}".format(limit.host,
+            limit.limit, ", {0:.1f}s apart".format(limit.delay) if limit.delay else "")
+            for limit in limits)
@@ -0,0 +1,258 @@
+# coding: utf-8
+# reader.py
+"""
+A local reader for the comics, served over HTTP. Archives are opened by
+reading their central directory only, and pages are sliced out of a memory
+map of the archive (comics kept in the other backends of stores.py are read
+through their own index). The next pages are prefetched as the reader moves
+forward, and thumbnails are kept in a least recently used cache that spills
+to disk.
+"""
+import os, io, re, html, hashlib, imghdr, threading
+import http.server
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+from PIL import Image
+from ziparchive import ZipArchive, MappedZip
+from stores import archivetype, loadarchive
+from utils import comicdir, extension, thumbdir, getcomiclist
+
+thumbsize = (200, 300)
+
+class LRU:
+    """A least recently used mapping of a limited number of items. Evicted
+    items are given to 'spill' (if it is set)."""
+    def __init__(self, maxitems, spill=None):
+        self.maxitems   = maxitems
+        self.spill      = spill
+        self.items      = OrderedDict()
+        self.lock       = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        return None
+
+    def put(self, key, value):
+        evicted = []
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxitems:
+                evicted.append(self.items.popitem(last=False))
+        if self.spill:
+            for item in evicted:
+                self.spill(*item)
+
+class ThumbnailCache:
+    """Thumbnails of the pages, in memory and spilled to the folder"""
+    def __init__(self, directory, maxitems=256, size=thumbsize):
+        self.directory  = directory
+        self.size       = size
+        self.memory     = LRU(maxitems, spill=self.spill)
+
+    def key(self, title, member, stamp):
+        """Names the thumbnail after the content of the member (its stamp)"""
+        text = "{0}\0{1}\0{2}\0{3}".format(title, member, stamp, self.size)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".jpg")
+
+    def spill(self, key, data):
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = path + ".tmp{0}".format(threading.get_ident())
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+
+    def get(self, key, image):
+        """Returns the thumbnail with the key, making it from the image
+        bytes (a function returning them) if it isn't cached"""
+        data = self.memory.get(key)
+        if data is None:
+            try:
+                with open(self.path(key), "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = self.make(image())
+            self.memory.put(key, data)
+        return data
+
+    def make(self, data):
+        picture = Image.open(io.BytesIO(data))
+        picture.draft("RGB", self.size) # Decode JPEGs at a lower scale
+        picture = picture.convert("RGB")
+        picture.thumbnail(self.size)
+        out = io.BytesIO()
+        picture.save(out, format="jpeg", quality=80)
+        return out.getvalue()
+
+def pagenumber(member):
+    match = re.match(r"image(\d+)\.", member)
+    return int(match.group(1)) if match else None
+
+class Shelf:
+    """The open archives of the reader, with the page and thumbnail caches"""
+    def __init__(self, thumbs=256, pages=32, prefetch=4, workers=2):
+        self.lock       = threading.Lock()
+        self.archives   = {} # title -> (archive, [page members])
+        self.pages      = LRU(pages) # (title, member, stamp) -> bytes
+        self.thumbs     = ThumbnailCache(thumbdir, maxitems=thumbs)
+        self.ahead      = prefetch # Pages prefetched after the one read
+        self.pool       = ThreadPoolExecutor(max_workers=workers)
+
+    def open(self, title):
+        """Returns the archive and the page members of the comic, mapping it
+        again if it was changed (by a scrape) since it was opened"""
+        with self.lock:
+            found = self.archives.get(title)
+            if found and not found[0].isstale():
+                return found
+            path = os.path.join(comicdir, title+extension)
+            if not os.path.exists(path):
+                raise KeyError(title)
+            if archivetype(path) is ZipArchive:
+                archive = MappedZip(path)
+            else: # Scraped into another backend and not exported yet
+                archive = loadarchive(path)
+            members = sorted((member for member in archive.list()
+                if pagenumber(member) is not None), key=pagenumber)
+            # An old map is closed when its last reader lets go of it
+            self.archives[title] = (archive, members)
+            return archive, members
+
+    def count(self, title):
+        return len(self.open(title)[1])
+
+    def locate(self, title, num):
+        """Returns the archive, the member and the stamp of the page (from 1),
+        so the page isn't taken from the caches once it was replaced"""
+        archive, members = self.open(title)
+        if not 1 <= num <= len(members):
+            raise KeyError(num)
+        member = members[num-1]
+        return archive, member, archive.memberstamp(member)
+
+    def page(self, title, num):
+        """Returns the bytes of the page (from 1)"""
+        archive, member, stamp = self.locate(title, num)
+        data = self.pages.get((title, member, stamp))
+        if data is None:
+            data = archive.readbytes(member)
+            self.pages.put((title, member, stamp), data)
+        return data
+
+    def thumbnail(self, title, num):
+        archive, member, stamp = self.locate(title, num)
+        key = self.thumbs.key(title, member, stamp)
+        return self.thumbs.get(key, lambda: self.page(title, num))
+
+    def prefetch(self, title, num):
+        """Reads the pages after the given one in the background"""
+        archive, members = self.open(title)
+        for after in range(num + 1, min(num + self.ahead, len(members)) + 1):
+            member = members[after-1]
+            if self.pages.get((title, member, archive.memberstamp(member))) is None:
+                archive.prefetch(member)
+                self.pool.submit(self.page, title, after)
+
+def contenttype(data):
+    kind = imghdr.what(None, data[:32])
+    return "image/" + kind if kind else "application/octet-stream"
+
+def indexpage(titles):
+    items = "\n".join('<li><a href="/comic/{0}/">{1}</a></li>'.format(
+        quote(title), html.escape(title)) for title in titles)
+    return """<!DOCTYPE html><html><head><meta charset="utf-8">
+<title>Comics</title></head><body><h1>Comics</h1><ul>{0}</ul></body></html>""".format(
+        items or "<li>No comics present!</li>")
+
+def thumbspage(title, count):
+    thumbs = "\n".join('<a href="/comic/{0}/{1}"><img loading="lazy" '
+        'src="/thumb/{0}/{1}" title="{1}"></a>'.format(quote(title), num)
+        for num in range(1, count + 1))
+    return """<!DOCTYPE html><html><head><meta charset="utf-8">
+<title>{0}</title></head><body><h1>{0}</h1><p><a href="/">Comics</a></p>
+{1}</body></html>""".format(html.escape(title), thumbs)
+
+def readerpage(title, num, count):
+    comic = quote(title)
+    prev = "/comic/{0}/{1}".format(comic, max(num - 1, 1))
+    after = "/comic/{0}/{1}".format(comic, min(num + 1, count))
+    return """<!DOCTYPE html><html><head><meta charset="utf-8">
+<title>{title} - {num}/{count}</title>
+<link rel="prefetch" href="/image/{comic}/{nextnum}">
+<style>body {{ text-align: center; background: #222; color: #ccc; }}
+img {{ max-width: 100%; }} a {{ color: #ccc; }}</style></head><body>
+<p><a href="/comic/{comic}/">{title}</a> - {num}/{count}</p>
+<a href="{after}"><img src="/image/{comic}/{num}"></a>
+<p><a href="{prev}">Previous</a> <a href="{after}">Next</a></p>
+<script>document.onkeydown = function(e) {{
+    if (e.key == "ArrowLeft") location = "{prev}";
+    if (e.key == "ArrowRight") location = "{after}";
+}};</script></body></html>""".format(title=html.escape(title), comic=comic,
+        num=num, count=count, nextnum=min(num + 1, count), prev=prev,
+        after=after)
+
+def makehandler(shelf):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive
+        def do_GET(self):
+            parts = [unquote(part) for part in self.path.split("?")[0].split("/")[1:]]
+            try:
+                if parts == [""]:
+                    return self.reply("text/html; charset=utf-8",
+                        indexpage(getcomiclist()).encode("utf-8"))
+                kind, title = parts[0], parts[1]
+                num = int(parts[2]) if len(parts) > 2 and parts[2] else None
+                if kind == "comic" and num is None:
+                    return self.reply("text/html; charset=utf-8",
+                        thumbspage(title, shelf.count(title)).encode("utf-8"))
+                if kind == "comic":
+                    return self.reply("text/html; charset=utf-8", readerpage(title,
+                        num, shelf.count(title)).encode("utf-8"))
+                if kind == "image":
+                    data = shelf.page(title, num)
+                    shelf.prefetch(title, num)
+                    return self.reply(contenttype(data), data, cache=True)
+                if kind == "thumb":
+                    return self.reply("image/jpeg", shelf.thumbnail(title, num),
+                        cache=True)
+            except (KeyError, IndexError, ValueError):
+                pass
+            self.send_error(404)
+
+        def reply(self, contenttype, body, cache=False):
+            self.send_response(200)
+            self.send_header("Content-Type", contenttype)
+            self.send_header("Content-Length", str(len(body)))
+            if cache:
+                self.send_header("Cache-Control", "max-age=3600")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+def serve(host="127.0.0.1", port=8080, thumbs=256, prefetch=4):
+    """Serves the comics until interrupted"""
+    shelf = Shelf(thumbs=thumbs, prefetch=prefetch)
+    server = Server((host, port), makehandler(shelf))
+    print("Serving the comics at http://{0}:{1}/".format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+    finally:
+        server.server_close()
+        shelf.pool.shutdown(wait=False)
@@ -0,0 +1,38 @@
+# coding: utf-8
+# scheduler.py
+"""
+Shares the network between everything that is scraped in one process:
+a global cap on the number of concurrent fetches, and a cap per host.
+"""
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+class Scheduler:
+    """Hands out fetch slots. A fetch first waits for its host, and only then
+    for a global slot, so a busy host never holds slots the others could use."""
+    def __init__(self, connections=8, perhost=2):
+        self.connections    = threading.BoundedSemaphore(connections)
+        self.perhost        = perhost
+        self.hosts          = {} # host -> semaphore
+        self.lock           = threading.Lock()
+
+    def hostslots(self, url):
+        """Returns the semaphore of the host of the url"""
+        host = urlparse(url).netloc
+        with self.lock:
+            if not host in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.perhost)
+            return self.hosts[host]
+
+    @contextmanager
+    def slot(self, url):
+        """Holds a fetch slot for the url while in the with-block"""
+        with self.hostslots(url):
+            with self.connections:
+                yield
+
+    def run(self, url, func, *args, **kwargs):
+        """Calls the (fetch) function with the url inside a slot"""
+        with self.slot(url):
+            return func(url, *args, **kwargs)
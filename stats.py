@@ -0,0 +1,125 @@
+# coding: utf-8
+# stats.py
+"""
+Timings and counters of the scrape phases (fetching, parsing, identifying,
+downloading, writing, ...). Every timed phase goes into a histogram with
+power-of-two buckets, which is cheap enough to always keep on. Runs append a
+summary to a JSON-lines file, and '--stats' prints it.
+"""
+import json, math, time, threading
+from contextlib import contextmanager
+from functools import wraps
+
+class Histogram:
+    """The durations (and bytes) of one phase, in power-of-two microsecond
+    buckets"""
+    def __init__(self):
+        self.count      = 0
+        self.seconds    = 0.0
+        self.max        = 0.0
+        self.bytes      = 0
+        self.buckets    = {} # log2(microseconds) -> count
+
+    def add(self, seconds, size=0):
+        self.count      += 1
+        self.seconds    += seconds
+        self.bytes      += size
+        self.max        = max(self.max, seconds)
+        bucket = max(0, int(math.log2(seconds * 1e6))) if seconds > 0 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        """The upper bound of the bucket of the percentile, in seconds"""
+        wanted, seen = fraction * self.count, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return min(2 ** (bucket + 1) / 1e6, self.max)
+        return self.max
+
+    def getdict(self):
+        return {
+            "count": self.count,
+            "seconds": self.seconds,
+            "mean": self.seconds / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+            "bytes": self.bytes,
+            "buckets": {str(2 ** bucket): count
+                for bucket, count in sorted(self.buckets.items())},
+        }
+
+class Stats:
+    """The phase histograms and counters of the process"""
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.phases     = {}
+        self.counters   = {}
+        self.started    = time.time()
+
+    @contextmanager
+    def timer(self, phase):
+        """Times the with-block as the phase. Yields a dict where the block
+        can put the number of 'bytes' it handled."""
+        event = {"bytes": 0}
+        started = time.perf_counter()
+        try:
+            yield event
+        finally:
+            self.record(phase, time.perf_counter() - started, event["bytes"])
+
+    def timed(self, phase):
+        """Decorates a function to time its calls as the phase"""
+        def decorator(func):
+            @wraps(func)
+            def timedfunc(*args, **kwargs):
+                with self.timer(phase):
+                    return func(*args, **kwargs)
+            return timedfunc
+        return decorator
+
+    def record(self, phase, seconds, size=0):
+        with self.lock:
+            if not phase in self.phases:
+                self.phases[phase] = Histogram()
+            self.phases[phase].add(seconds, size)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def getdict(self):
+        with self.lock:
+            return {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "seconds": time.time() - self.started,
+                "phases": {phase: histogram.getdict()
+                    for phase, histogram in self.phases.items()},
+                "counters": dict(self.counters),
+            }
+
+    def dump(self, path, **extra):
+        """Appends the stats of this run as a line to the JSON-lines file"""
+        data = self.getdict()
+        data.update(extra)
+        with open(path, "a") as f:
+            f.write(json.dumps(data, sort_keys=True) + "\n")
+
+    def summary(self):
+        """Returns the stats as lines of text"""
+        data = self.getdict()
+        lines = ["Stats ({0:.1f}s):".format(data['seconds'])]
+        for phase, h in sorted(data['phases'].items(),
+            key=lambda item: -item[1]['seconds']):
+            line = "- {0}: {1} x, {2:.3f}s total, mean {3:.1f}ms, p50 {4:.1f}ms, p95 {5:.1f}ms, max {6:.1f}ms".format(
+                phase, h['count'], h['seconds'], h['mean'] * 1e3, h['p50'] * 1e3,
+                h['p95'] * 1e3, h['max'] * 1e3)
+            if h['bytes']:
+                line += ", {0:.1f} KB".format(h['bytes'] / 1024)
+            lines.append(line)
+        for counter, val in sorted(data['counters'].items()):
+            lines.append("- {0}: {1}".format(counter, val))
+        return lines
+
+stats = Stats()
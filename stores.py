@@ -0,0 +1,458 @@
+# coding: utf-8
+# stores.py
+"""
+Archive backends besides ZipArchive, with the same interface (see utils):
+
+    DirectoryArchive    Every member is a file in a folder at the path of
+                        the archive, so writing one is a plain file write.
+    PackArchive         Members are appended to a single pack file, and an
+                        index next to it (.idx) maps them to their offsets,
+                        so appends never rewrite anything and reads seek
+                        straight to the member.
+
+The backend of a new comic is the 'archive' option of its spec ("zip", "dir"
+or "pack"), and the backend of a stored one is told from what is at its path.
+'export' turns an archive of another backend into the .cbz that comic
+readers understand, in its place.
+"""
+import os, json, shutil, struct, threading
+from ziparchive import ZipArchive, unchanged
+
+def checkmode(mode):
+    if not mode in ["a", "r"]:
+        raise Exception("Archive must be opened in modes 'r' or 'a'!")
+
+def tobytes(content):
+    return content.encode("utf-8") if isinstance(content, str) else content
+
+class DirectoryArchive:
+    """An archive kept as a folder of member files. Members are written to a
+    temporary file and renamed into place, so a member is either whole or
+    not there, and a checkpoint only has to sync the files written since."""
+    def __init__(self, filepath):
+        self.path       = filepath
+        self.unsynced   = set() # Files written since the last checkpoint
+        self.stamp      = DirectoryArchive.stampof(filepath)
+
+    def create(filepath):
+        os.makedirs(filepath)
+        return DirectoryArchive(filepath)
+
+    def load(filepath, mode='r'):
+        checkmode(mode)
+        if not os.path.isdir(filepath):
+            raise Exception("Archive folder not found: '{0}'".format(filepath))
+        return DirectoryArchive(filepath)
+
+    def file(self, member):
+        parts = member.split("/")
+        if ".." in parts:
+            raise KeyError("Bad member name '{0}'".format(member))
+        return os.path.join(self.path, *parts)
+
+    def read(self, member):
+        return str(self.readbytes(member), encoding="utf-8")
+
+    def readbytes(self, member):
+        try:
+            with open(self.file(member), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError("There is no member named '{0}'".format(member))
+
+    def write(self, member, content):
+        self.writestream(member, [tobytes(content)])
+
+    def writestream(self, member, chunks):
+        path = self.file(member)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp, path)
+        self.unsynced.add(path)
+
+    def writemany(self, members):
+        """Writes the members (a dict of their contents) that changed"""
+        stored = set(self.list())
+        for member, content in members.items():
+            if not unchanged(self, member, content, stored):
+                self.write(member, content)
+
+    def remove(self, member):
+        try:
+            os.remove(self.file(member))
+        except FileNotFoundError:
+            raise KeyError("There is no member named '{0}'".format(member))
+        self.unsynced.discard(self.file(member))
+
+    def list(self):
+        members = []
+        for folder, dirs, files in os.walk(self.path):
+            relative = os.path.relpath(folder, self.path)
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue # Torn by a crash
+                members.append(name if relative == "." else
+                    "/".join(relative.split(os.sep) + [name]))
+        return sorted(members)
+
+    def sync(self):
+        for path in self.unsynced:
+            try:
+                with open(path, "rb") as f:
+                    os.fsync(f.fileno())
+            except FileNotFoundError:
+                pass
+        self.unsynced = set()
+
+    def close(self):
+        self.sync()
+
+    def checkpoint(self):
+        """Syncs the members written since the last checkpoint. There is
+        nothing to put back later, as no member is ever torn."""
+        self.sync()
+        return 0, b""
+
+    def restore(filepath, offset, tail):
+        pass
+
+    def isvalid(filepath):
+        return os.path.isdir(filepath)
+
+    def waste(self):
+        return 0
+
+    def compact(self):
+        """Removes the temporary files left by a crash"""
+        reclaimed = 0
+        for folder, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".tmp"):
+                    path = os.path.join(folder, name)
+                    reclaimed += os.path.getsize(path)
+                    os.remove(path)
+        return reclaimed
+
+    # For the reader
+    def stampof(filepath):
+        stat = os.stat(filepath)
+        return (stat.st_mtime, stat.st_nlink)
+
+    def isstale(self):
+        try:
+            return DirectoryArchive.stampof(self.path) != self.stamp
+        except OSError:
+            return True
+
+    def memberstamp(self, member):
+        stat = os.stat(self.file(member))
+        return (stat.st_mtime, stat.st_size)
+
+    def prefetch(self, member):
+        pass
+
+# A pack record: magic, kind, length of the name and of the data, then both
+record      = struct.Struct("<4sBHQ")
+packmagic   = b"CPAK"
+data, removal, pending = 0, 1, 2 # Kinds of records (pending: data being written)
+
+class PackArchive:
+    """An append-only archive in a pack file with an index. Every write and
+    removal is a record appended to the pack (which alone is enough to
+    rebuild the index), and a line appended to the index."""
+    def __init__(self, filepath, mode):
+        self.path       = filepath
+        self.indexpath  = filepath + ".idx"
+        self.lock       = threading.Lock()
+        if PackArchive.istorn(self.indexpath): # Lines after it would be lost
+            PackArchive.reindex(filepath)
+        self.members    = PackArchive.readindex(self.indexpath) # -> (offset, size)
+        self.mode       = None
+        self.pack       = None
+        self.index      = None
+        self.stamp      = PackArchive.stampof(filepath)
+        self._setmode(mode)
+
+    def _setmode(self, mode):
+        # Appending can read as well, so the mode never goes back to 'r'
+        if self.mode != mode and self.mode != "a":
+            if self.pack:
+                self.pack.close()
+            self.mode = mode
+            self.pack = open(self.path, "r+b" if mode == "a" else "rb")
+            if mode == "a":
+                self.index = open(self.indexpath, "a", encoding="utf-8")
+
+    def create(filepath):
+        open(filepath, "wb").close()
+        open(filepath + ".idx", "w").close()
+        return PackArchive(filepath, "a")
+
+    def load(filepath, mode='r'):
+        checkmode(mode)
+        if not os.path.exists(filepath):
+            raise Exception("Archive file not found: '{0}'".format(filepath))
+        return PackArchive(filepath, mode)
+
+    def istorn(indexpath):
+        """Whether the index is missing or its last line is cut short"""
+        try:
+            with open(indexpath, "rb") as f:
+                if f.seek(0, 2) == 0:
+                    return False
+                f.seek(-1, 2)
+                return f.read(1) != b"\n"
+        except OSError:
+            return True
+
+    def readindex(indexpath):
+        """The members of the index, up to a torn last line"""
+        members = {}
+        with open(indexpath, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    member, offset, size = json.loads(line)
+                except ValueError:
+                    break
+                if offset is None:
+                    members.pop(member, None)
+                else:
+                    members[member] = (offset, size)
+        return members
+
+    def scan(filepath):
+        """Yields the (member, offset of the data, size or None if removed)
+        of the whole records in the pack"""
+        end = os.path.getsize(filepath)
+        with open(filepath, "rb") as f:
+            while True:
+                start = f.tell()
+                head = f.read(record.size)
+                if len(head) < record.size:
+                    return
+                magic, kind, namelen, size = record.unpack(head)
+                if magic != packmagic or not kind in (data, removal):
+                    return # Not a record, or one torn by a crash
+                member = f.read(namelen).decode("utf-8")
+                offset = start + record.size + namelen
+                if offset + size > end:
+                    return # Torn by a crash
+                f.seek(offset + size)
+                yield member, offset, (size if kind == data else None)
+
+    def reindex(filepath):
+        """Rebuilds the index of the pack from its records"""
+        temp = filepath + ".idx.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            for member, offset, size in PackArchive.scan(filepath):
+                f.write(json.dumps([member, offset if size is not None else None,
+                    size]) + "\n")
+        os.replace(temp, filepath + ".idx")
+
+    def read(self, member):
+        return str(self.readbytes(member), encoding="utf-8")
+
+    def readbytes(self, member):
+        if not member in self.members:
+            raise KeyError("There is no member named '{0}'".format(member))
+        offset, size = self.members[member]
+        with self.lock:
+            self.pack.seek(offset)
+            return self.pack.read(size)
+
+    def append(self, member, kind, chunks):
+        """Appends a record, returning the offset and size of its data. Data
+        records are pending until all of their data is written, so a record
+        torn by a crash is never read as a whole one."""
+        name = member.encode("utf-8")
+        with self.lock:
+            start = self.pack.seek(0, 2)
+            self.pack.write(record.pack(packmagic, pending if kind == data else kind,
+                len(name), 0))
+            self.pack.write(name)
+            size = 0
+            for chunk in chunks:
+                size += self.pack.write(chunk)
+            if kind == data:
+                self.pack.seek(start)
+                self.pack.write(record.pack(packmagic, kind, len(name), size))
+                self.pack.seek(0, 2)
+            offset = start + record.size + len(name)
+            self.index.write(json.dumps([member, offset if kind == data else None,
+                size]) + "\n")
+        return offset, size
+
+    def write(self, member, content):
+        self.writestream(member, [tobytes(content)])
+
+    def writestream(self, member, chunks):
+        self._setmode("a")
+        self.members[member] = self.append(member, data, chunks)
+
+    def writemany(self, members):
+        """Writes the members (a dict of their contents) that changed"""
+        for member, content in members.items():
+            if not unchanged(self, member, content, self.members):
+                self.write(member, content)
+
+    def remove(self, member):
+        self._setmode("a")
+        if not member in self.members:
+            raise KeyError("There is no member named '{0}'".format(member))
+        self.append(member, removal, [])
+        del self.members[member]
+
+    def list(self):
+        return list(self.members)
+
+    def close(self):
+        if self.mode == "a": # Durable like a zip archive that was closed
+            self.checkpoint()
+        if self.index:
+            self.index.close()
+            self.index = None
+        if self.pack:
+            self.pack.close()
+            self.pack = None
+        self.mode = None
+
+    def checkpoint(self):
+        """Syncs the pack and then the index. Returns the end of the pack,
+        which 'restore' cuts the pack back to."""
+        self._setmode("a")
+        with self.lock:
+            self.pack.flush()
+            os.fsync(self.pack.fileno())
+            self.index.flush()
+            os.fsync(self.index.fileno())
+            return self.pack.seek(0, 2), b""
+
+    def restore(filepath, offset, tail):
+        """Cuts the pack back to the checkpoint and indexes it anew"""
+        with open(filepath, "r+b") as f:
+            f.truncate(min(offset, os.fstat(f.fileno()).st_size))
+            f.flush()
+            os.fsync(f.fileno())
+        PackArchive.reindex(filepath)
+
+    def isvalid(filepath):
+        """A pack that wasn't closed cleanly is never kept as it is: whatever
+        was written after the checkpoint may be torn, or missing from the
+        index, and new records would be appended after it."""
+        return False
+
+    def waste(self):
+        live = sum(record.size + len(member.encode("utf-8")) + size
+            for member, (offset, size) in self.members.items())
+        return os.path.getsize(self.path) - live
+
+    def compact(self):
+        """Rewrites the pack with only its current members. Returns the
+        number of bytes that were reclaimed."""
+        before = os.path.getsize(self.path)
+        temp = self.path + ".compact"
+        members = {}
+        try:
+            with open(temp, "wb") as out, \
+                open(temp + ".idx", "w", encoding="utf-8") as index:
+                for member in self.list():
+                    content = self.readbytes(member)
+                    name = member.encode("utf-8")
+                    out.write(record.pack(packmagic, data, len(name), len(content)))
+                    out.write(name)
+                    offset = out.tell()
+                    out.write(content)
+                    members[member] = (offset, len(content))
+                    index.write(json.dumps([member, offset, len(content)]) + "\n")
+            mode = self.mode
+            self.close()
+            os.replace(temp, self.path)
+            os.replace(temp + ".idx", self.indexpath)
+        finally:
+            for path in (temp, temp + ".idx"):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.members = members
+        self._setmode(mode or "r")
+        return before - os.path.getsize(self.path)
+
+    # For the reader
+    def stampof(filepath):
+        stat = os.stat(filepath + ".idx")
+        return (stat.st_size, stat.st_mtime)
+
+    def isstale(self):
+        try:
+            return PackArchive.stampof(self.path) != self.stamp
+        except OSError:
+            return True
+
+    def memberstamp(self, member):
+        return self.members[member]
+
+    def prefetch(self, member):
+        pass
+
+backends = {"zip": ZipArchive, "dir": DirectoryArchive, "pack": PackArchive}
+
+def archivetype(filepath):
+    """The backend of the archive at the path"""
+    if os.path.isdir(filepath):
+        return DirectoryArchive
+    if os.path.exists(filepath + ".idx"):
+        return PackArchive
+    try:
+        with open(filepath, "rb") as f:
+            if f.read(len(packmagic)) == packmagic:
+                return PackArchive
+    except OSError:
+        pass
+    return ZipArchive
+
+def loadarchive(filepath, mode='r'):
+    """Loads the archive at the path with its backend"""
+    return archivetype(filepath).load(filepath, mode=mode)
+
+def archivesize(filepath):
+    """The bytes the archive at the path takes"""
+    kind = archivetype(filepath)
+    if kind is DirectoryArchive:
+        return sum(os.path.getsize(os.path.join(folder, name))
+            for folder, dirs, files in os.walk(filepath) for name in files)
+    if kind is PackArchive:
+        return os.path.getsize(filepath) + os.path.getsize(filepath + ".idx")
+    return os.path.getsize(filepath)
+
+def removearchive(filepath):
+    """Removes the archive at the path, whatever its backend"""
+    if os.path.isdir(filepath):
+        shutil.rmtree(filepath)
+    elif os.path.exists(filepath):
+        os.remove(filepath)
+    if os.path.exists(filepath + ".idx"):
+        os.remove(filepath + ".idx")
+
+def export(filepath):
+    """Writes the archive at the path out as a zip archive in its place.
+    Returns the backend it was in (None if it was a zip archive already)."""
+    kind = archivetype(filepath)
+    if kind is ZipArchive:
+        return None
+    source = kind.load(filepath)
+    temp = filepath + ".export"
+    try:
+        target = ZipArchive.create(temp)
+        for member in source.list():
+            target.write(member, source.readbytes(member))
+        target.close()
+        source.close()
+        removearchive(filepath)
+        os.replace(temp, filepath)
+    finally:
+        source.close()
+        if os.path.exists(temp):
+            os.remove(temp)
+    return kind
@@ -0,0 +1,97 @@
+# coding: utf-8
+# test_archives.py
+"""
+Tests that sessions on a comic only write what they changed, so that its
+archive doesn't grow when nothing (or only the progress) changed.
+"""
+import os, sys, shutil, tempfile, unittest
+home = tempfile.mkdtemp(prefix="comictest")
+os.environ["COMIC_SCRAPER_HOME"] = home
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import toml
+from utils import comicdir, metadatafile, progressfile, indexfile, indexdir, extension
+from stores import backends, loadarchive
+from comic import Comic
+
+def makecomic(title, backend):
+    """Stores a comic of a few images that was scraped up to page 3"""
+    os.makedirs(comicdir, exist_ok=True)
+    archive = backend.create(os.path.join(comicdir, title+extension))
+    for num in range(1, 4):
+        archive.write("image{0}.png".format(num), os.urandom(2048))
+    archive.write(metadatafile, toml.dumps({"title": title, "authors": ["x"]}))
+    archive.write(progressfile, toml.dumps({"lastindex": 3, "lastimages": [],
+        "lastpage": "http://example.com/3", "pages": 3}))
+    archive.close()
+
+def size(title):
+    path = os.path.join(comicdir, title+extension)
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(folder, name))
+            for folder, dirs, files in os.walk(path) for name in files)
+    return os.path.getsize(path)
+
+class SessionTest(unittest.TestCase):
+    def session(self, title, change=None):
+        with Comic.load(title) as comic:
+            if change:
+                change(comic)
+        return size(title)
+
+    def test_unchanged_session(self):
+        for name, backend in backends.items():
+            title = "Unchanged " + name
+            makecomic(title, backend)
+            before = self.session(title) # Written as toml.dumps writes it
+            for _ in range(3):
+                self.assertEqual(self.session(title), before, name)
+
+    def test_progress_rewritten_in_place(self):
+        makecomic("Progress", backends["zip"])
+        def setpages(pages):
+            def change(comic):
+                comic.progress['pages'] = pages
+            return change
+        before = self.session("Progress", setpages(10))
+        for pages in range(11, 15): # Same length, so the same size
+            self.assertEqual(self.session("Progress", setpages(pages)), before)
+
+    def test_index_stored_in_segments(self):
+        for name, backend in backends.items():
+            title = "Index " + name
+            makecomic(title, backend)
+            for num in range(1, 4):
+                with Comic.load(title) as comic:
+                    comic.index.add("http://example.com/{0}.png".format(num),
+                        "digest{0}".format(num), "image{0}.png".format(num))
+            archive = loadarchive(os.path.join(comicdir, title+extension))
+            segments = [member for member in archive.list()
+                if member.startswith(indexdir + "/")]
+            self.assertEqual(len(segments), 3, name)
+            self.assertNotIn(indexfile, archive.list(), name)
+            archive.close()
+            with Comic.load(title) as comic:
+                self.assertEqual(comic.index.memberof(
+                    comic.index.digestof("http://example.com/2.png")), "image2.png")
+                comic.index.prune(["image1.png", "image2.png"])
+            archive = loadarchive(os.path.join(comicdir, title+extension))
+            self.assertIn(indexfile, archive.list(), name)
+            self.assertFalse([member for member in archive.list()
+                if member.startswith(indexdir + "/")], name)
+            archive.close()
+
+    def test_metadata_rewritten_in_place(self):
+        makecomic("Metadata", backends["zip"])
+        def settag(tag):
+            def change(comic):
+                comic.metadata['tags'] = [tag]
+            return change
+        before = self.session("Metadata", settag("a"))
+        for tag in "bcd":
+            self.assertEqual(self.session("Metadata", settag(tag)), before)
+
+def tearDownModule():
+    shutil.rmtree(home, ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
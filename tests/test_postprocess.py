@@ -0,0 +1,39 @@
+# coding: utf-8
+# test_postprocess.py
+"""
+Tests that post-processing passes over the images it can't render.
+"""
+import io, os, sys, shutil, tempfile, unittest
+home = tempfile.mkdtemp(prefix="comictest")
+os.environ.setdefault("COMIC_SCRAPER_HOME", home)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PIL import Image
+from ziparchive import ZipArchive
+from comic import Comic
+from postprocess import process, renditiondir
+
+def png(size):
+    out = io.BytesIO()
+    Image.new("RGB", size, (200, 100, 50)).save(out, format="png")
+    return out.getvalue()
+
+class ProcessTest(unittest.TestCase):
+    def test_corrupt_image(self):
+        archive = ZipArchive.create(os.path.join(home, "Corrupt.cbz"))
+        archive.write("image1.png", png((40, 60)))
+        archive.write("image2.png", b"\x89PNG\r\n\x1a\n not an image")
+        archive.write("image3.png", png((40, 60)))
+        progress = {"lastindex": 3, "postprocess": {"format": "jpeg"}}
+        comic = Comic(archive, progress, {"title": "Corrupt"})
+        self.assertEqual(process(comic, workers=1), (3, 2))
+        self.assertEqual(comic.progress['processed'], 3)
+        self.assertEqual(sorted(member for member in archive.list()
+            if member.startswith(renditiondir)),
+            [renditiondir + "/image1.jpg", renditiondir + "/image3.jpg"])
+        archive.close()
+
+def tearDownModule():
+    shutil.rmtree(home, ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
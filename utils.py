@@ -1,8 +1,9 @@
 # coding: utf-8
 # Created by Jabok @ August 14th 2014
 # utils.py
-import os, sys, subprocess, toml
+import os, sys, time, subprocess, toml
 from ziparchive import ZipArchive
+from stores import loadarchive, archivesize
 from validators import validate_metadata, validate_progdata
 from argparse import ArgumentParser
 """
@@ -31,14 +32,30 @@ def assertpath(path, filetype="path"):
         return False
     return True
 
+def gethome(*path):
+    """Returns the path relatively to where the comics and the rest of the
+    data are kept (this script's location, unless COMIC_SCRAPER_HOME is set)"""
+    home = os.environ.get("COMIC_SCRAPER_HOME") or os.path.dirname(__file__)
+    return os.path.join(home, os.path.join(*path))
+
 # Global tweakable variables
-comicdir        = getlocal("comics")
-metadir         = getlocal("metadata")
+comicdir        = gethome("comics")
+metadir         = gethome("metadata")
 metadatafile    = ".metadata.toml" # inside the zip
 progressfile    = ".progress.toml"
+indexfile       = ".images.json" # Content hashes of the images
+indexdir        = ".images" # ... added since, a segment per session
 defaultarchive  = ZipArchive
 extension       = ".cbz"
 lastcomicfile   = os.path.join(metadir, "lastcomic.toml")
+cachedir        = gethome("cache") # Fetched pages and images
+cachesize       = 512 * 2**20 # bytes
+pagecachesize   = 64 * 2**20 # ... of which pages keep for themselves
+thumbdir        = gethome("cache", "thumbs") # Thumbnails spilled by the reader
+statsfile       = os.path.join(metadir, "stats.jsonl") # Phase timings of runs
+libraryindexfile = os.path.join(metadir, "images.db") # Shared content hashes
+catalogfile     = os.path.join(metadir, "catalog.db") # What list and info show
+queuedir        = gethome("queue") # Work units of distributed scrapes
 
 """
 Needed interface for archives
@@ -51,6 +68,7 @@ close(self)
 list(self)
 __enter__(self)
 __exit__(self)
+Besides ZipArchive, stores.py has a folder and an append-only pack backend.
 """
 def read(*args):
     """read [comic]
@@ -59,14 +77,7 @@ def read(*args):
     if not args:
         return printhelp("read")
     name = " ".join(args).strip()
-    title = None
-    if name in getcomiclist():
-        title = name
-    else:
-        for comic in getcomiclist():
-            if comic.startswith(name):
-                title = comic
-                break
+    title = getcatalog().find(name)
     if title:
         print("Opening '{0}'...".format(title))
         path = os.path.join(comicdir, title+extension)
@@ -77,21 +88,26 @@ def read(*args):
     else:
         print("No comic found.")
 
-def getcomiclist():
+def getcatalog():
+    """Returns the catalog of the comics (building it if there is none, and
+    else bringing it in line with the archives in the comic folder)"""
+    from catalog import shared as catalog
+    if not catalog.built():
+        catalog.rebuild()
+    else:
+        catalog.reconcile()
+    return catalog
+
+def getcomiclist(prefix=""):
     """Returns a list of the names of the comics currently in local storage"""
-    comics = []
-    if os.path.exists(comicdir): 
-        for file in os.listdir(comicdir):
-            if file.endswith(extension):
-                comics.append(file[:-1*len(extension)])
-    return sorted(comics)
+    return getcatalog().titles(prefix)
 
 def listcomics(*args):
     """list [prefix]
     Lists the locally stored comics (optionally starting with 
     the given text)."""
     prefix  = " ".join(args).strip()
-    valid   = [comic for comic in getcomiclist() if comic.startswith(prefix)]
+    valid   = getcomiclist(prefix)
     if not valid:
         print("No comics present!")
     else:
@@ -110,6 +126,35 @@ def infocomic(*args):
     if not args:
         return printhelp("info")
     query = " ".join(args).strip()
+    catalog = getcatalog()
+    title = catalog.find(query)
+    if not title:
+        return print("No comic found.")
+    info = catalog.get(title)
+    scraped = "never"
+    if info['scraped']:
+        scraped = time.strftime("%Y-%m-%d %H:%M", time.localtime(info['scraped']))
+    print(info['title'])
+    print("- Authors:   ", ", ".join(info['authors']))
+    if info['tags']:
+        print("- Tags:      ", ", ".join(info['tags']))
+    print("- Images:    ", info['images'])
+    print("- Pages:     ", "unknown" if info['pages'] is None else info['pages'])
+    print("- Size:       {0:.1f} MB".format(info['size'] / 2**20))
+    print("- Last page: ", info['lastpage'] or "-")
+    print("- Scraped:   ", scraped)
+    print("- Archive:   ", info['path'])
+
+def rebuild(*args):
+    """rebuild
+    Rebuilds the catalog of the comics (that list and info use) by
+    reading every archive in local storage."""
+    from catalog import shared as catalog
+    started = time.time()
+    count, failed = catalog.rebuild()
+    for path, error in failed:
+        print("- Could not read '{0}': {1}".format(path, error))
+    print("Cataloged {0} comics in {1:.2f}s".format(count, time.time() - started))
 
 def resume(*args):
     """resume
@@ -127,6 +172,71 @@ def resume(*args):
                 print("Resuming scrape of comic", specs['title'])
                 fetchcomic(specs, directory=directory)
 
+def compact(*args):
+    """compact [comic]
+    Rewrites the archive of the comic (or of every comic) without the space
+    left behind by replaced and duplicated members. The segments of its
+    image index are folded into the index first."""
+    from imageindex import ImageIndex
+    name = " ".join(args).strip()
+    titles = [name] if name else getcomiclist()
+    for title in titles:
+        path = os.path.join(comicdir, title+extension)
+        if not assertpath(path, "comic"):
+            continue
+        archive = loadarchive(path)
+        try:
+            members, removed = ImageIndex.load(archive).changes(fold=True)
+            for segment in removed:
+                archive.remove(segment)
+            archive.writemany(members)
+            reclaimed = archive.compact()
+        finally:
+            archive.close()
+        getcatalog().resize(title, path)
+        print("- {0}: reclaimed {1} bytes".format(title, reclaimed))
+
+def export(*args):
+    """export [comic]
+    Turns the archive of the comic (or of every comic) into a .cbz, if it
+    was scraped into a folder or a pack (the 'archive' option of the spec)."""
+    import stores
+    from journal import Journal
+    name = " ".join(args).strip()
+    titles = [name] if name else getcomiclist()
+    for title in titles:
+        path = os.path.join(comicdir, title+extension)
+        if not assertpath(path, "comic"):
+            continue
+        if Journal(path).exists():
+            print("- {0}: didn't close cleanly, scrape or process it first".format(title))
+            continue
+        before = archivesize(path)
+        backend = stores.export(path)
+        if not backend:
+            print("- {0}: a .cbz already".format(title))
+            continue
+        getcatalog().resize(title, path)
+        print("- {0}: exported from {1} ({2} -> {3} bytes)".format(title,
+            backend.__name__, before, os.path.getsize(path)))
+
+def process(*args):
+    """process [comic]
+    Post-processes the new images of the comic (or of every comic) as
+    the [postprocess] options of its spec say."""
+    from comic import Comic
+    from fetcher import postprocess
+    name = " ".join(args).strip()
+    titles = [name] if name else getcomiclist()
+    for title in titles:
+        progress = Comic.peek(title) # None if it has to be recovered first
+        if progress is not None and not progress.get('postprocess'):
+            continue # Loading it for writing would only rewrite its progress
+        with Comic.load(title) as comic:
+            if comic.progress.get('postprocess'):
+                print("- {0}:".format(title))
+                postprocess(comic)
+
 def edit(*args):
     """Moves and opens the medadata (or progress) of a comic for editing"""
     from __main__ import _editcmd
@@ -1,22 +1,117 @@
 # coding: utf-8
 # Created by Jabok @ August 14th 2014
 # main.py
-import os, zipfile, tempfile
+import os, time, zipfile, tempfile, imghdr, mmap, struct, zlib
+
+# Image formats that are compressed already; deflating them only costs time
+storedformats = {"jpeg", "png", "gif", "webp"}
+
+# Archives opened for appending are compacted when they are closed with more
+# than this share of their bytes wasted (and at least 'compactwaste' bytes)
+compactratio = 0.25
+compactwaste = 256 * 1024
+
+def compression(member, content, default=zipfile.ZIP_DEFLATED):
+    """The default compression policy: images that are compressed already
+    (sniffed like Comic.add does) are stored, and everything else (metadata,
+    progress and descriptions) is deflated."""
+    if isinstance(content, bytes) and imghdr.what(None, content) in storedformats:
+        return zipfile.ZIP_STORED
+    return default
+
+def unchanged(archive, member, content, members):
+    """Whether the member is stored in the archive (whose 'members' are
+    given) with the same content already"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return member in members and archive.readbytes(member) == content
+
+class CentralDirectory:
+    """The central directory of a zip file open for appending. zipfile has no
+    API to remove members or to write the directory without closing, so this
+    is the one place that uses its internals; they are checked up front, so
+    a Python that changed them fails loudly instead of corrupting archives."""
+    internals = ["NameToInfo", "filelist", "start_dir", "fp", "_lock",
+        "_didModify", "_write_end_record"]
+    
+    def __init__(self, arch):
+        missing = [name for name in CentralDirectory.internals if not hasattr(arch, name)]
+        if missing:
+            raise Exception("Unsupported zipfile module (missing {0})".format(
+                ", ".join(missing)))
+        self.arch = arch
+    
+    def has(self, member):
+        return member in self.arch.NameToInfo
+    
+    def start(self):
+        """Where the central directory starts (the end of the last member)"""
+        return self.arch.start_dir
+    
+    def remove(self, member):
+        """Drops the member (and its older duplicates) from the directory.
+        Returns its info."""
+        arch = self.arch
+        info = arch.NameToInfo.pop(member)
+        arch.filelist = [other for other in arch.filelist if other.filename != member]
+        arch._didModify = True # Rewrite the central directory on close
+        return info
+    
+    def end(self, info):
+        """The offset after the data of the member"""
+        arch = self.arch
+        with arch._lock:
+            arch.fp.seek(info.header_offset + 26)
+            namelen, extralen = struct.unpack("<HH", arch.fp.read(4))
+        end = info.header_offset + 30 + namelen + extralen + info.compress_size
+        if info.flag_bits & 0x08: # A data descriptor follows
+            end += 16 if info.compress_size < 0xFFFFFFFF else 24
+        return end
+    
+    def cut(self, offset):
+        """Moves the start of the central directory back to the offset, so
+        the members written next overwrite what was there"""
+        self.arch.start_dir = offset
+        self.arch._didModify = True
+    
+    def flush(self):
+        """Writes the central directory and syncs the file without closing
+        it. Returns where the directory starts and the bytes from there."""
+        arch = self.arch
+        with arch._lock:
+            arch.fp.seek(arch.start_dir)
+            arch._write_end_record()
+            arch.fp.flush()
+            os.fsync(arch.fp.fileno())
+            arch.fp.seek(arch.start_dir)
+            return arch.start_dir, arch.fp.read()
+
 class ZipArchive:
-    """An archive interface for the zip format"""
+    """An archive interface for the zip format.
+    The archive keeps one handle open: it is only reopened once, when the
+    first write happens to an archive loaded for reading, and members that
+    were just written can be read from the same handle. Writing a member
+    that exists replaces it in the central directory instead of adding a
+    duplicate. The member is overwritten in place if nothing comes after it;
+    otherwise the bytes it leaves behind are reclaimed by 'compact', which
+    runs on close once enough of the archive is wasted."""
     def _setmode(self, mode):
-        if self.mode != mode:
+        # Appending can read as well, so the mode never goes back to 'r'
+        if self.mode != mode and self.mode != "a":
             #print("Setting mode to '"+mode+"'")
             if self.arch:
                 self.arch.close()
             self.mode = mode
             self.arch = zipfile.ZipFile(self.path, mode=self.mode, compression=self.comp)
         
-    def __init__(self, filepath, mode, comp=zipfile.ZIP_DEFLATED):
+    def __init__(self, filepath, mode, comp=zipfile.ZIP_DEFLATED,
+        policy=compression):
         self.path = filepath
         self.comp = comp
+        self.policy = policy # (member, content, default) -> compression
         self.mode = None
         self.arch = None
+        self.checkpointed = 0 # Bytes before this are never overwritten
         self._setmode(mode)
         
     def create(filepath):
@@ -31,15 +126,217 @@ class ZipArchive:
             return ZipArchive(filepath, mode=mode)
     
     def read(self, member):
+        return str(self.readbytes(member), encoding="utf-8")
+    
+    def readbytes(self, member):
         self._setmode("r")
-        return str(self.arch.read(member), encoding="utf-8")
+        return self.arch.read(member)
     
     def write(self, member, content):
         self._setmode("a")
-        return self.arch.writestr(member, content)
+        if CentralDirectory(self.arch).has(member):
+            self.remove(member)
+        comp = self.policy(member, content, self.comp) if self.policy else self.comp
+        return self.arch.writestr(member, content, compress_type=comp)
+    
+    def writestream(self, member, chunks):
+        """Writes the member from an iterable of byte chunks, without holding
+        all of it in memory. The compression policy sees the first chunk."""
+        self._setmode("a")
+        if CentralDirectory(self.arch).has(member):
+            self.remove(member)
+        chunks = iter(chunks)
+        head = next(chunks, b"")
+        info = zipfile.ZipInfo(member, time.localtime()[:6])
+        info.compress_type = self.policy(member, head, self.comp) if self.policy else self.comp
+        info.external_attr = 0o600 << 16 # Like writestr
+        with self.arch.open(info, "w") as f:
+            f.write(head)
+            for chunk in chunks:
+                f.write(chunk)
+    
+    def writemany(self, members):
+        """Writes the members (a dict of their contents), skipping those that
+        are stored with the same content already. The members it replaces
+        are removed last first, together with the given members that follow
+        them at the end of the file, so that all of those are written over
+        in place instead of being left behind."""
+        stored = set(self.list())
+        rewrite = set(member for member, content in members.items()
+            if not unchanged(self, member, content, stored))
+        if not rewrite:
+            return
+        self._setmode("a")
+        infos = sorted(self.arch.infolist(), key=lambda info: info.header_offset)
+        tail = [] # The given members at the end of the file, in file order
+        for info in reversed(infos):
+            if not info.filename in members:
+                break
+            tail.insert(0, info.filename)
+        for num, member in enumerate(tail):
+            if member in rewrite: # Those after it cost nothing to write again
+                rewrite.update(tail[num:])
+                break
+        for info in reversed(infos):
+            if info.filename in rewrite and CentralDirectory(self.arch).has(info.filename):
+                self.remove(info.filename)
+        for member, content in members.items():
+            if member in rewrite:
+                self.write(member, content)
+    
+    def remove(self, member):
+        """Removes the member from the central directory. If it is the last
+        member in the file (and was written after the last checkpoint), the
+        next member is written over it; otherwise its bytes stay in the file
+        until the archive is compacted."""
+        self._setmode("a")
+        directory = CentralDirectory(self.arch)
+        if not directory.has(member):
+            raise KeyError("There is no member named '{0}'".format(member))
+        info = directory.remove(member)
+        if (info.header_offset >= self.checkpointed and
+            directory.end(info) == directory.start()):
+            directory.cut(info.header_offset)
     
     def close(self):
+        if self.mode == "a" and self.wasteful():
+            self.compact()
         return self.arch.close()
+    
+    def wasteful(self):
+        """Whether enough of the archive is wasted to compact it"""
+        waste = self.waste()
+        return waste >= compactwaste and waste > compactratio * CentralDirectory(self.arch).start()
+    
+    def checkpoint(self):
+        """Writes the central directory and flushes the archive to disk
+        without closing it. Returns the offset of the central directory and
+        the bytes from there to the end, which 'restore' puts back if the
+        process dies while later members are being written over them."""
+        self._setmode("a")
+        offset, tail = CentralDirectory(self.arch).flush()
+        self.checkpointed = offset
+        return offset, tail
+    
+    def restore(filepath, offset, tail):
+        """Puts the archive back in the state of a checkpoint"""
+        with open(filepath, "r+b") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def isvalid(filepath):
+        """Whether the archive can be opened"""
+        try:
+            zipfile.ZipFile(filepath).close()
+            return True
+        except (zipfile.BadZipFile, OSError):
+            return False
             
     def list(self):
-        return list([info.filename for info in self.arch.infolist()])
\ No newline at end of file
+        return list([info.filename for info in self.arch.infolist()])
+    
+    def waste(self):
+        """Returns the number of bytes that aren't used by the members"""
+        live = sum(len(info.FileHeader()) + info.compress_size
+            for info in self.arch.infolist())
+        return CentralDirectory(self.arch).start() - live
+    
+    def compact(self):
+        """Rewrites the archive with only its current members (the last
+        version of each, for archives with duplicates), and returns the number
+        of bytes that were reclaimed."""
+        before = os.path.getsize(self.path)
+        latest = {}
+        for info in self.arch.infolist(): # The last duplicate wins
+            latest[info.filename] = info
+        folder = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=folder, suffix=".compact")
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(temp, "w") as target:
+                for info in self.arch.infolist():
+                    if latest[info.filename] is not info:
+                        continue
+                    copy = zipfile.ZipInfo(info.filename, info.date_time)
+                    copy.compress_type = info.compress_type
+                    copy.external_attr = info.external_attr
+                    copy.comment = info.comment
+                    target.writestr(copy, self.arch.read(info))
+            self.arch.close()
+            self.arch, self.mode = None, None
+            os.replace(temp, self.path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        self._setmode("r")
+        return before - os.path.getsize(self.path)
+
+class MappedZip:
+    """Read-only random access to the members of a zip archive.
+    The central directory is read once, and members are sliced out of a
+    memory map of the file by their offsets, so opening a large archive
+    costs no more than reading its directory."""
+    def __init__(self, filepath):
+        self.path       = filepath
+        self.stamp      = MappedZip.stampof(filepath)
+        self.infos      = {}
+        with zipfile.ZipFile(filepath) as arch:
+            for info in arch.infolist(): # The last duplicate wins
+                self.infos[info.filename] = info
+        self.file       = open(filepath, "rb")
+        self.map        = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.starts     = {} # member -> offset of its data
+    
+    def stampof(filepath):
+        stat = os.stat(filepath)
+        return (stat.st_size, stat.st_mtime)
+    
+    def isstale(self):
+        """Whether the archive was changed since it was mapped"""
+        try:
+            return MappedZip.stampof(self.path) != self.stamp
+        except OSError:
+            return True
+    
+    def list(self):
+        return list(self.infos)
+    
+    def memberstamp(self, member):
+        """What changes when the content of the member does"""
+        info = self.infos[member]
+        return (info.CRC, info.file_size)
+    
+    def start(self, member):
+        """The offset of the data of the member (after its local header)"""
+        if not member in self.starts:
+            offset = self.infos[member].header_offset
+            namelen, extralen = struct.unpack("<HH", self.map[offset+26:offset+30])
+            self.starts[member] = offset + 30 + namelen + extralen
+        return self.starts[member]
+    
+    def readbytes(self, member):
+        info = self.infos[member]
+        start = self.start(member)
+        data = self.map[start:start+info.compress_size]
+        if info.compress_type == zipfile.ZIP_STORED:
+            return data
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        raise Exception("Unsupported compression of '{0}': {1}".format(
+            member, info.compress_type))
+    
+    def prefetch(self, member):
+        """Asks the system to read the member into memory ahead of time"""
+        if not hasattr(self.map, "madvise"):
+            return
+        start = self.start(member)
+        aligned = start - start % mmap.PAGESIZE
+        self.map.madvise(mmap.MADV_WILLNEED, aligned,
+            start - aligned + self.infos[member].compress_size)
+    
+    def close(self):
+        self.map.close()
+        self.file.close()